@@ -110,6 +110,7 @@ setup(
             'flake8',
             'flaky',
             'isort',
+            'pytest-benchmark',
             'pytest-cov',
             'pytest-runner',
             'pytest-splinter',
@@ -146,6 +147,8 @@ setup(
             'ws-sanity-check=websauna.system.devop.scripts.sanitycheck:main',
             'ws-collect-static=websauna.system.devop.scripts.collectstatic:main',
             'ws-settings=websauna.system.devop.scripts.settings:main',
+            'ws-generate-sitemap=websauna.system.devop.scripts.generatesitemap:main',
+            'ws-purge-sessions=websauna.system.devop.scripts.purgesessions:main',
         ],
 
         'paste.app_factory': [
@@ -246,7 +246,9 @@ class Initializer:
         self.config.set_authorization_policy(authz_policy)
 
         # We need to carefully be above TM view, but below exc view so that internal server error page doesn't trigger session authentication that accesses the database
-        self.config.add_tween("websauna.system.auth.tweens.SessionInvalidationTweenFactory", under="pyramid_tm.tm_tween_factory")
+        # With the user session index, sessions are deleted directly when authentication details change and no per-request check is needed
+        if not asbool(self.settings.get("websauna.user_session_index", False)):
+            self.config.add_tween("websauna.system.auth.tweens.SessionInvalidationTweenFactory", under="pyramid_tm.tm_tween_factory")
 
         # Grab incoming auth details changed events
         from websauna.system.auth import subscribers
@@ -669,6 +671,12 @@ class Initializer:
         from websauna.system.devop import tasks  # noQA
         self.config.scan(tasks)
 
+        from websauna.system.crud import tasks as crud_tasks
+        self.config.scan(crud_tasks)
+
+        from websauna.system.core import tasks as core_tasks
+        self.config.scan(core_tasks)
+
     @event_source
     def configure_tweens(self):
         """Configure tweens."""
@@ -70,6 +70,10 @@ class Listing(crud_views.Listing):
         # We override this method just to define admin route_name traversing
         return super(Listing, self).listing()
 
+    @view_config(context=ModelAdmin, name="bulk", request_method="POST", route_name="admin", permission='view')
+    def bulk(self):
+        return super(Listing, self).bulk()
+
 
 class Show(crud_views.Show):
     """Default show view for model admin."""
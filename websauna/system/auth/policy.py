@@ -3,6 +3,8 @@ from pyramid.authentication import \
     SessionAuthenticationPolicy as _SessionAuthenticationPolicy
 
 # Websauna
+from websauna.system.auth import sessionindex
+from websauna.system.core.session import WebsaunaSession
 from websauna.utils.time import now
 
 
@@ -26,11 +28,17 @@ class SessionAuthenticationPolicy(_SessionAuthenticationPolicy):
         if self.authenticated_at_key not in request.session:
             request.session[self.authenticated_at_key] = now()
 
+        sessionindex.add_user_session(request, userid)
+
         return []
 
     def forget(self, request):
         """User logs out or is forced to be forgotten."""
 
+        userid = request.session.get(self.userid_key)
+        if userid is not None:
+            sessionindex.remove_user_session(request, userid)
+
         # Wiggle session keys so that we know when unauthentication happened
         request.session[self.unauthenticated_at_key] = now()
 
@@ -48,5 +56,10 @@ class SessionAuthenticationPolicy(_SessionAuthenticationPolicy):
         # Cookie header.
         # request.add_response_callback(add_vary_callback_if_cookie("Cookie"))
 
+        session = request.session
+        if isinstance(session, WebsaunaSession) and session.cookie_session_id is None:
+            # Without a session cookie nobody is logged in. Do not load or create a session in Redis.
+            return None
+
         # Dispatch to the real SessionAuthenticationPolicy
         return super().unauthenticated_userid(request)
@@ -0,0 +1,93 @@
+"""Per-user index of Redis sessions.
+
+Each logged in session id is added to a Redis set keyed by the user session token when the user logs in and removed when the user logs out. The expiration time of the set is reset whenever a session of the user is written or touched, see :py:meth:`websauna.system.core.session.WebsaunaSession.expire`, so the set lives as long as the sessions it points to. Session ids of sessions which have expired are left in the set and skipped when the sessions are deleted. When the user authentication details change, :py:func:`delete_user_sessions` deletes all sessions of the user directly, logging the user out everywhere.
+
+With ``websauna.user_session_index`` setting enabled, the sessions are trusted to be killed through this index and :py:class:`websauna.system.auth.tweens.SessionInvalidationTweenFactory` is not installed. This saves comparing the session login time to the user in the database on every request.
+"""
+# Standard Library
+import logging
+import typing as t
+
+from redis import StrictRedis
+
+# Websauna
+from websauna.system.core.redis import get_redis
+from websauna.system.http import Request
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Redis key prefix for the set of session ids of a user
+KEY_PREFIX = "user_sessions_"
+
+#: Session key the authenticated user session token is stored under, see :py:class:`pyramid.authentication.SessionAuthenticationPolicy`
+USERID_KEY = "auth.userid"
+
+
+def get_index_key(token: t.Any) -> str:
+    """Get the Redis key of the session set of a user.
+
+    :param token: User session token, see :py:meth:`websauna.system.user.userregistry.UserRegistry.get_session_token`
+    """
+    return KEY_PREFIX + str(token)
+
+
+def get_session_redis(request: Request) -> StrictRedis:
+    """Get the Redis connection where sessions are stored."""
+    redis = getattr(request.session, "redis", None)
+    if redis is None:
+        redis = get_redis(request)
+    return redis
+
+
+def add_user_session(request: Request, token: t.Any):
+    """Add the current session to the session index of a user on login."""
+    session = request.session
+    session_id = getattr(session, "session_id", None)
+    if not session_id:
+        # Not a Redis session
+        return
+
+    key = get_index_key(token)
+    with get_session_redis(request).pipeline() as pipe:
+        pipe.sadd(key, session_id)
+        # The index does not need to live longer than the sessions it points to
+        pipe.expire(key, session.timeout)
+        pipe.execute()
+
+
+def remove_user_session(request: Request, token: t.Any):
+    """Remove the current session from the session index of a user on logout."""
+    session_id = getattr(request.session, "session_id", None)
+    if not session_id:
+        return
+
+    get_session_redis(request).srem(get_index_key(token), session_id)
+
+
+def delete_user_sessions(request: Request, token: t.Any) -> int:
+    """Delete all indexed sessions of a user.
+
+    If the current request session belongs to the user, it is invalidated, so that it is not written back at the end of the request.
+
+    :param token: User session token
+    :return: Number of deleted sessions
+    """
+    redis = get_session_redis(request)
+    key = get_index_key(token)
+    session_ids = [s.decode("utf-8") for s in redis.smembers(key)]
+
+    current_session_id = getattr(request.session, "session_id", None) if getattr(request.session, "loaded", True) else None
+    if current_session_id in session_ids:
+        request.session.invalidate()
+
+    with redis.pipeline() as pipe:
+        for session_id in session_ids:
+            pipe.delete(session_id)
+        pipe.delete(key)
+        results = pipe.execute()
+
+    deleted = sum(results[:-1])
+    logger.info("Deleted %d sessions of user %s", deleted, token)
+    return deleted
@@ -3,7 +3,9 @@
 from pyramid.events import subscriber
 
 # Websauna
+from websauna.system.auth.sessionindex import delete_user_sessions
 from websauna.system.user.events import UserAuthSensitiveOperation
+from websauna.system.user.utils import get_user_registry
 from websauna.utils.time import now
 
 
@@ -18,3 +20,7 @@ def user_auth_details_changes(event: UserAuthSensitiveOperation):
     user = event.user
     # Update the timestamp which session validation checks on every request
     user.last_auth_sensitive_operation_at = now()
+
+    # Log out the user everywhere
+    token = get_user_registry(event.request).get_session_token(user)
+    delete_user_sessions(event.request, token)
@@ -11,6 +11,7 @@ from sqlalchemy import orm
 
 # Websauna
 from websauna.system.core import messages
+from websauna.system.core.session import WebsaunaSession
 from websauna.system.http import Request
 
 
@@ -35,6 +36,10 @@ class SessionInvalidationTweenFactory:
         self.registry = registry
 
     def __call__(self, request: Request):
+        if isinstance(request.session, WebsaunaSession) and request.session.cookie_session_id is None:
+            # No session cookie, so no logged in user. Do not load or create a session in Redis.
+            return self.handler(request)
+
         user = request.user
         if user:
             try:
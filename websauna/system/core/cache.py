@@ -0,0 +1,432 @@
+"""Caching computed data in Redis.
+
+Cache results of expensive functions, like rendered fragments or aggregate database queries, with :py:func:`cached` decorator:
+
+.. code-block:: python
+
+    from websauna.system.core.cache import cached
+
+
+    @cached(ttl=300, tags=["products"])
+    def get_bestsellers(request, category_id):
+        # ... slow query ...
+        return bestsellers
+
+    # Later, when products change
+    get_cache(request).invalidate_tags("products")
+
+The first argument of the decorated function must be a request or a registry. Use :py:class:`Cache` returned by :py:func:`get_cache` for explicit access.
+
+Keys are prefixed by a namespace, so caches of different add-ons do not clash. Values can be tagged and all values with a tag deleted at once. Each tag has a version which is increased when the tag is invalidated. :py:meth:`Cache.get_or_set` does not store a value if any of its tags was invalidated while the value was being computed, as the value may have been computed from stale data. Deleting a single key with :py:meth:`Cache.delete` gives no such protection.
+
+Tag invalidation deletes the values listed in a tag set from a Lua script, which accesses keys not declared to Redis. It does not work with Redis Cluster.
+
+Cache stampedes are prevented in two ways. When a value is missing, only one process computes it while the others wait for the result. Before a value expires, it is recomputed early with increasing probability, based on how long the computation took, so popular values are usually refreshed before they expire. See `Optimal Probabilistic Cache Stampede Prevention <http://www.vldb.org/pvldb/vol8/p886-vattani.pdf>`_.
+
+Values are pickled by default. Select another serializer with ``websauna.cache_serializer`` setting or ``serializer`` argument: ``json``, ``compact`` (:py:mod:`websauna.system.core.sessionserializer`) or your own :py:class:`Serializer`.
+"""
+# Standard Library
+import functools
+import hashlib
+import json
+import logging
+import math
+import os
+import pickle
+import random
+import struct
+import time
+import typing as t
+
+# Pyramid
+from pyramid.registry import Registry
+
+from redis import StrictRedis
+
+# Websauna
+from websauna.system.core import sessionserializer
+from websauna.system.core.redis import get_redis
+from websauna.system.http import Request
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Default namespace of cache keys
+DEFAULT_NAMESPACE = "cache"
+
+#: Expiration time and computation time in seconds stored before the serialized value
+HEADER = struct.Struct("!dd")
+
+#: Marker for a value not in the cache
+MISSING = object()
+
+#: Seconds to keep a tag version after the tag was last invalidated. Computations taking longer than this may store stale values.
+TAG_VERSION_TTL = 86400
+
+#: Set a value and add its key to tag sets. Tag sets are sorted sets of keys scored by their expiration time in milliseconds. Expired keys are removed from a tag set whenever a value is added to it. Tag sets live as long as their longest living value.
+#: KEYS[1] is the value key, followed by tag set key and tag version key pairs. ARGV is value, time to live in milliseconds, current time in milliseconds and optionally the expected version of each tag.
+#: Returns 0 without setting the value if a tag version is not the expected one.
+SET_SCRIPT = """
+local tags = (#KEYS - 1) / 2
+if #ARGV > 3 then
+    for i = 1, tags do
+        if (redis.call("GET", KEYS[2 * i + 1]) or "") ~= ARGV[3 + i] then
+            return 0
+        end
+    end
+end
+redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2])
+local expires_at = tonumber(ARGV[3]) + tonumber(ARGV[2])
+for i = 1, tags do
+    local tag_key = KEYS[2 * i]
+    redis.call("ZREMRANGEBYSCORE", tag_key, "-inf", ARGV[3])
+    redis.call("ZADD", tag_key, expires_at, KEYS[1])
+    if redis.call("PTTL", tag_key) < tonumber(ARGV[2]) then
+        redis.call("PEXPIRE", tag_key, ARGV[2])
+    end
+end
+return 1
+"""
+
+#: Delete tag sets and all values listed in them and increase the tag versions. Returns the number of deleted values.
+#: KEYS are tag set key and tag version key pairs. ARGV[1] is the time to live of tag versions in seconds.
+#: The deleted values are not declared in KEYS, so this does not work with Redis Cluster.
+INVALIDATE_SCRIPT = """
+local deleted = 0
+for i = 1, #KEYS, 2 do
+    for _, key in ipairs(redis.call("ZRANGE", KEYS[i], 0, -1)) do
+        deleted = deleted + redis.call("DEL", key)
+    end
+    redis.call("DEL", KEYS[i])
+    redis.call("INCR", KEYS[i + 1])
+    redis.call("EXPIRE", KEYS[i + 1], ARGV[1])
+end
+return deleted
+"""
+
+#: Release a lock only if we still hold it
+UNLOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+#: Script source -> registered script
+_scripts = {}
+
+
+def _as_tags(tags: t.Union[str, t.Iterable[str]]) -> t.List[str]:
+    """Get tags as a list, wrapping a single tag given as a string."""
+    if isinstance(tags, str):
+        return [tags]
+    return list(tags)
+
+
+class Serializer:
+    """Convert cached values to bytes and back."""
+
+    def dumps(self, value) -> bytes:
+        raise NotImplementedError()
+
+    def loads(self, data: bytes):
+        raise NotImplementedError()
+
+
+class PickleSerializer(Serializer):
+    """Any picklable value."""
+
+    def dumps(self, value) -> bytes:
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data: bytes):
+        return pickle.loads(data)
+
+
+class JSONSerializer(Serializer):
+    """JSON compatible values only. Safe to read from untrusted sources and readable by other languages."""
+
+    def dumps(self, value) -> bytes:
+        return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data: bytes):
+        return json.loads(data.decode("utf-8"))
+
+
+class CompactSerializer(Serializer):
+    """JSON with datetimes, sets and other common types, see :py:mod:`websauna.system.core.sessionserializer`."""
+
+    def dumps(self, value) -> bytes:
+        return sessionserializer.serialize(value)
+
+    def loads(self, data: bytes):
+        return sessionserializer.deserialize(data)
+
+
+#: Serializer name -> serializer
+SERIALIZERS = {
+    "pickle": PickleSerializer(),
+    "json": JSONSerializer(),
+    "compact": CompactSerializer(),
+}
+
+
+def get_serializer(serializer: t.Union[str, Serializer]) -> Serializer:
+    """Resolve a serializer by its name.
+
+    :param serializer: Name in :py:data:`SERIALIZERS` or a serializer instance
+    """
+    if isinstance(serializer, Serializer):
+        return serializer
+
+    try:
+        return SERIALIZERS[serializer]
+    except KeyError:
+        raise RuntimeError("Unknown cache serializer: {}. Available: {}".format(serializer, ", ".join(sorted(SERIALIZERS))))
+
+
+def _run_script(redis: StrictRedis, script: str, keys: list, args: list):
+    registered = _scripts.get(script)
+    if registered is None:
+        registered = _scripts[script] = redis.register_script(script)
+    return registered(keys=keys, args=args, client=redis)
+
+
+class Cache:
+    """Namespaced cache in Redis."""
+
+    def __init__(self, redis: StrictRedis, namespace: str = DEFAULT_NAMESPACE, serializer: t.Union[str, Serializer] = "pickle", lock_timeout: float = 10.0, beta: float = 1.0):
+        """
+        :param redis: Redis client
+        :param namespace: Prefix of all keys
+        :param serializer: Serializer name or instance
+        :param lock_timeout: Maximum seconds to wait for another process computing a missing value. Should be longer than the computation takes.
+        :param beta: Eagerness of early recomputation. Values over 1 favour earlier recomputation, 0 disables it.
+        """
+        self.redis = redis
+        self.namespace = namespace
+        self.serializer = get_serializer(serializer)
+        self.lock_timeout = lock_timeout
+        self.beta = beta
+
+    def make_key(self, key: str) -> str:
+        """Get the Redis key of a cache key."""
+        return "{}:{}".format(self.namespace, key)
+
+    def make_tag_key(self, tag: str) -> str:
+        """Get the Redis key of the set of keys with a tag."""
+        return "{}:tag:{}".format(self.namespace, tag)
+
+    def make_tag_version_key(self, tag: str) -> str:
+        """Get the Redis key of the version of a tag."""
+        return "{}:tagver:{}".format(self.namespace, tag)
+
+    def _make_tag_keys(self, tags: t.Iterable[str]) -> list:
+        """Get tag set key and tag version key pairs as a flat list."""
+        keys = []
+        for tag in tags:
+            keys += [self.make_tag_key(tag), self.make_tag_version_key(tag)]
+        return keys
+
+    def get_tag_versions(self, tags: t.Iterable[str]) -> t.List[str]:
+        """Get the current versions of tags, to be passed to :py:meth:`set`.
+
+        :return: Version of each tag, empty string for tags never invalidated
+        """
+        tags = _as_tags(tags)
+        if not tags:
+            return []
+        versions = self.redis.mget([self.make_tag_version_key(tag) for tag in tags])
+        return ["" if version is None else version.decode("utf-8") for version in versions]
+
+    def _load(self, key: str) -> t.Tuple[object, float, float]:
+        """Read a value with its expiration time and computation time."""
+        data = self.redis.get(self.make_key(key))
+        if data is None:
+            return MISSING, 0.0, 0.0
+
+        expires_at, delta = HEADER.unpack_from(data)
+        return self.serializer.loads(data[HEADER.size:]), expires_at, delta
+
+    def get(self, key: str, default=None):
+        """Get a cached value.
+
+        :return: Cached value or ``default``
+        """
+        value, expires_at, delta = self._load(key)
+        return default if value is MISSING else value
+
+    def set(self, key: str, value, ttl: float, tags: t.Union[str, t.Iterable[str]] = (), delta: float = 0.0, versions: t.Optional[t.List[str]] = None) -> bool:
+        """Store a value.
+
+        :param ttl: Seconds to keep the value
+        :param tags: Tag or tags to invalidate the value with, see :py:meth:`invalidate_tags`
+        :param delta: Seconds the computation of the value took. Used to decide when to recompute it early.
+        :param versions: Tag versions from :py:meth:`get_tag_versions` read before the value was computed. The value is not stored if any of the tags has been invalidated since.
+        :return: True if the value was stored
+        """
+        ttl_ms = max(1, int(ttl * 1000))
+        current_time = time.time()
+        data = HEADER.pack(current_time + ttl, delta) + self.serializer.dumps(value)
+        redis_key = self.make_key(key)
+        tag_keys = self._make_tag_keys(_as_tags(tags))
+        if tag_keys:
+            args = [data, ttl_ms, int(current_time * 1000)] + (list(versions) if versions is not None else [])
+            return bool(_run_script(self.redis, SET_SCRIPT, [redis_key] + tag_keys, args))
+
+        self.redis.set(redis_key, data, px=ttl_ms)
+        return True
+
+    def delete(self, key: str) -> bool:
+        """Delete a value.
+
+        :return: True if the value was cached
+        """
+        return bool(self.redis.delete(self.make_key(key)))
+
+    def invalidate_tags(self, *tags: str) -> int:
+        """Delete all values with any of the tags.
+
+        Values of the tags being computed by :py:meth:`get_or_set` at the same time are not stored. Not supported with Redis Cluster.
+
+        :return: Number of deleted values
+        """
+        if not tags:
+            return 0
+        return _run_script(self.redis, INVALIDATE_SCRIPT, self._make_tag_keys(tags), [TAG_VERSION_TTL])
+
+    def should_recompute_early(self, expires_at: float, delta: float) -> bool:
+        """Should this process recompute a value before it expires.
+
+        The probability grows as the expiration time comes closer, faster for values which are slow to compute.
+        """
+        if not delta or not self.beta:
+            return False
+        # 1 - random() is never zero
+        return time.time() - delta * self.beta * math.log(1 - random.random()) >= expires_at
+
+    def _lock(self, key: str) -> t.Optional[str]:
+        token = os.urandom(8).hex()
+        if self.redis.set(self.make_key(key) + ":lock", token, nx=True, px=max(1, int(self.lock_timeout * 1000))):
+            return token
+        return None
+
+    def _unlock(self, key: str, token: str):
+        _run_script(self.redis, UNLOCK_SCRIPT, [self.make_key(key) + ":lock"], [token])
+
+    def _wait(self, key: str):
+        """Wait for another process to compute a value."""
+        deadline = time.monotonic() + self.lock_timeout
+        sleep = 0.01
+        while time.monotonic() < deadline:
+            time.sleep(sleep)
+            value, expires_at, delta = self._load(key)
+            if value is not MISSING:
+                return value
+            sleep = min(sleep * 2, 0.2)
+        return MISSING
+
+    def get_or_set(self, key: str, func: t.Callable[[], object], ttl: float, tags: t.Union[str, t.Iterable[str]] = ()):
+        """Get a cached value or compute and store it.
+
+        If the value is missing, only one process computes it and others wait for the result up to ``lock_timeout`` seconds. A value about to expire is recomputed early by one process while others keep getting the old value.
+
+        If a tag of the value is invalidated during the computation, the computed value is returned but not stored.
+
+        :param func: Compute the value
+        :param ttl: Seconds to keep the value
+        :param tags: Tag or tags to invalidate the value with
+        """
+        value, expires_at, delta = self._load(key)
+        if value is not MISSING and not self.should_recompute_early(expires_at, delta):
+            return value
+
+        token = self._lock(key)
+        if token is None:
+            if value is not MISSING:
+                # Another process is already refreshing the value
+                return value
+
+            value = self._wait(key)
+            if value is not MISSING:
+                return value
+
+            logger.warning("Timed out waiting for cache key %s, computing it", key)
+
+        try:
+            tags = _as_tags(tags)
+            versions = self.get_tag_versions(tags)
+            started = time.time()
+            value = func()
+            if not self.set(key, value, ttl, tags, delta=time.time() - started, versions=versions):
+                logger.debug("Cache key %s was invalidated while being computed, not storing it", key)
+        finally:
+            if token:
+                self._unlock(key, token)
+
+        return value
+
+
+def get_cache(request_or_registry: t.Union[Request, Registry], namespace: str = DEFAULT_NAMESPACE, serializer: t.Optional[t.Union[str, Serializer]] = None) -> Cache:
+    """Get a cache using the default Redis connection.
+
+    :param namespace: Prefix of keys
+    :param serializer: Serializer name or instance. Default from ``websauna.cache_serializer`` setting, or ``pickle``.
+    """
+    redis = get_redis(request_or_registry)
+    registry = request_or_registry if isinstance(request_or_registry, Registry) else request_or_registry.registry
+    if serializer is None:
+        serializer = (registry.settings or {}).get("websauna.cache_serializer", "pickle")
+    return Cache(redis, namespace=namespace, serializer=serializer)
+
+
+def make_args_key(func: t.Callable, args: tuple, kwargs: dict) -> str:
+    """Default cache key of a function call: the function name and a digest of the arguments."""
+    digest = hashlib.sha1(repr((args, sorted(kwargs.items()))).encode("utf-8")).hexdigest()
+    return "{}.{}:{}".format(func.__module__, func.__qualname__, digest)
+
+
+def cached(ttl: float, key: t.Optional[t.Union[str, t.Callable]] = None, namespace: str = DEFAULT_NAMESPACE, tags: t.Union[str, t.Iterable[str], t.Callable] = (), serializer: t.Optional[t.Union[str, Serializer]] = None):
+    """Cache the return value of a function.
+
+    The first argument of the function must be a request or a registry. Other arguments are used to build the cache key.
+
+    The decorated function has ``invalidate(request, *args, **kwargs)`` attribute which deletes the cached value for the arguments.
+
+    Example:
+
+    .. code-block:: python
+
+        @cached(ttl=60, key="user_stats:{0}", tags=lambda request, user_id: ["user:{}".format(user_id)])
+        def get_user_stats(request, user_id):
+            # ...
+
+    :param ttl: Seconds to keep the value
+    :param key: Cache key. A format string filled with the arguments after the request, or a function taking the same arguments as the decorated function. Default is built from the function name and the arguments.
+    :param namespace: Prefix of keys
+    :param tags: Tag or tags of the cached values, or a function taking the same arguments as the decorated function and returning them
+    :param serializer: Serializer name or instance
+    """
+    def outer(func: t.Callable):
+
+        def get_key(args: tuple, kwargs: dict) -> str:
+            if key is None:
+                return make_args_key(func, args[1:], kwargs)
+            if callable(key):
+                return key(*args, **kwargs)
+            return key.format(*args[1:], **kwargs)
+
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            cache = get_cache(args[0], namespace, serializer)
+            value_tags = tags(*args, **kwargs) if callable(tags) else tags
+            return cache.get_or_set(get_key(args, kwargs), lambda: func(*args, **kwargs), ttl, value_tags)
+
+        def invalidate(*args, **kwargs) -> bool:
+            return get_cache(args[0], namespace, serializer).delete(get_key(args, kwargs))
+
+        inner.invalidate = invalidate
+        return inner
+
+    return outer
@@ -1,4 +1,5 @@
 # Standard Library
+import datetime
 import typing as t
 
 # Pyramid
@@ -75,3 +76,37 @@ class IContainer(ILocation):
 
         :return: Iterable (URL id, child object). Child objects can be any Python objects with `__parent__` pointer set as described by a generic interface :py:class:`pyramid.interfaces.ILocation`.
         """
+
+
+class IBatchContainer(IContainer):
+    """Container which can enumerate its children in pages.
+
+    Walking through a large database backed container with ``items()`` and ``__getitem__`` may cause a query per child. Batch containers instead load a page of children with one query. Sitemap building uses :py:meth:`iterate_batches` instead of ``items()`` when it is available.
+
+    Example implementation using keyset pagination on the primary key:
+
+    .. code-block:: python
+
+        @implementer(IBatchContainer)
+        class AssetFolder(Resource):
+
+            def iterate_batches(self, batch_size):
+                dbsession = self.request.dbsession
+                last_id = None
+                while True:
+                    query = dbsession.query(Asset).filter_by(state=AssetState.public)
+                    if last_id is not None:
+                        query = query.filter(Asset.id > last_id)
+                    assets = query.order_by(Asset.id).limit(batch_size).all()
+                    if not assets:
+                        return
+                    yield [(asset.slug, self.get_description(asset), asset.updated_at) for asset in assets]
+                    last_id = assets[-1].id
+    """
+
+    def iterate_batches(batch_size: int) -> t.Iterable[t.List[t.Tuple[str, ILocation, t.Optional[datetime.datetime]]]]:
+        """Return children in this container in pages.
+
+        :param batch_size: Maximum number of children in one page
+        :return: Iterable of lists of (URL id, child object, last modification time) tuples. Child objects must have lineage set like in ``items()``. Last modification time is ``None`` if not known.
+        """
@@ -2,25 +2,32 @@
 # Standard Library
 import functools
 import logging
-import os
 import pickle as cPickle
+import re
 import typing as t
 from urllib.parse import urlparse
 
 # Pyramid
+from pyramid.decorator import reify
+from pyramid.interfaces import IRoutesMapper
 from pyramid.request import Request
 from pyramid.session import signed_serialize
+from pyramid.settings import asbool
+from pyramid.settings import aslist
+from pyramid.viewderivers import INGRESS
 
 from pyramid_redis_sessions import RedisSession
 from pyramid_redis_sessions import _delete_cookie
 from pyramid_redis_sessions import _generate_session_id
 from pyramid_redis_sessions import _get_session_id_from_cookie
 from pyramid_redis_sessions import get_default_connection
+from pyramid_redis_sessions.session import _SessionState
 from pyramid_redis_sessions.util import _parse_settings
 from pyramid_redis_sessions.util import get_unique_session_id
-from pyramid_redis_sessions.util import persist
 
 # Websauna
+from websauna.system.auth import sessionindex
+from websauna.system.core import sessionserializer
 from websauna.utils.time import now
 
 
@@ -30,6 +37,70 @@ logger = logging.getLogger(__name__)
 #: Todo temporary fix until we manage address this properly in pyramid_redis_sessions
 NO_SESSION_FILE_EXTENSIONS = [".js", ".css", ".ico", ".png", ".gif", ".jpg"]
 
+#: Paths which always get a session, even if they match sessionless rules. Requests to /notebook are proxied to another daemon.
+SESSION_PATH_PREFIXES = ["/notebook/"]
+
+
+class SessionlessMatcher:
+    """Decide if a request should not get a session.
+
+    Requests are matched against path prefixes, file extensions of static assets and route names. The rules are compiled to regular expressions once when the application starts. Sessionless requests get an empty dict as ``request.session`` and never access Redis.
+
+    Routes are matched by ``request.matched_route``. If the session is accessed before the router has run, e.g. in a tween, the route is looked up from the route mapper.
+    """
+
+    def __init__(self, path_prefixes: t.Iterable[str] = (), extensions: t.Iterable[str] = NO_SESSION_FILE_EXTENSIONS, route_names: t.Iterable[str] = (), exempt_prefixes: t.Iterable[str] = SESSION_PATH_PREFIXES):
+        """
+        :param path_prefixes: URL paths starting with any of these do not get a session
+        :param extensions: URL paths ending with any of these file extensions, in any case, do not get a session
+        :param route_names: Requests matching these routes do not get a session
+        :param exempt_prefixes: URL paths starting with any of these always get a session
+        """
+        self.path_prefixes = tuple(path_prefixes)
+        self.extensions = tuple(extensions)
+        self.exempt_prefixes = tuple(exempt_prefixes)
+        self.route_names = set(route_names)
+        self.compile()
+
+    def compile(self):
+        """Compile path rules to regular expressions."""
+        self.prefix_match = self.path_prefixes and re.compile("|".join(re.escape(p) for p in self.path_prefixes)).match
+        self.extension_search = self.extensions and re.compile("(?:{})$".format("|".join(re.escape(e) for e in self.extensions)), re.IGNORECASE).search
+
+    def add_route(self, route_name: str):
+        """Do not give a session to requests matching a route."""
+        self.route_names.add(route_name)
+
+    def match_path(self, path: str) -> bool:
+        """Should a request to a path be sessionless, regardless of its route."""
+        if path.startswith(self.exempt_prefixes):
+            return False
+
+        if self.prefix_match and self.prefix_match(path):
+            return True
+
+        return bool(self.extension_search and self.extension_search(path))
+
+    def __call__(self, request: Request) -> bool:
+        """Should the request be sessionless."""
+        if self.match_path(request.path):
+            return True
+
+        if not self.route_names:
+            return False
+
+        route = request.matched_route
+        if route is None:
+            # Session accessed before routing, or no route matched
+            mapper = request.registry.queryUtility(IRoutesMapper)
+            route = mapper(request)["route"] if mapper else None
+
+        return route is not None and route.name in self.route_names
+
+
+#: Matcher with the default rules
+default_sessionless_matcher = SessionlessMatcher()
+
 
 def ignore_session(url: str) -> bool:
     """Should we ignore session for this request?
@@ -38,10 +109,75 @@ def ignore_session(url: str) -> bool:
     :param url: Request url.
     :return: Flag indicating if session should be ignored.
     """
-    path = urlparse(url).path
-    to_notebook = path.startswith('/notebook/')
-    ext = str(os.path.splitext(path)[1]).lower()
-    return True if (ext in NO_SESSION_FILE_EXTENSIONS and not to_notebook) else False
+    return default_sessionless_matcher.match_path(urlparse(url).path)
+
+
+def create_sessionless_matcher(settings: dict) -> SessionlessMatcher:
+    """Create a matcher from ``websauna.sessionless_paths`` and ``websauna.sessionless_routes`` settings."""
+    return SessionlessMatcher(
+        path_prefixes=aslist(settings.get("websauna.sessionless_paths", "")),
+        route_names=aslist(settings.get("websauna.sessionless_routes", "")),
+    )
+
+
+def sessionless_view(view, info):
+    """View deriver for ``session=False`` view option.
+
+    The route of the view is added to the sessionless routes when the application starts. Views without a route, e.g. traversal views, replace the session with an empty dict before the view is called, unless the session has already been created during the request.
+
+    Example:
+
+    .. code-block:: python
+
+        @view_config(route_name="health", session=False)
+        def health(request):
+            return Response("OK")
+    """
+    if info.options.get("session", True) is not False:
+        return view
+
+    route_name = info.options.get("route_name")
+    if route_name:
+        info.registry.sessionless_matcher.add_route(route_name)
+        return view
+
+    def wrapper(context, request):
+        if "session" not in request.__dict__:
+            request.session = {}
+        return view(context, request)
+
+    return wrapper
+
+
+sessionless_view.options = ("session",)
+
+
+def persist(wrapped):
+    """Decorator to save the session after a modifying method.
+
+    Unlike the ``pyramid_redis_sessions`` decorator, the write can be buffered until the end of the request, see :py:meth:`WebsaunaSession.save`.
+    """
+    @functools.wraps(wrapped)
+    def wrapped_persist(session, *arg, **kw):
+        result = wrapped(session, *arg, **kw)
+        session.save()
+        return result
+
+    return wrapped_persist
+
+
+def refresh(wrapped):
+    """Decorator to reset the session expiration time after a reading method.
+
+    The expiration can be buffered until the end of the request, see :py:meth:`WebsaunaSession.touch`.
+    """
+    @functools.wraps(wrapped)
+    def wrapped_refresh(session, *arg, **kw):
+        result = wrapped(session, *arg, **kw)
+        session.touch()
+        return result
+
+    return wrapped_refresh
 
 
 class WebsaunaSession(RedisSession):
@@ -49,6 +185,10 @@ class WebsaunaSession(RedisSession):
 
     We can pass `initial_data` that pre-populates session data keys when the session is written for the first time. Usually this is when CSRF token is generated.
 
+    The session is loaded lazily. Redis is not accessed before the session is read or written for the first time, so views not using the session do not pay for it. If the session id from the cookie does not exist in Redis, a new session is created on the first access.
+
+    With ``coalesce_writes`` the session is not written to Redis on every modification. Changes are buffered and written with one ``SET`` and ``EXPIRE`` when :py:meth:`flush` is called at the end of the request.
+
     .. note::Move this to upstream pyramid_redis_session - its development has stalled for now.
     """
 
@@ -61,10 +201,146 @@ class WebsaunaSession(RedisSession):
         new_session,
         serialize=cPickle.dumps,
         deserialize=cPickle.loads,
+        coalesce_writes=False,
     ):
-        super().__init__(redis, session_id, new, new_session, serialize, deserialize)
+        """
+        :param session_id: Session id to load, usually from the session cookie, or ``None`` to create a new session
+        :param new: Is the session with ``session_id`` just created
+        :param coalesce_writes: Buffer writes and expiration time updates until :py:meth:`flush`
+        """
+        # Do not call RedisSession.__init__(), as it loads the session immediately
+        self.redis = redis
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self._new_session = new_session
         self.initial_data = initial_data
 
+        self._pending_session_id = session_id
+        self._pending_new = new
+
+        #: Session id from the session cookie or ``None`` if the request had no valid cookie
+        self.cookie_session_id = session_id
+
+        #: Was the session loaded with the session id given to the constructor
+        self.cookie_was_valid = False
+
+        self._was_invalidated = False
+
+        self.coalesce_writes = coalesce_writes
+
+        #: Session data has changed since the last write
+        self.dirty = False
+
+        #: Session has been read since the last expiration time update
+        self.touched = False
+
+    @reify
+    def _session_state(self):
+        session_id = self._pending_session_id
+        self._pending_session_id = None
+        self._was_invalidated = False
+
+        if session_id:
+            # Single GET instead of EXISTS followed by GET
+            persisted = self.redis.get(session_id)
+            if persisted is not None:
+                self.cookie_was_valid = not self._pending_new
+                return self._state_from_persisted(session_id, self.deserialize(persisted), self._pending_new)
+
+        return self._make_session_state(session_id=self._new_session(), new=True)
+
+    def _state_from_persisted(self, session_id: str, persisted: dict, new: bool) -> _SessionState:
+        return _SessionState(
+            session_id=session_id,
+            managed_dict=persisted['managed_dict'],
+            created=persisted['created'],
+            timeout=persisted['timeout'],
+            new=new,
+        )
+
+    @property
+    def loaded(self) -> bool:
+        """Has the session been loaded from Redis during this request."""
+        return '_session_state' in self.__dict__
+
+    @property
+    def _invalidated(self):
+        return self._was_invalidated and not self.loaded
+
+    def invalidate(self):
+        super().invalidate()
+        self._was_invalidated = True
+        self.dirty = self.touched = False
+
+    def get_index_key(self) -> t.Optional[str]:
+        """Get the key of the per-user session index this session belongs to, see :py:mod:`websauna.system.auth.sessionindex`.
+
+        :return: Redis key or ``None`` if no user is logged in
+        """
+        token = self.managed_dict.get(sessionindex.USERID_KEY)
+        if token is None:
+            return None
+        return sessionindex.get_index_key(token)
+
+    def expire(self, pipe=None):
+        """Reset the expiration time of the session and its per-user session index.
+
+        The index lives as long as the last session written or touched, so it does not expire before the sessions it points to.
+
+        :param pipe: Pipeline to add the commands to. If not given, the commands are sent immediately.
+        """
+        index_key = self.get_index_key()
+
+        if pipe is not None:
+            pipe.expire(self.session_id, self.timeout)
+            if index_key:
+                pipe.expire(index_key, self.timeout)
+        elif index_key:
+            with self.redis.pipeline() as pipe:
+                self.expire(pipe)
+                pipe.execute()
+        else:
+            self.redis.expire(self.session_id, self.timeout)
+
+    def write(self):
+        """Write the session to Redis and reset its expiration time."""
+        with self.redis.pipeline() as pipe:
+            pipe.set(self.session_id, self.to_redis())
+            self.expire(pipe)
+            pipe.execute()
+        self.dirty = self.touched = False
+
+    def save(self):
+        """Persist changes, now or at :py:meth:`flush`."""
+        if self.coalesce_writes:
+            self.dirty = True
+        else:
+            self.write()
+
+    def touch(self):
+        """Reset the expiration time, now or at :py:meth:`flush`."""
+        if self.coalesce_writes:
+            self.touched = True
+        else:
+            self.expire()
+
+    def flush(self):
+        """Write buffered changes and expiration time update to Redis."""
+        if not self.loaded:
+            return
+
+        if self.dirty:
+            self.write()
+        elif self.touched:
+            self.expire()
+            self.touched = False
+
+    # dict modifying methods decorated with @persist
+
+    @persist
+    def __delitem__(self, key):
+        del self.managed_dict[key]
+
     @persist
     def __setitem__(self, key, value):
         # Check if do not have any values in the session and then initialize its data
@@ -72,6 +348,81 @@ class WebsaunaSession(RedisSession):
             self.managed_dict.update(self.initial_data)
         self.managed_dict[key] = value
 
+    @persist
+    def setdefault(self, key, default=None):
+        return self.managed_dict.setdefault(key, default)
+
+    @persist
+    def clear(self):
+        return self.managed_dict.clear()
+
+    @persist
+    def pop(self, key, default=None):
+        return self.managed_dict.pop(key, default)
+
+    @persist
+    def update(self, other):
+        return self.managed_dict.update(other)
+
+    @persist
+    def popitem(self):
+        return self.managed_dict.popitem()
+
+    @persist
+    def changed(self):
+        """Persist the session after a mutable value in it has been modified."""
+
+    @persist
+    def adjust_timeout_for_session(self, timeout_seconds):
+        """Permanently adjust the timeout for this session."""
+        self._session_state.timeout = timeout_seconds
+
+    # dict read-only methods decorated with @refresh
+
+    @refresh
+    def __getitem__(self, key):
+        return self.managed_dict[key]
+
+    @refresh
+    def __contains__(self, key):
+        return key in self.managed_dict
+
+    @refresh
+    def keys(self):
+        return self.managed_dict.keys()
+
+    @refresh
+    def items(self):
+        return self.managed_dict.items()
+
+    @refresh
+    def get(self, key, default=None):
+        return self.managed_dict.get(key, default)
+
+    @refresh
+    def __iter__(self):
+        return self.managed_dict.__iter__()
+
+    @refresh
+    def has_key(self, key):
+        return key in self.managed_dict
+
+    @refresh
+    def values(self):
+        return self.managed_dict.values()
+
+    @refresh
+    def itervalues(self):
+        return self.managed_dict.values()
+
+    @refresh
+    def iteritems(self):
+        return self.managed_dict.items()
+
+    @refresh
+    def iterkeys(self):
+        return self.managed_dict.keys()
+
     def get_csrf_token(self):
         token = self.get('_csrft_', None)
         if token is None:
@@ -112,7 +463,6 @@ def _cookie_callback(
     session,
     request,
     response,
-    session_cookie_was_valid,
     cookie_on_exception,
     set_cookie,
     delete_cookie,
@@ -130,11 +480,17 @@ def _cookie_callback(
         if header in response.headers:
             return
 
+    session_cookie_was_valid = session.cookie_was_valid
+
     if session._invalidated:
         if session_cookie_was_valid:
             delete_cookie(response=response)
         return
 
+    if not session.loaded:
+        # The session was not touched, leave the cookie as is
+        return
+
     # Do not session cookie if we have not written anything to session yet
     # has_content = len(session.keys()) > 0
     # if session.new and has_content:
@@ -187,6 +543,7 @@ def WebsaunaSessionFactory(
     id_generator=_generate_session_id,
     cookieless_headers=('expires', 'cache-control'),
     klass=WebsaunaSession,
+    coalesce_writes=False,
 ):
     """
     Overrides the RedisSessionFactory with Websauna specifi functionality.
@@ -278,6 +635,10 @@ def WebsaunaSessionFactory(
     is safe. Otherwise if we set a cookie on these responses it could
     result to user session leakage.
 
+    ``coalesce_writes``
+    Buffer session changes and write them to Redis once at the end of the
+    request instead of on every modification. Default: ``False``.
+
     The following arguments are also passed straight to the ``StrictRedis``
     constructor and allow you to further configure the Redis client::
 
@@ -320,23 +681,22 @@ def WebsaunaSessionFactory(
             generator=id_generator,
         )
 
-        if session_id_from_cookie and redis.exists(session_id_from_cookie):
-            session_id = session_id_from_cookie
-            session_cookie_was_valid = True
-        else:
-            session_id = new_session()
-            session_cookie_was_valid = False
-
+        # The session is loaded, or created if the cookie is missing or expired, on the first access
         session = klass(
             initial_data,
             redis=redis,
-            session_id=session_id,
-            new=not session_cookie_was_valid,
+            session_id=session_id_from_cookie,
+            new=False,
             new_session=new_session,
             serialize=serialize,
             deserialize=deserialize,
+            coalesce_writes=coalesce_writes,
         )
 
+        if coalesce_writes:
+            # Registered before the cookie callback, so that the write happens first
+            request.add_response_callback(lambda request, response: session.flush())
+
         set_cookie = functools.partial(
             _set_cookie,
             session,
@@ -357,7 +717,6 @@ def WebsaunaSessionFactory(
         cookie_callback = functools.partial(
             _cookie_callback,
             session,
-            session_cookie_was_valid=session_cookie_was_valid,
             cookie_on_exception=cookie_on_exception,
             set_cookie=set_cookie,
             delete_cookie=delete_cookie,
@@ -383,32 +742,40 @@ def set_creation_time_aware_session_factory(config):
         if key in settings:
             settings[key] = config.maybe_dotted(settings[key])
 
+    # Compact serializer needs its own deserializer, which also reads legacy pickled sessions
+    if settings.get("redis.sessions.serialize") is sessionserializer.serialize:
+        settings.setdefault("redis.sessions.deserialize", sessionserializer.deserialize)
+
     options = _parse_settings(settings)
+    if "coalesce_writes" in options:
+        options["coalesce_writes"] = asbool(options["coalesce_writes"])
     session_factory = WebsaunaSessionFactory(**options)
 
+    sessionless_matcher = config.registry.sessionless_matcher = create_sessionless_matcher(settings)
+    config.add_view_deriver(sessionless_view, under=INGRESS, over="secured_view")
+
     def create_session(request: Request) -> t.Union[WebsaunaSession, t.Dict]:
         """Given a request, return a WebsaunaSession or an empty dict.
 
         :param request: A client request.
         :return: An instance of WebsaunaSession or an empty dict
         """
+        # Make sure we do not get accidental race conditions when populating sessions when browser asynchronously fetches more resources
+        if sessionless_matcher(request):
+            logger.debug("Skipped session creation for %s", request.path)
+            return {}
+
         # Pass in the the data we use to track session on the server side.
-        # Esp. created_at is used to later manually purge old sessions
+        # Esp. created_at is used to later manually purge old sessions, see websauna.system.core.sessionpurge
         initial_data = {
             "client_addr": request.client_addr,
             "created_at": now(),
         }
 
-        # Make sure we do not get accidental race conditions when populating sessions when browser asynchronously fetches more resources
-        url = request.url
-        if ignore_session(url):
-            logger.debug("Skipped session creation for {url}".format(url=url))
-            return {}
-
         session = session_factory(request, initial_data)
 
         # Allow session backend to use this information to debug session problems
-        session.url = url
+        session.url = request.url
         return session
 
     config.set_session_factory(create_session)
@@ -0,0 +1,205 @@
+"""Purge old Redis sessions.
+
+Sessions live in Redis until their idle timeout expires. With a long ``redis.sessions.timeout`` the session keyspace grows without bounds as every visitor gets a session which is kept alive by any returning request. :py:func:`purge_sessions` walks through the session keyspace and deletes sessions
+
+* created longer than ``websauna.session_max_age`` seconds ago, based on the ``created_at`` marker set by :py:func:`websauna.system.core.session.set_creation_time_aware_session_factory`
+
+* logged in as a user who can no longer log in, e.g. a disabled user
+
+The keyspace is walked with ``SCAN``, so Redis is not blocked, and the sessions of each batch are read and deleted with one pipeline each. Deleted sessions are also removed from the per-user session index, see :py:mod:`websauna.system.auth.sessionindex`.
+
+Run with :ref:`ws-purge-sessions` command or schedule :py:func:`websauna.system.core.tasks.purge_sessions` Celery task.
+"""
+# Standard Library
+import datetime
+import logging
+import pickle
+import time
+import typing as t
+
+# Pyramid
+from pyramid.settings import asbool
+
+from redis import StrictRedis
+
+# Websauna
+from websauna.system.auth import sessionindex
+from websauna.system.core.redis import get_redis
+from websauna.system.http import Request
+from websauna.system.user.utils import get_user_registry
+from websauna.utils.time import now
+
+
+logger = logging.getLogger(__name__)
+
+
+#: How many keys are requested from Redis with one SCAN call and read with one pipeline
+DEFAULT_BATCH_SIZE = 500
+
+
+class PurgeStats:
+    """Statistics of a session purge run."""
+
+    def __init__(self):
+        #: Keys returned by SCAN
+        self.scanned = 0
+
+        #: Keys which were sessions
+        self.sessions = 0
+
+        #: Sessions deleted for being older than the maximum age
+        self.expired = 0
+
+        #: Sessions deleted for belonging to a user who can no longer log in
+        self.disabled = 0
+
+        #: Number of SCAN batches
+        self.batches = 0
+
+        #: Seconds spent
+        self.duration = 0.0
+
+    @property
+    def deleted(self) -> int:
+        return self.expired + self.disabled
+
+    @property
+    def rate(self) -> float:
+        """Scanned keys per second."""
+        if not self.duration:
+            return 0.0
+        return self.scanned / self.duration
+
+    def __str__(self):
+        return "Scanned {} keys, {} sessions in {} batches in {:.2f} s ({:.0f} keys/s). Deleted {} sessions: {} too old, {} of disabled users.".format(
+            self.scanned, self.sessions, self.batches, self.duration, self.rate, self.deleted, self.expired, self.disabled)
+
+
+def get_session_key_pattern(settings: dict) -> str:
+    """Get SCAN pattern matching session keys.
+
+    Without ``redis.sessions.prefix`` all keys in the session database are scanned and keys which are not sessions are skipped.
+    """
+    return settings.get("redis.sessions.prefix", "") + "*"
+
+
+def get_session_deserializer(settings: dict) -> t.Callable[[bytes], dict]:
+    """Get the function sessions were serialized with.
+
+    Dotted names have been resolved by :py:func:`websauna.system.core.session.set_creation_time_aware_session_factory` when the application was configured.
+    """
+    deserialize = settings.get("redis.sessions.deserialize", pickle.loads)
+    assert callable(deserialize), "Session factory not configured"
+    return deserialize
+
+
+def get_session_created_at(session_data: dict) -> datetime.datetime:
+    """Get the creation time of a stored session."""
+    created_at = session_data["managed_dict"].get("created_at")
+    if isinstance(created_at, datetime.datetime):
+        return created_at
+
+    # Session was never written after its creation, fall back to the time pyramid_redis_sessions recorded
+    return datetime.datetime.fromtimestamp(session_data["created"], datetime.timezone.utc)
+
+
+def load_session(deserialize: t.Callable[[bytes], dict], value) -> t.Optional[dict]:
+    """Deserialize a stored session, or return ``None`` if the value is not a session."""
+    if not isinstance(value, bytes):
+        # Pipeline result of a key which is not a string, or was deleted after SCAN returned it
+        return None
+
+    try:
+        data = deserialize(value)
+    except Exception:
+        return None
+
+    if not isinstance(data, dict) or not isinstance(data.get("managed_dict"), dict) or "created" not in data:
+        return None
+
+    return data
+
+
+def purge_sessions(request: Request, max_age: t.Optional[int] = None, purge_disabled: t.Optional[bool] = None, batch_size: int = DEFAULT_BATCH_SIZE, redis: t.Optional[StrictRedis] = None) -> PurgeStats:
+    """Delete old sessions and sessions of disabled users.
+
+    :param request: Request used to access settings and user database
+    :param max_age: Delete sessions created more than this many seconds ago. Default from ``websauna.session_max_age`` setting. ``None`` or ``0`` does not purge by age.
+    :param purge_disabled: Delete sessions of users who cannot log in. Default from ``websauna.session_purge_disabled`` setting, which defaults to true.
+    :param batch_size: How many keys to SCAN and read at once
+    :param redis: Redis connection of the session database. Default is :py:func:`websauna.system.core.redis.get_redis`.
+    :return: Purge statistics
+    """
+    settings = request.registry.settings
+
+    if max_age is None:
+        max_age = int(settings.get("websauna.session_max_age", 0))
+
+    if purge_disabled is None:
+        purge_disabled = asbool(settings.get("websauna.session_purge_disabled", True))
+
+    redis = redis or get_redis(request)
+    deserialize = get_session_deserializer(settings)
+    user_registry = get_user_registry(request)
+    cutoff = now() - datetime.timedelta(seconds=max_age) if max_age else None
+
+    #: Session token -> can the user log in
+    user_cache = {}
+
+    def is_disabled(token) -> bool:
+        if token not in user_cache:
+            user = user_registry.get_user_by_session_token(token)
+            user_cache[token] = user is None or not user_registry.can_login(user)
+        return user_cache[token]
+
+    stats = PurgeStats()
+    started = time.time()
+    cursor = 0
+
+    while True:
+        cursor, keys = redis.scan(cursor, match=get_session_key_pattern(settings), count=batch_size)
+        stats.batches += 1
+        stats.scanned += len(keys)
+
+        if keys:
+            with redis.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.get(key)
+                values = pipe.execute(raise_on_error=False)
+
+            #: Deleted session id -> session token of the logged in user or None
+            doomed = {}
+            for key, value in zip(keys, values):
+                data = load_session(deserialize, value)
+                if data is None:
+                    continue
+
+                stats.sessions += 1
+
+                token = data["managed_dict"].get(sessionindex.USERID_KEY)
+
+                if cutoff and get_session_created_at(data) < cutoff:
+                    stats.expired += 1
+                    doomed[key] = token
+                    continue
+
+                if purge_disabled and token is not None and is_disabled(token):
+                    stats.disabled += 1
+                    doomed[key] = token
+
+            if doomed:
+                # Remove the deleted sessions from the per-user session index too
+                with redis.pipeline(transaction=False) as pipe:
+                    pipe.delete(*doomed)
+                    for key, token in doomed.items():
+                        if token is not None:
+                            pipe.srem(sessionindex.get_index_key(token), key)
+                    pipe.execute()
+
+        # SCAN returns cursor 0 when the full iteration is complete
+        if int(cursor) == 0:
+            break
+
+    stats.duration = time.time() - started
+    logger.info("Session purge: %s", stats)
+    return stats
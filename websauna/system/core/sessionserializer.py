@@ -0,0 +1,170 @@
+"""Compact session serialization.
+
+Session data is serialized with pickle by default. Pickle output is large for objects like :py:class:`websauna.system.core.messages.FlashMessage` and datetimes, it is slow to load and loading untrusted pickles is a security risk. This module serializes sessions as compact JSON with typed extensions for non-JSON types.
+
+Enable in INI settings:
+
+.. code-block:: ini
+
+    redis.sessions.serialize = websauna.system.core.sessionserializer.serialize
+    redis.sessions.deserialize = websauna.system.core.sessionserializer.deserialize
+
+:py:func:`deserialize` still reads sessions pickled before the switch. They are rewritten in the compact format next time the session is saved.
+
+Supported types are JSON types, tuples, sets, ``bytes``, ``datetime``, ``date``, ``time``, ``timedelta``, ``Decimal``, ``UUID`` and :py:class:`websauna.system.core.messages.FlashMessage`. Add more with :py:func:`register_type`.
+"""
+# Standard Library
+import base64
+import datetime
+import decimal
+import json
+import logging
+import pickle
+import typing as t
+import uuid
+
+# Websauna
+from websauna.system.core.messages import FlashMessage
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Prefix telling serialized data from legacy pickles
+MAGIC = b"WS1"
+
+#: Prefix of the only key of a typed value in the JSON output, e.g. ``{"~d": 737060}``
+TYPE_PREFIX = "~"
+
+#: Naive datetime epoch for datetime serialization
+EPOCH = datetime.datetime(1970, 1, 1)
+
+#: Resolution of datetime serialization
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+#: Type -> (tag, encoder)
+_encoders = {}
+
+#: Tag -> decoder
+_decoders = {}
+
+
+def register_type(cls: type, tag: str, encode: t.Callable[[object], object], decode: t.Callable[[object], object]):
+    """Teach the serializer a new type.
+
+    :param cls: Python class. Subclasses are not matched.
+    :param tag: Short unique id of the type in serialized data
+    :param encode: Convert an instance to a serializable value
+    :param decode: Convert the serialized value back to an instance
+    """
+    assert tag not in _decoders, "Tag {} already registered".format(tag)
+    _encoders[cls] = (tag, encode)
+    _decoders[tag] = decode
+
+
+def _encode_datetime(value: datetime.datetime) -> list:
+    offset = value.utcoffset()
+    micros = (value.replace(tzinfo=None) - EPOCH) // MICROSECOND
+    if offset is None:
+        return [micros]
+    return [micros, offset // datetime.timedelta(seconds=1)]
+
+
+def _decode_datetime(value: list) -> datetime.datetime:
+    dt = EPOCH + value[0] * MICROSECOND
+    if len(value) == 1:
+        return dt
+    offset = value[1]
+    return dt.replace(tzinfo=datetime.timezone.utc if offset == 0 else datetime.timezone(datetime.timedelta(seconds=offset)))
+
+
+def _encode_flash_message(value: FlashMessage) -> list:
+    return [value.kind, value.plain, value.rich, value.msg_id, _encode(value.extra)]
+
+
+def _decode_flash_message(value: list) -> FlashMessage:
+    msg = FlashMessage.__new__(FlashMessage)
+    msg.kind, msg.plain, msg.rich, msg.msg_id, extra = value
+    msg.extra = _decode(extra)
+    return msg
+
+
+register_type(tuple, "t", lambda v: [_encode(i) for i in v], lambda v: tuple(_decode(i) for i in v))
+register_type(set, "s", lambda v: [_encode(i) for i in v], lambda v: set(_decode(i) for i in v))
+register_type(frozenset, "fs", lambda v: [_encode(i) for i in v], lambda v: frozenset(_decode(i) for i in v))
+register_type(bytes, "b", lambda v: base64.b64encode(v).decode("ascii"), lambda v: base64.b64decode(v))
+register_type(datetime.datetime, "dt", _encode_datetime, _decode_datetime)
+register_type(datetime.date, "d", lambda v: v.toordinal(), datetime.date.fromordinal)
+register_type(datetime.time, "tm", lambda v: [v.hour, v.minute, v.second, v.microsecond], lambda v: datetime.time(*v))
+register_type(datetime.timedelta, "td", lambda v: [v.days, v.seconds, v.microseconds], lambda v: datetime.timedelta(*v))
+register_type(decimal.Decimal, "dec", str, decimal.Decimal)
+register_type(uuid.UUID, "u", lambda v: v.hex, uuid.UUID)
+register_type(FlashMessage, "f", _encode_flash_message, _decode_flash_message)
+
+
+def _encode(value):
+    """Convert a value to JSON serializable structure."""
+    if value is None or isinstance(value, (str, bool, float)):
+        return value
+
+    cls = type(value)
+
+    if cls is int:
+        return value
+
+    if cls is list:
+        return [_encode(i) for i in value]
+
+    if cls is dict:
+        if all(type(k) is str and not k.startswith(TYPE_PREFIX) for k in value):
+            return {k: _encode(v) for k, v in value.items()}
+        # Keys which are not strings or could be mistaken for a type tag
+        return {TYPE_PREFIX + "m": [[_encode(k), _encode(v)] for k, v in value.items()]}
+
+    encoder = _encoders.get(cls)
+    if encoder is None:
+        raise TypeError("Cannot serialize {} to session, see websauna.system.core.sessionserializer.register_type()".format(cls))
+
+    tag, encode = encoder
+    return {TYPE_PREFIX + tag: encode(value)}
+
+
+def _decode(value):
+    """Convert a decoded JSON structure back to Python objects."""
+    if type(value) is list:
+        return [_decode(i) for i in value]
+
+    if type(value) is dict:
+        if len(value) == 1:
+            key, item = next(iter(value.items()))
+            if key.startswith(TYPE_PREFIX):
+                tag = key[len(TYPE_PREFIX):]
+                if tag == "m":
+                    return {_decode(k): _decode(v) for k, v in item}
+                return _decoders[tag](item)
+
+        return {k: _decode(v) for k, v in value.items()}
+
+    return value
+
+
+def serialize(data: dict) -> bytes:
+    """Serialize session data to compact JSON."""
+    return MAGIC + json.dumps(_encode(data), separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def is_legacy(data: bytes) -> bool:
+    """Check if data was serialized with pickle."""
+    return not data.startswith(MAGIC)
+
+
+def deserialize(data: bytes) -> dict:
+    """Deserialize session data.
+
+    Sessions written by the default pickle serializer are loaded with pickle.
+    """
+    if is_legacy(data):
+        logger.debug("Loading legacy pickled session of %d bytes", len(data))
+        return pickle.loads(data)
+
+    return _decode(json.loads(data[len(MAGIC):].decode("utf-8")))
@@ -2,21 +2,27 @@
 # Standard Library
 import abc
 import typing as t
+from collections import defaultdict
+from xml.sax.saxutils import escape
 
 # Pyramid
-from pyramid.config import Configurator
 from pyramid.interfaces import IAuthorizationPolicy
 from pyramid.interfaces import IRouteRequest
+from pyramid.interfaces import IRoutesMapper
 from pyramid.interfaces import ITraverser
 from pyramid.registry import Introspectable
+from pyramid.registry import Registry
+from pyramid.response import Response
 from pyramid.router import Router
 from pyramid.scripts.proutes import _get_pattern
 from pyramid.security import Everyone
 from pyramid.static import static_view
 from pyramid.traversal import ResourceTreeTraverser
 from pyramid.urldispatch import Route
+from transaction import TransactionManager
 
 # Websauna
+from websauna.system.core.interfaces import IBatchContainer
 from websauna.system.core.interfaces import IContainer
 from websauna.system.core.traversal import Resource
 from websauna.system.http import Request
@@ -116,6 +122,190 @@ class Sitemap:
         request.response.content_type = "application/xml"
         return dict(urlset=self.urls())
 
+    def stream(self, context, request) -> Response:
+        """View streaming the sitemap XML without a template.
+
+        Example:
+
+        .. code-block:: python
+
+            config.add_view(map.stream, route_name="sitemap")
+
+        .. note ::
+
+            Items are resolved while the response body is being sent, after the request transaction has been committed. Generators needing the database should use their own session.
+        """
+        return Response(content_type="application/xml", charset="utf-8", app_iter=iterate_sitemap_xml(self.urls(), request))
+
+
+#: Number of sitemap entries serialized to one ``app_iter`` chunk
+STREAM_BATCH_SIZE = 500
+
+#: Sitemap protocol XML namespace
+SITEMAP_NAMESPACE = "http://www.sitemaps.org/schemas/sitemap/0.9"
+
+
+def format_lastmod(value) -> str:
+    """Format lastmod as W3C datetime if it is a date or datetime, otherwise as is."""
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def serialize_url(item: SitemapItem, request: Request) -> str:
+    """Serialize one ``<url>`` element."""
+    parts = ["<url><loc>", escape(item.location(request)), "</loc>"]
+
+    lastmod = item.lastmod(request)
+    if lastmod:
+        parts += ["<lastmod>", escape(format_lastmod(lastmod)), "</lastmod>"]
+
+    changefreq = item.changefreq(request)
+    if changefreq:
+        parts += ["<changefreq>", escape(str(changefreq)), "</changefreq>"]
+
+    priority = item.priority(request)
+    if priority is not None:
+        parts += ["<priority>", escape(str(priority)), "</priority>"]
+
+    parts.append("</url>\n")
+    return "".join(parts)
+
+
+def iterate_sitemap_xml(items: t.Iterable[SitemapItem], request: Request, batch_size: int = STREAM_BATCH_SIZE) -> t.Iterable[bytes]:
+    """Serialize sitemap items to UTF-8 encoded XML.
+
+    Items are consumed lazily and the output is yielded in chunks of ``batch_size`` entries, so memory use does not grow with the sitemap size.
+
+    :param items: Sitemap items, e.g. :py:meth:`Sitemap.urls`
+    :param request: Request used to resolve URLs
+    :param batch_size: Number of entries per yielded chunk
+    """
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{}">\n'.format(SITEMAP_NAMESPACE).encode("utf-8")
+
+    batch = []
+    for item in items:
+        batch.append(serialize_url(item, request))
+        if len(batch) >= batch_size:
+            yield "".join(batch).encode("utf-8")
+            batch = []
+
+    if batch:
+        yield "".join(batch).encode("utf-8")
+
+    yield b"</urlset>\n"
+
+
+def iterate_sitemap_index_xml(sitemaps: t.Iterable[t.Tuple[str, str]]) -> t.Iterable[bytes]:
+    """Serialize a sitemap index to UTF-8 encoded XML.
+
+    :param sitemaps: (location, lastmod) tuples of sitemap files
+    """
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="{}">\n'.format(SITEMAP_NAMESPACE).encode("utf-8")
+    for location, lastmod in sitemaps:
+        yield "<sitemap><loc>{}</loc><lastmod>{}</lastmod></sitemap>\n".format(escape(location), escape(format_lastmod(lastmod))).encode("utf-8")
+    yield b"</sitemapindex>\n"
+
+
+class RouteViewEntry:
+    """Introspected view of a route in :py:class:`SitemapIndex`."""
+
+    __slots__ = ("route_name", "pattern", "view_data", "public_get", "sitemap_data")
+
+    def __init__(self, route_name: str, pattern: str, view_data: Introspectable):
+        self.route_name = route_name
+        self.pattern = pattern
+        self.view_data = view_data
+
+        #: Can be accessed with anonymous HTTP GET
+        self.public_get = is_get_requestable(view_data) and is_anonymous(view_data)
+
+        #: Data set by :py:func:`include_in_sitemap` or ``None``
+        self.sitemap_data = get_sitemap_data(view_data)
+
+
+class SitemapIndex:
+    """Route and view configuration needed for sitemap building.
+
+    Route and view configuration does not change after the application has been configured. Instead of scanning Pyramid introspector on every sitemap build, the data is collected once and stored in the registry. Use :py:func:`get_sitemap_index` to get it.
+    """
+
+    def __init__(self, registry: Registry):
+        mapper = registry.queryUtility(IRoutesMapper)
+
+        #: All non-static routes
+        self.routes = mapper.get_routes(include_static=False) if mapper else []
+
+        #: :py:class:`RouteViewEntry` for each view of each route
+        self.route_views = []
+        for route in self.routes:
+            for name, pattern, view_data in _get_route_data(route, registry):
+                self.route_views.append(RouteViewEntry(name, pattern, view_data))
+
+        #: Route name -> list of (context class, view name, view introspectable) for traversal views
+        self.traverse_views = defaultdict(list)
+        for v in registry.introspector.get_category("views"):
+            spectable = v["introspectable"]  # pyramid.registry.Introspectable
+
+            # See discrim_func() in add_view()
+            cat, intr_context_cls, name, route_name, phash = spectable.discriminator
+
+            if not intr_context_cls:
+                continue
+
+            self.traverse_views[route_name].append((intr_context_cls, name, spectable))
+
+        #: Router used to resolve traversal roots
+        self.router = Router(registry)
+
+
+def get_sitemap_index(registry: Registry) -> SitemapIndex:
+    """Get the cached sitemap index for the application.
+
+    The index is built on the first call after the application configuration is complete.
+    """
+    index = getattr(registry, "sitemap_index", None)
+    if index is None:
+        index = registry.sitemap_index = SitemapIndex(registry)
+    return index
+
+
+def is_get_requestable(view_data: dict) -> bool:
+    """Check if a view accepts HTTP GET.
+
+    :param view_data: Introspected view data
+    """
+    if not view_data.get("request_methods"):
+        return True
+
+    return "GET" in view_data["request_methods"]
+
+
+def is_anonymous(view_data: dict) -> bool:
+    """Check if a view can be accessed without a permission.
+
+    :param view_data: Introspected view data
+    """
+
+    # TODO: This does not handle the case where
+    # multiple derivates are stacked
+    derived = view_data.get("derived_callable")
+    if derived:
+        if getattr(derived, "__permission__", None):
+            return False
+
+    return True
+
+
+def get_sitemap_data(view_data: dict) -> t.Optional[dict]:
+    """Get the data set by :py:func:`include_in_sitemap` decorator for a view."""
+    callable = view_data.get("callable")
+    if callable is None:
+        return None
+
+    # TODO: Not sure if we need to peek through callable decorator stack
+    return getattr(callable, "_sitemap_data", None)
+
 
 class ReflectiveSitemapBuilder:
     """Scan all registered routes and traversable resources and build sitemap from them automatically.
@@ -130,16 +320,27 @@ class ReflectiveSitemapBuilder:
 
     This method might not yet work for more advanced view configuration use cases. Check :py:mod:`websauna.tests.sitemapsamples` for covered use cases.
 
+    Containers implementing :py:class:`websauna.system.core.interfaces.IBatchContainer` are enumerated in pages of ``batch_size`` children. ACL decisions and available views are computed once per resource class and parent, not for every child.
+
     See :ref:`Sitemap <sitemap>` for examples.
     """
 
+    #: Number of children loaded at once from batch containers
+    batch_size = 1000
+
     def __init__(self, request: Request):
         self.request = request
         self.sitemap = Sitemap()
+        self.index = get_sitemap_index(request.registry)
 
-    def get_mapper(self):
-        config = Configurator(registry=self.request.registry)
-        return config.get_routes_mapper()
+        #: (id of parent, resource class) -> (parent, public view decision)
+        self.acl_cache = {}
+
+        #: (route name, resource class) -> available views
+        self.view_cache = {}
+
+    def get_mapper(self) -> IRoutesMapper:
+        return self.request.registry.getUtility(IRoutesMapper)
 
     def is_parameter_free_route(self, route_spec: str):
         # no {param}, no traverse/*
@@ -156,22 +357,10 @@ class ReflectiveSitemapBuilder:
         return "*" in route.pattern
 
     def is_get_requestable(self, view_data: dict):
-
-        if not view_data.get("request_methods"):
-            return True
-
-        return "GET" in view_data["request_methods"]
+        return is_get_requestable(view_data)
 
     def is_anonymous(self, view_data: dict):
-
-        # TODO: This does not handle the case where
-        # multiple derivates are stacked
-        derived = view_data.get("derived_callable")
-        if derived:
-            if getattr(derived, "__permission__", None):
-                return False
-
-        return True
+        return is_anonymous(view_data)
 
     def is_static(self, view_data: dict):
         return isinstance(view_data.get("callable"), static_view)
@@ -193,13 +382,15 @@ class ReflectiveSitemapBuilder:
     def is_included(self, view_data: dict, context: t.Optional[Resource], request: Request):
         """Check if sitemap conditions allow to include this item."""
 
-        callable = view_data.get("callable")
-        if callable is None:
-            # This is route like admin_home without callable, only traversing nesting
-            return True
+        return self.is_included_by_sitemap_data(get_sitemap_data(view_data), context, request)
+
+    def is_included_by_sitemap_data(self, sitemap_data: t.Optional[dict], context: t.Optional[Resource], request: Request):
+        """Check if sitemap conditions set by :py:func:`include_in_sitemap` allow to include this item.
 
-        # TODO: Not sure if we need to peek through callable decorator stack
-        sitemap_data = getattr(callable, "_sitemap_data", None)
+        :param sitemap_data: Data set by :py:func:`include_in_sitemap` or ``None``
+        """
+
+        # None for routes like admin_home without callable, only traversing nesting
         if sitemap_data is None:
             return True
 
@@ -228,16 +419,61 @@ class ReflectiveSitemapBuilder:
 
         return True
 
+    def is_good_route_entry(self, entry: RouteViewEntry):
+        """Check conditions if routed view can be added in the sitemap, using the data precomputed in :py:class:`SitemapIndex`."""
+
+        if not self.is_parameter_free_route(entry.pattern):
+            return False
+
+        if not entry.public_get:
+            return False
+
+        if not self.is_included_by_sitemap_data(entry.sitemap_data, None, self.request):
+            return False
+
+        return True
+
+    def get_acl_cache_key(self, context: Resource) -> t.Optional[tuple]:
+        """Get the key for sharing the ACL decision of a resource with its siblings.
+
+        Siblings of the same class get the same decision if their ACL is a plain class attribute or inherited from the parents.
+
+        :return: Cache key or ``None`` if the ACL may depend on the instance
+        """
+        parent = getattr(context, "__parent__", None)
+        if parent is None:
+            return None
+
+        if "__acl__" in getattr(context, "__dict__", {}):
+            return None
+
+        cls = type(context)
+        acl = getattr(cls, "__acl__", None)
+        if callable(acl) or isinstance(acl, property):
+            return None
+
+        return (id(parent), cls)
+
     def has_public_view_acl(self, context: Resource):
         """Check if ACL for the resource is publicly viewable.
 
         View permission must be either missing or pyramid.security.Everyone.
         """
+        key = self.get_acl_cache_key(context)
+        if key is not None and key in self.acl_cache:
+            return self.acl_cache[key][1]
+
         policy = self.request.registry.queryUtility(IAuthorizationPolicy)
 
         # view permission is set on Root object or overridden in resource hierarchy __ACL__
         principals = policy.principals_allowed_by_permission(context, "view")
-        return Everyone in principals
+        public = Everyone in principals
+
+        if key is not None:
+            # Keep the parent alive so that its id is not reused
+            self.acl_cache[key] = (context.__parent__, public)
+
+        return public
 
     def add_route_item(self, name, pattern, view_data):
         """Add one route item to the table.
@@ -246,52 +482,45 @@ class ReflectiveSitemapBuilder:
         """
         self.sitemap.add_item(RouteItem(name))
 
-    def add_traverse_item(self, context: Resource, view_name: str):
+    def add_traverse_item(self, context: Resource, view_name: str, lastmod=None):
         """Add one traverse item to the table.
 
         Override for custom sitemap parameters (changefreq, etc.).
+
+        :param lastmod: Last modification time given by a batch container
         """
-        self.sitemap.add_item(TraverseItem(context, view_name))
+        self.sitemap.add_item(TraverseItem(context, view_name, lastmod=lastmod))
+
+    def walk_routes(self) -> t.Iterable[None]:
+        """Add all routes without parameters and permissions, yielding after each added item."""
+        for entry in self.index.route_views:
+            if self.is_good_route_entry(entry):
+                self.add_route_item(entry.route_name, entry.pattern, entry.view_data)
+                yield
 
     def build_routes(self):
         """Build all routes without parameters and permissions."""
-        mapper = self.get_mapper()
-        routes = mapper.get_routes(include_static=False)
-
-        for route in routes:
-            data = _get_route_data(route, self.request.registry)
-            for name, pattern, view_data in data:
-
-                if self.is_good_route_item(name, pattern, view_data):
-                    self.add_route_item(name, pattern, view_data)
+        for _ in self.walk_routes():
+            pass
 
     def enumerate_available_views(self, route: Route, context: Resource) -> t.Iterable[Introspectable]:
         """Get list of available views for a given resource."""
-        introspector = self.request.registry.introspector
-        views = introspector.get_category("views")
+
+        key = (route.name, type(context))
+        if key in self.view_cache:
+            return self.view_cache[key]
 
         # We can have multiple views with the same name for the same resource because of inheritance.
         available_views = {}
 
-        for v in views:
-            spectable = v["introspectable"]  # pyramid.registry.Introspectable
-
-            # See discrim_func() in add_view()
-            cat, intr_context_cls, name, route_name, phash = spectable.discriminator
-
-            if not intr_context_cls:
-                continue
-
-            if route_name != route.name:
-                # On a different route
-                continue
-
+        for intr_context_cls, name, spectable in self.index.traverse_views.get(route.name, ()):
             if isinstance(context, intr_context_cls):
                 # TODO: Assumes that the later defined views have more accurate context scope.
                 # Not sure if this holds true all the time.
-                available_views[name] = v["introspectable"]
+                available_views[name] = spectable
 
-        return available_views.values()
+        views = self.view_cache[key] = list(available_views.values())
+        return views
 
     def get_traverse_endpoint_context(self, router: Router, route: Route) -> Resource:
         """Get root object for a traversable route.
@@ -322,10 +551,22 @@ class ReflectiveSitemapBuilder:
         context = tdict["context"]
         return context
 
-    def recurse_traversable(self, router: Router, route: Route, context: Resource):
+    def iterate_children(self, context: Resource) -> t.Iterable[t.Tuple[str, Resource, t.Any]]:
+        """Enumerate children of a container.
+
+        :return: Iterable of (name, child, lastmod) tuples
+        """
+        if IBatchContainer.providedBy(context):
+            for batch in context.iterate_batches(self.batch_size):
+                yield from batch
+        else:
+            for name, child in context.items():
+                yield name, child, None
+
+    def walk_traversable(self, router: Router, route: Route, context: Resource, lastmod=None) -> t.Iterable[None]:
         """Walk through traversable hierarchy.
 
-        For each context iterate available views and add to sitemap.
+        For each context iterate available views and add to sitemap, yielding after each added item.
         """
 
         if not self.has_public_view_acl(context):
@@ -335,36 +576,81 @@ class ReflectiveSitemapBuilder:
         # Add all views for this leaf
         for view_data in self.enumerate_available_views(route, context):
             if self.is_public_get_view(view_data) and self.is_included(view_data, context, self.request):
-                self.add_traverse_item(context, view_data["name"])
+                self.add_traverse_item(context, view_data["name"], lastmod)
+                yield
 
         # Recurse to children
         if IContainer.providedBy(context):
-            for name, child in context.items():
-                self.recurse_traversable(router, route, child)
+            for name, child, child_lastmod in self.iterate_children(context):
+                yield from self.walk_traversable(router, route, child, child_lastmod)
 
-    def build_traverse_trees(self):
-        """Build all traversed hierarchies."""
-        mapper = self.get_mapper()
-        router = Router(self.request.registry)
+    def recurse_traversable(self, router: Router, route: Route, context: Resource, lastmod=None):
+        """Walk through traversable hierarchy.
+
+        For each context iterate available views and add to sitemap.
+        """
+        for _ in self.walk_traversable(router, route, context, lastmod):
+            pass
 
-        routes = mapper.get_routes(include_static=False)
+    def walk_traverse_trees(self) -> t.Iterable[None]:
+        """Walk all traversed hierarchies, yielding after each added item."""
+        router = self.index.router
 
-        for route in routes:
+        for route in self.index.routes:
             if not self.is_traversable_sitemap_route(route):
                 continue
 
             root_context = self.get_traverse_endpoint_context(router, route)
-            self.recurse_traversable(router, route, root_context)
+            yield from self.walk_traversable(router, route, root_context)
+
+    def build_traverse_trees(self):
+        """Build all traversed hierarchies."""
+        for _ in self.walk_traverse_trees():
+            pass
+
+    def walk(self) -> t.Iterable[None]:
+        """Iterate through all public routes and traversable items and add them to the sitemap, yielding after each added item."""
+        yield from self.walk_routes()
+        yield from self.walk_traverse_trees()
 
     def build(self):
         """Iterate through all public routes and traversable items and add them to the sitemap."""
-        self.build_routes()
-        self.build_traverse_trees()
+        for _ in self.walk():
+            pass
+
+    def iterate_items(self) -> t.Iterable[SitemapItem]:
+        """Build the sitemap lazily.
+
+        Items are yielded as soon as they are added and are not kept in the sitemap, so memory use does not grow with the number of traversed resources.
+        """
+        for _ in self.walk():
+            items, self.sitemap.items = self.sitemap.items, []
+            yield from items
 
     def get_sitemap(self) -> Sitemap:
         """Get ready sitemap after build."""
         return self.sitemap
 
+    @classmethod
+    def create_sitemap(cls, request: Request) -> Sitemap:
+        """Build a sitemap for the site.
+
+        All items are held in memory. For large sites use :py:meth:`create_lazy_sitemap`.
+        """
+        reflective_builder = cls(request)
+        reflective_builder.build()
+        return reflective_builder.get_sitemap()
+
+    @classmethod
+    def create_lazy_sitemap(cls, request: Request) -> Sitemap:
+        """Create a sitemap which walks the site only when its URLs are iterated.
+
+        Items are not kept in memory, see :py:meth:`iterate_items`. Each :py:meth:`Sitemap.urls` call walks the site again. Use as a sitemap factory for :py:func:`websauna.system.core.sitemapstore.add_stored_sitemap`.
+        """
+        sitemap = Sitemap()
+        sitemap.add_generator(lambda: cls(request).iterate_items())
+        return sitemap
+
     @classmethod
     def render(cls, context, request):
         """Render the sitemap.
@@ -378,6 +664,32 @@ class ReflectiveSitemapBuilder:
         map = reflective_builder.get_sitemap()
         return map.render(context, request)
 
+    @classmethod
+    def stream(cls, context, request) -> Response:
+        """View streaming the sitemap XML while the site is walked, see :py:meth:`Sitemap.stream`.
+
+        The walk runs while the response body is being sent, after the request transaction has been committed. It is run in a new transaction of ``request.tm``, which is aborted when the walk is complete.
+        """
+        reflective_builder = cls(request)
+        items = _iterate_in_transaction(getattr(request, "tm", None), reflective_builder.iterate_items())
+        return Response(content_type="application/xml", charset="utf-8", app_iter=iterate_sitemap_xml(items, request))
+
+
+def _iterate_in_transaction(tm: t.Optional[TransactionManager], items: t.Iterable) -> t.Iterable:
+    """Consume an iterable inside a read-only transaction.
+
+    :param tm: Transaction manager or ``None`` to consume the iterable as is
+    """
+    if tm is None:
+        yield from items
+        return
+
+    tm.begin()
+    try:
+        yield from items
+    finally:
+        tm.abort()
+
 
 def _get_route_data(route, registry):
     """Iterate all non static views for a route.
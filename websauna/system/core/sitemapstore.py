@@ -0,0 +1,217 @@
+"""Pre-generated sitemaps.
+
+Building a sitemap walks through routes, traversal trees and database content. Instead of doing this on every ``/sitemap.xml`` request, the sitemap is generated by ``ws-generate-sitemap`` command or :py:func:`websauna.system.core.tasks.generate_sitemap` Celery task. The result is written to disk as a `sitemap index <https://www.sitemaps.org/protocol.html#index>`_ and gzip compressed sitemap files of at most 50,000 URLs each. Web processes only serve these files.
+
+Example:
+
+.. code-block:: python
+
+    class Initializer(websauna.system.Initializer):
+
+        def configure_sitemap(self):
+            from websauna.system.core.sitemap import ReflectiveSitemapBuilder
+            from websauna.system.core.sitemapstore import add_stored_sitemap
+            add_stored_sitemap(self.config, ReflectiveSitemapBuilder.create_lazy_sitemap)
+
+The files are written to the folder given in ``websauna.sitemap_dir`` setting. If you run several web servers, the folder must be shared between them.
+"""
+# Standard Library
+import gzip
+import itertools
+import logging
+import os
+import tempfile
+import typing as t
+
+# Pyramid
+from pyramid.config import Configurator
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.registry import Registry
+from pyramid.response import FileResponse
+
+# Websauna
+from websauna.system.http import Request
+from websauna.utils.time import now
+
+from .sitemap import Sitemap
+from .sitemap import SitemapItem
+from .sitemap import include_in_sitemap
+from .sitemap import iterate_sitemap_index_xml
+from .sitemap import iterate_sitemap_xml
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Maximum number of URLs in one sitemap file as set by the sitemap protocol
+MAX_URLS = 50000
+
+#: File name of the sitemap index
+INDEX_FILE = "sitemap.xml"
+
+#: File name pattern of the sitemap chunks, numbered from one
+CHUNK_FILE = "sitemap-{}.xml.gz"
+
+#: How long crawlers and proxies may cache the sitemap files, in seconds
+CACHE_MAX_AGE = 3600
+
+
+def get_sitemap_dir(registry: Registry) -> str:
+    """Get the folder where sitemap files are stored, creating it if needed."""
+    path = registry.settings.get("websauna.sitemap_dir")
+    if not path:
+        path = os.path.join(tempfile.gettempdir(), "websauna-sitemap")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def iterate_chunks(items: t.Iterable, size: int) -> t.Iterable[t.Iterator]:
+    """Split an iterable to consecutive iterators of at most ``size`` items without reading it in memory.
+
+    Each chunk must be consumed before advancing to the next one.
+    """
+    items = iter(items)
+    for first in items:
+        yield itertools.chain([first], itertools.islice(items, size - 1))
+
+
+class SitemapGenerator:
+    """Write a sitemap index and gzipped sitemap chunk files to disk.
+
+    Files are first written under temporary names and then moved in place, so that web processes never serve a partially written sitemap. Items are streamed from the sitemap to the files. With a lazy sitemap, e.g. from :py:meth:`websauna.system.core.sitemap.ReflectiveSitemapBuilder.create_lazy_sitemap`, only a batch of entries is held in memory at a time.
+    """
+
+    def __init__(self, request: Request, sitemap: Sitemap, chunk_size: int = MAX_URLS):
+        """
+        :param request: Request used to resolve URLs. Outside HTTP requests, ``websauna.site_url`` setting gives the site address.
+        :param sitemap: Sitemap to write
+        :param chunk_size: Maximum number of URLs in a chunk file
+        """
+        assert chunk_size <= MAX_URLS
+        self.request = request
+        self.sitemap = sitemap
+        self.chunk_size = chunk_size
+        self.folder = get_sitemap_dir(request.registry)
+
+    def write_chunk(self, number: int, items: t.Iterable[SitemapItem]) -> t.Tuple[str, int]:
+        """Write one gzipped sitemap file.
+
+        :return: Tuple (temporary file name, number of written URLs)
+        """
+        count = 0
+
+        def counted():
+            nonlocal count
+            for item in items:
+                count += 1
+                yield item
+
+        path = os.path.join(self.folder, "." + CHUNK_FILE.format(number))
+        with gzip.open(path, "wb") as f:
+            for data in iterate_sitemap_xml(counted(), self.request):
+                f.write(data)
+        return path, count
+
+    def write_index(self, count: int) -> str:
+        """Write the sitemap index pointing to all chunk files.
+
+        :return: Temporary file name
+        """
+        lastmod = now().isoformat()
+        chunks = ((self.request.route_url("sitemap_chunk", chunk=number), lastmod) for number in range(1, count + 1))
+        path = os.path.join(self.folder, "." + INDEX_FILE)
+        with open(path, "wb") as f:
+            for data in iterate_sitemap_index_xml(chunks):
+                f.write(data)
+        return path
+
+    def remove_stale_chunks(self, count: int):
+        """Remove chunk files left from a previous, larger, sitemap."""
+        number = count + 1
+        while True:
+            path = os.path.join(self.folder, CHUNK_FILE.format(number))
+            if not os.path.exists(path):
+                break
+            os.remove(path)
+            number += 1
+
+    def generate(self) -> int:
+        """Generate all sitemap files.
+
+        :return: Number of URLs in the sitemap
+        """
+        written = []
+        total = 0
+        for number, items in enumerate(iterate_chunks(self.sitemap.urls(), self.chunk_size), start=1):
+            path, count = self.write_chunk(number, items)
+            written.append(path)
+            total += count
+
+        index = self.write_index(len(written))
+
+        # Chunks first, so that the new index never points to missing files
+        for path in written:
+            os.replace(path, os.path.join(self.folder, os.path.basename(path)[1:]))
+        os.replace(index, os.path.join(self.folder, INDEX_FILE))
+
+        self.remove_stale_chunks(len(written))
+        logger.info("Generated sitemap with %d URLs in %d files to %s", total, len(written), self.folder)
+        return total
+
+
+def generate_sitemap(request: Request) -> int:
+    """Build the configured sitemap and write it to disk.
+
+    :return: Number of URLs in the sitemap
+    """
+    factory = getattr(request.registry, "sitemap_factory", None)
+    if not factory:
+        raise RuntimeError("Stored sitemap is not configured, see websauna.system.core.sitemapstore.add_stored_sitemap()")
+    sitemap = factory(request)
+    return SitemapGenerator(request, sitemap).generate()
+
+
+def serve_sitemap_file(request: Request, filename: str, content_type: str) -> FileResponse:
+    """Serve a stored sitemap file with caching headers.
+
+    ``If-Modified-Since`` and ``If-None-Match`` conditional requests get ``304 Not Modified``.
+    """
+    path = os.path.join(get_sitemap_dir(request.registry), filename)
+    if not os.path.exists(path):
+        logger.warning("Sitemap file %s missing, run ws-generate-sitemap", path)
+        raise HTTPNotFound()
+
+    response = FileResponse(path, request=request, content_type=content_type, cache_max_age=CACHE_MAX_AGE)
+    stat = os.stat(path)
+    response.etag = "{:x}-{:x}".format(int(stat.st_mtime * 1000), stat.st_size)
+    response.conditional_response = True
+    return response
+
+
+@include_in_sitemap(False)
+def serve_sitemap_index(request: Request) -> FileResponse:
+    """View serving the sitemap index."""
+    return serve_sitemap_file(request, INDEX_FILE, "application/xml")
+
+
+def serve_sitemap_chunk(request: Request) -> FileResponse:
+    """View serving a gzipped sitemap chunk."""
+    chunk = request.matchdict["chunk"]
+    if not chunk.isdigit():
+        raise HTTPNotFound()
+    return serve_sitemap_file(request, CHUNK_FILE.format(int(chunk)), "application/gzip")
+
+
+def add_stored_sitemap(config: Configurator, sitemap_factory: t.Callable[[Request], Sitemap], path: str = "/sitemap.xml"):
+    """Serve a pre-generated sitemap.
+
+    :param config: Configurator
+    :param sitemap_factory: Callable creating the :py:class:`websauna.system.core.sitemap.Sitemap` to generate, e.g. :py:meth:`websauna.system.core.sitemap.ReflectiveSitemapBuilder.create_lazy_sitemap`. The sitemap should yield its items from generators, so that they are not all held in memory.
+    :param path: URL of the sitemap index. The chunks are served next to it.
+    """
+    assert path.endswith(".xml")
+    config.registry.sitemap_factory = sitemap_factory
+    config.add_route("sitemap", path)
+    config.add_route("sitemap_chunk", path[:-len(".xml")] + "-{chunk}.xml.gz")
+    config.add_view(serve_sitemap_index, route_name="sitemap")
+    config.add_view(serve_sitemap_chunk, route_name="sitemap_chunk")
@@ -0,0 +1,29 @@
+"""Background tasks for core functionality."""
+# Standard Library
+import logging
+
+# Websauna
+from websauna.system.task.tasks import ScheduleOnCommitTask
+from websauna.system.task.tasks import task
+
+from .sessionpurge import purge_sessions as _purge_sessions
+from .sitemapstore import generate_sitemap as _generate_sitemap
+
+
+logger = logging.getLogger(__name__)
+
+
+@task(name="generate_sitemap", base=ScheduleOnCommitTask, bind=True)
+def generate_sitemap(self: ScheduleOnCommitTask):
+    """Regenerate the stored sitemap files. Add to Celery beat schedule to keep the sitemap up to date."""
+    request = self.get_request()
+    count = _generate_sitemap(request)
+    logger.info("Sitemap regenerated with %d URLs", count)
+
+
+@task(name="purge_sessions", base=ScheduleOnCommitTask, bind=True)
+def purge_sessions(self: ScheduleOnCommitTask):
+    """Delete old sessions and sessions of disabled users. Add to Celery beat schedule to keep Redis memory usage bounded."""
+    request = self.get_request()
+    stats = _purge_sessions(request)
+    logger.info("Sessions purged: %s", stats)
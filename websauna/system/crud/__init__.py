@@ -2,9 +2,12 @@
 # Standard Library
 import typing as t
 from abc import abstractmethod
+from inspect import isclass
 
 # Pyramid
 from pyramid.interfaces import IRequest
+from pyramid.registry import Registry
+from zope.interface.interfaces import IInterface
 
 # Websauna
 from websauna.system.core.traversal import Resource as _Resource
@@ -13,6 +16,41 @@ from websauna.system.http import Request
 from .urlmapper import Base64UUIDMapper
 
 
+def get_reserved_view_names(registry: Registry, crud_class: type) -> t.FrozenSet[str]:
+    """Get view names registered for a CRUD class.
+
+    Traversal tries to resolve a path segment as an object before looking up a view with the same name. If the mapper cannot tell object ids and view names apart, e.g. ``listing`` decodes as a valid base64 UUID slug, the lookup would hit the database on every view request. CRUD skips the object lookup for these names.
+
+    Only views whose context is ``crud_class``, one of its base classes or an interface implemented by it are included, so that an object slug is not shadowed by a view of an unrelated CRUD. View registrations are collected from Pyramid view introspection on the first call and the names are cached per CRUD class in ``registry.crud_reserved_view_names``.
+
+    :param registry: Pyramid registry
+    :param crud_class: CRUD class being traversed
+    """
+    cache = getattr(registry, "crud_reserved_view_names", None)
+    if cache is None:
+        cache = registry.crud_reserved_view_names = {}
+
+    names = cache.get(crud_class)
+    if names is not None:
+        return names
+
+    names = set()
+    introspector = getattr(registry, "introspector", None)
+    if introspector:
+        for view in introspector.get_category("views"):
+            # See discrim_func() in add_view()
+            cat, context, name, route_name, phash = view["introspectable"].discriminator
+            if not name:
+                continue
+            if isclass(context) and issubclass(crud_class, context):
+                names.add(name)
+            elif IInterface.providedBy(context) and context.implementedBy(crud_class):
+                names.add(name)
+
+    cache[crud_class] = frozenset(names)
+    return cache[crud_class]
+
+
 class Resource(_Resource):
     """One object in CRUD traversing.
 
@@ -162,6 +200,10 @@ class CRUD(_Resource):
         :param path: Part of URL which is resolved to an object via ``mapper``.
         :return: :py:class:`websauna.core.traverse.Resource`
         """
+        if path in get_reserved_view_names(self.request.registry, self.__class__):
+            # A view of this CRUD, do not look up the database
+            raise KeyError
+
         if not self.mapper.is_id(path):
             # Signal that this id is not part of the CRUD database and may be a view
             raise KeyError
@@ -0,0 +1,281 @@
+"""Set-based bulk actions for CRUD listings.
+
+Bulk actions operate on the rows selected with checkboxes on a listing page, or on all rows matching the listing query. Instead of loading and deleting objects one by one, they compile to ``DELETE ... WHERE id IN (...)`` and ``UPDATE ... WHERE id IN (...)`` statements executed in chunks.
+
+Example:
+
+.. code-block:: python
+
+    from websauna.system.crud import bulk
+
+    @view_overrides(context=MyModelAdmin)
+    class MyModelListing(admin_views.Listing):
+
+        bulk_actions = [
+            bulk.BulkDelete(),
+            bulk.BulkUpdate(id="disable", name="Disable selected", values={"enabled": False}),
+        ]
+
+.. note ::
+
+    Bulk statements bypass the ORM unit of work. Python-side cascades, ``before_delete`` and other mapper events are not run. Database level ``ON DELETE`` rules still apply.
+"""
+# Standard Library
+import logging
+import typing as t
+
+# Pyramid
+from pyramid.path import DottedNameResolver
+
+# SQLAlchemy
+from sqlalchemy import inspect
+from sqlalchemy.orm import Query
+from sqlalchemy.orm import Session
+
+# Websauna
+from websauna.system.http import Request
+from websauna.utils.qualname import get_qual_name
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_primary_key(model: type):
+    """Get the primary key column attribute of a model.
+
+    :raise RuntimeError: If the model has a composite primary key
+    """
+    mapper = inspect(model)
+    if len(mapper.primary_key) != 1:
+        raise RuntimeError("Bulk actions support only models with a single column primary key, {} has {}".format(model, mapper.primary_key))
+    return getattr(model, mapper.get_property_by_column(mapper.primary_key[0]).key)
+
+
+def iterate_id_chunks(query: Query, chunk_size: int, ids: t.Optional[t.Iterable] = None) -> t.Iterable[list]:
+    """Resolve primary keys of rows the action applies to, in chunks.
+
+    :param query: Listing query. Only rows matching this query are affected.
+    :param chunk_size: Maximum number of ids in a chunk
+    :param ids: Selected primary keys. If ``None`` iterate all rows matching the query.
+    """
+    model = query.column_descriptions[0]["entity"]
+    pk = get_primary_key(model)
+    query = query.order_by(None).with_entities(pk)
+
+    if ids is not None:
+        ids = list(ids)
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            # Only ids visible in the listing can be touched
+            yield [row[0] for row in query.filter(pk.in_(chunk))]
+        return
+
+    # Walk over the primary key index instead of using OFFSET
+    last = None
+    while True:
+        chunk_query = query
+        if last is not None:
+            chunk_query = chunk_query.filter(pk > last)
+        chunk = [row[0] for row in chunk_query.order_by(pk).limit(chunk_size)]
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1]
+
+
+class BulkAction:
+    """An action performed on many listing rows with set-based SQL statements.
+
+    Subclasses implement :py:meth:`execute_chunk`.
+    """
+
+    #: HTML id and POST value of the action
+    id = None
+
+    #: Human readable label of the action button
+    name = None
+
+    #: Permission needed on the CRUD context to see and perform the action
+    permission = None
+
+    #: How many rows are updated by one statement
+    chunk_size = 1000
+
+    #: If more than this many rows are affected, the chunks are processed as Celery tasks after the request commits. ``None`` to always run in the request.
+    background_threshold = None
+
+    def __init__(self, id: t.Optional[str] = None, name: t.Optional[str] = None, permission: t.Optional[str] = None, chunk_size: t.Optional[int] = None, background_threshold: t.Optional[int] = None):
+        """
+        :param id: Override action id
+        :param name: Override button label
+        :param permission: Override required permission
+        :param chunk_size: Override the number of rows per statement
+        :param background_threshold: Run in Celery when more than this many rows are affected
+        """
+        if id:
+            self.id = id
+        if name:
+            self.name = name
+        if permission:
+            self.permission = permission
+        if chunk_size:
+            self.chunk_size = chunk_size
+        if background_threshold is not None:
+            self.background_threshold = background_threshold
+
+        assert self.id, "Bulk action id missing"
+        assert self.name, "Bulk action name missing"
+
+    def is_visible(self, context: object, request: Request) -> bool:
+        """Check if the current user can perform this action."""
+        if self.permission is None:
+            return True
+        return bool(request.has_permission(self.permission, context))
+
+    def execute_chunk(self, dbsession: Session, model: type, ids: list) -> int:
+        """Run the SQL statement for one chunk of primary keys.
+
+        :return: Number of affected rows
+        """
+        raise NotImplementedError()
+
+    def get_payload(self) -> dict:
+        """Serializable arguments to reconstruct this action in a Celery task with :py:meth:`from_payload`."""
+        return {"id": self.id, "name": self.name, "permission": self.permission, "chunk_size": self.chunk_size}
+
+    @classmethod
+    def from_payload(cls, payload: dict) -> "BulkAction":
+        """Reconstruct the action inside a Celery task."""
+        return cls(**payload)
+
+    def schedule(self, request: Request, model: type, chunks: t.Iterable[list]) -> int:
+        """Process chunks as Celery tasks after the current transaction commits.
+
+        :return: Number of scheduled rows
+        """
+        from .tasks import bulk_action  # Celery is an optional dependency
+
+        count = 0
+        for chunk in chunks:
+            bulk_action.apply_async(args=(get_qual_name(self.__class__), self.get_payload(), get_qual_name(model), chunk), tm=request.tm)
+            count += len(chunk)
+        return count
+
+    def schedule_query(self, request: Request, listing_ref: tuple):
+        """Process all rows matching a listing query as a Celery task after the current transaction commits.
+
+        The task rebuilds the listing query and resolves the ids in chunks itself, so the web request does not load them. The query is rebuilt as seen by the current user, whose permissions are checked again by the task.
+
+        :param listing_ref: Tuple (listing view class name, route name, traversal path, query string parameters) to rebuild the listing query, see :py:meth:`websauna.system.crud.views.Listing.get_listing_ref`
+        """
+        from .tasks import bulk_action_query  # Celery is an optional dependency
+
+        user = request.user
+        user_id = user.id if user else None
+        bulk_action_query.apply_async(args=(get_qual_name(self.__class__), self.get_payload(), user_id) + tuple(listing_ref), tm=request.tm)
+
+    def execute_query(self, query: Query) -> int:
+        """Run the action on all rows matching a query, resolving the ids chunk by chunk.
+
+        The primary key walk continues after the last id of the previous chunk, so rows changed or deleted by the statements do not disturb it.
+
+        :return: Number of affected rows
+        """
+        model = query.column_descriptions[0]["entity"]
+        count = 0
+        for chunk in iterate_id_chunks(query, self.chunk_size):
+            count += self.execute_chunk(query.session, model, chunk)
+        return count
+
+    def perform(self, request: Request, query: Query, ids: t.Optional[t.Iterable] = None, listing_ref: t.Optional[tuple] = None) -> t.Tuple[int, bool]:
+        """Perform the action.
+
+        :param request: Current HTTP request
+        :param query: Listing query, limiting the rows the action can touch
+        :param ids: Selected primary keys or ``None`` for all rows matching the query
+        :param listing_ref: Reference to the listing to rebuild ``query`` in a Celery task. Without it all rows matching the query are processed in the request.
+        :return: Tuple (affected or scheduled row count, scheduled to background)
+        """
+        model = query.column_descriptions[0]["entity"]
+
+        if ids is None:
+            if self.background_threshold is not None and listing_ref is not None:
+                total = query.order_by(None).count()
+                if total > self.background_threshold:
+                    logger.info("Scheduling bulk action %s for all %d matching rows of %s", self.id, total, model)
+                    self.schedule_query(request, listing_ref)
+                    return total, True
+
+            return self.execute_query(query), False
+
+        # Selected ids are few, resolve them first, so that the statements do not interfere with the visibility check
+        chunks = list(iterate_id_chunks(query, self.chunk_size, ids))
+
+        total = sum(len(c) for c in chunks)
+        if self.background_threshold is not None and total > self.background_threshold:
+            logger.info("Scheduling bulk action %s for %d rows of %s", self.id, total, model)
+            return self.schedule(request, model, chunks), True
+
+        count = 0
+        for chunk in chunks:
+            count += self.execute_chunk(query.session, model, chunk)
+        return count, False
+
+
+class BulkDelete(BulkAction):
+    """Delete selected rows with ``DELETE ... WHERE id IN (...)``."""
+
+    id = "delete"
+
+    name = "Delete selected"
+
+    permission = "delete"
+
+    def execute_chunk(self, dbsession: Session, model: type, ids: list) -> int:
+        pk = get_primary_key(model)
+        return dbsession.query(model).filter(pk.in_(ids)).delete(synchronize_session=False)
+
+
+class BulkUpdate(BulkAction):
+    """Set column values on selected rows with ``UPDATE ... WHERE id IN (...)``."""
+
+    permission = "edit"
+
+    def __init__(self, values: dict, **kwargs):
+        """
+        :param values: Attribute name -> new value mapping. Values must be JSON serializable if the action is run in background.
+        :param kwargs: :py:class:`BulkAction` arguments
+        """
+        self.values = values
+        super(BulkUpdate, self).__init__(**kwargs)
+
+    def execute_chunk(self, dbsession: Session, model: type, ids: list) -> int:
+        pk = get_primary_key(model)
+        return dbsession.query(model).filter(pk.in_(ids)).update(self.values, synchronize_session=False)
+
+    def get_payload(self) -> dict:
+        payload = super(BulkUpdate, self).get_payload()
+        payload["values"] = self.values
+        return payload
+
+
+def run_bulk_action(dbsession: Session, action_name: str, payload: dict, model_name: str, ids: list) -> int:
+    """Execute a chunk of a scheduled bulk action. Called by the Celery task.
+
+    :return: Number of affected rows
+    """
+    resolver = DottedNameResolver()
+    action_class = resolver.resolve(action_name)
+    model = resolver.resolve(model_name)
+    action = action_class.from_payload(payload)
+    return action.execute_chunk(dbsession, model, ids)
+
+
+def run_bulk_action_query(action_name: str, payload: dict, query: Query) -> int:
+    """Execute a scheduled bulk action on all rows matching a listing query. Called by the Celery task.
+
+    :return: Number of affected rows
+    """
+    action_class = DottedNameResolver().resolve(action_name)
+    action = action_class.from_payload(payload)
+    return action.execute_query(query)
@@ -0,0 +1,212 @@
+"""Total item count strategies for CRUD listings.
+
+Counting all rows matching a listing query with ``SELECT count(*)`` needs a full scan over the matching rows, which can dominate the page load time on large tables. The strategies here trade exactness of the total for speed. Set one as :py:attr:`websauna.system.crud.views.Listing.count_strategy`:
+
+.. code-block:: python
+
+    from websauna.system.crud import count
+
+    class UserListing(admin_views.Listing):
+
+        count_strategy = count.CachedCount(count.EstimatedCount(), ttl=300)
+
+Strategies which cannot give the exact count return :py:class:`InexactCount`, which the paginator and listing templates render as ``~1,234,000`` or ``10,000+``.
+"""
+# Standard Library
+import hashlib
+import json
+import logging
+import typing as t
+
+# Pyramid
+from pyramid.registry import Registry
+
+# SQLAlchemy
+from sqlalchemy import text
+from sqlalchemy.orm import Query
+
+# Websauna
+from websauna.system.core.redis import get_redis
+from websauna.system.http import Request
+
+
+logger = logging.getLogger(__name__)
+
+
+class InexactCount(int):
+    """A total count which is not exact.
+
+    Behaves like ``int`` in arithmetic, so pagination math keeps working, but renders with a marker in templates.
+    """
+
+    #: Tell paginator that we do not know the exact total
+    exact = False
+
+    def __new__(cls, value: int, capped: bool = False):
+        instance = super(InexactCount, cls).__new__(cls, value)
+        instance.capped = capped
+        return instance
+
+    def __str__(self):
+        if self.capped:
+            return "{:,}+".format(int(self))
+        return "~{:,}".format(int(self))
+
+    def __repr__(self):
+        return "<InexactCount {}>".format(str(self))
+
+
+class CountStrategy:
+    """Calculate the total item count for a listing query."""
+
+    def get_count(self, query: Query, request: Request) -> int:
+        """Count items.
+
+        :param query: Listing query, already ordered
+        :param request: Current HTTP request
+        :return: Item count. ``int`` for exact counts, :py:class:`InexactCount` otherwise.
+        """
+        raise NotImplementedError()
+
+
+class ExactCount(CountStrategy):
+    """Run ``SELECT count(*)`` over the query. The default."""
+
+    def get_count(self, query: Query, request: Request) -> int:
+        return query.count()
+
+
+class CappedCount(CountStrategy):
+    """Count up to a limit.
+
+    The database stops scanning after ``cap + 1`` rows. If there are more rows than the cap, the count is displayed as e.g. ``10,000+``.
+    """
+
+    def __init__(self, cap: int = 10000):
+        """
+        :param cap: Maximum number of rows to count
+        """
+        self.cap = cap
+
+    def get_count(self, query: Query, request: Request) -> int:
+        count = query.order_by(None).limit(self.cap + 1).count()
+        if count > self.cap:
+            return InexactCount(self.cap, capped=True)
+        return count
+
+
+class EstimatedCount(CountStrategy):
+    """Use PostgreSQL query planner statistics to estimate the count.
+
+    For unfiltered queries the row count estimate of the table, ``pg_class.reltuples``, is used. For filtered queries we read the row estimate from ``EXPLAIN`` output. Estimates are only as good as the table statistics maintained by ``ANALYZE``.
+
+    If the estimate is below ``threshold`` we run the exact count, as small counts are cheap and estimates for them inaccurate. On other databases than PostgreSQL we always fall back to the exact count.
+    """
+
+    def __init__(self, threshold: int = 10000):
+        """
+        :param threshold: Estimates smaller than this are replaced with an exact count
+        """
+        self.threshold = threshold
+
+    def get_table_estimate(self, query: Query) -> t.Optional[int]:
+        """Get the row estimate for an unfiltered single table query, or ``None`` if the query is not such."""
+        if query.whereclause is not None or len(query.column_descriptions) != 1:
+            return None
+
+        entity = query.column_descriptions[0]["entity"]
+        table = getattr(entity, "__table__", None)
+        if table is None or getattr(query, "_from_obj", None):
+            return None
+
+        result = query.session.execute(
+            text("SELECT reltuples FROM pg_class WHERE oid = to_regclass(:name)"),
+            {"name": table.fullname}
+        ).scalar()
+
+        # -1 means the table has never been vacuumed or analyzed
+        if result is None or result < 0:
+            return None
+
+        return int(result)
+
+    def get_plan_estimate(self, query: Query) -> t.Optional[int]:
+        """Ask the query planner how many rows the query returns."""
+        connection = query.session.connection()
+        compiled = query.order_by(None).statement.compile(dialect=connection.dialect)
+        result = connection.execute("EXPLAIN (FORMAT JSON) " + str(compiled), compiled.params).scalar()
+
+        if isinstance(result, str):
+            result = json.loads(result)
+
+        try:
+            return int(result[0]["Plan"]["Plan Rows"])
+        except (KeyError, IndexError, TypeError, ValueError):
+            logger.warning("Could not parse EXPLAIN output %s", result)
+            return None
+
+    def get_count(self, query: Query, request: Request) -> int:
+        if query.session.get_bind().dialect.name != "postgresql":
+            return query.count()
+
+        estimate = self.get_table_estimate(query)
+        if estimate is None:
+            estimate = self.get_plan_estimate(query)
+
+        if estimate is None or estimate < self.threshold:
+            return query.count()
+
+        return InexactCount(estimate)
+
+
+class CachedCount(CountStrategy):
+    """Cache the result of another count strategy in Redis.
+
+    The cache key is derived from the compiled SQL of the query and its parameters, so different filters get different cache entries. The cached counts can be stale up to ``ttl`` seconds.
+    """
+
+    #: Redis key prefix for the cached counts
+    key_prefix = "crud_count_"
+
+    def __init__(self, strategy: t.Optional[CountStrategy] = None, ttl: int = 60):
+        """
+        :param strategy: Strategy to calculate the count on a cache miss. Defaults to :py:class:`ExactCount`.
+        :param ttl: Cache expiration time in seconds
+        """
+        self.strategy = strategy or ExactCount()
+        self.ttl = ttl
+
+    def get_cache_key(self, query: Query) -> str:
+        """Create the Redis key for a query."""
+        compiled = query.order_by(None).statement.compile(dialect=query.session.get_bind().dialect)
+        params = sorted((k, repr(v)) for k, v in compiled.params.items())
+        digest = hashlib.sha256("{}\n{}".format(compiled, params).encode("utf-8")).hexdigest()
+        return self.key_prefix + digest
+
+    def get_count(self, query: Query, request: Request) -> int:
+        redis = get_redis(request)
+        key = self.get_cache_key(query)
+
+        cached = redis.get(key)
+        if cached is not None:
+            kind, value = cached.decode("ascii").split(":")
+            if kind == "exact":
+                return int(value)
+            return InexactCount(int(value), capped=(kind == "capped"))
+
+        count = self.strategy.get_count(query, request)
+
+        if getattr(count, "exact", True):
+            kind = "exact"
+        else:
+            kind = "capped" if count.capped else "estimate"
+
+        redis.set(key, "{}:{}".format(kind, int(count)), ex=self.ttl)
+        return count
+
+
+def clear_count_cache(registry: Registry):
+    """Drop all cached listing counts, e.g. after a bulk import."""
+    redis = get_redis(registry)
+    for key in redis.scan_iter(match=CachedCount.key_prefix + "*"):
+        redis.delete(key)
@@ -0,0 +1,168 @@
+"""Background CSV export jobs.
+
+Very large :py:class:`websauna.system.crud.views.CSVListing` exports are written to a spool directory by a Celery task instead of being streamed by a web worker. The job state and progress is kept in Redis and the user downloads the finished file from the job status page.
+
+The spool directory is set with ``websauna.export_spool_dir`` setting. It defaults to ``websauna-exports`` under the system temporary folder. If you run several web and Celery servers, the directory must be shared between them.
+"""
+# Standard Library
+import os
+import tempfile
+import time
+import typing as t
+
+# Pyramid
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid.interfaces import IAuthorizationPolicy
+from pyramid.interfaces import IRootFactory
+from pyramid.interfaces import IRoutesMapper
+from pyramid.location import lineage
+from pyramid.registry import Registry
+from pyramid.security import Everyone
+
+# Websauna
+from websauna.system.auth.principals import resolve_principals
+from websauna.system.core.redis import get_redis
+from websauna.system.http import Request
+from websauna.system.user.utils import get_user_class
+from websauna.system.user.utils import get_user_registry
+from websauna.utils.crypt import generate_random_string
+
+
+#: Redis key prefix for export job state
+KEY_PREFIX = "crud_export_"
+
+#: How long finished job state is kept around, in seconds
+JOB_TTL = 24 * 3600
+
+
+def get_spool_dir(registry: Registry) -> str:
+    """Get the directory where export files are written, creating it if needed."""
+    path = registry.settings.get("websauna.export_spool_dir")
+    if not path:
+        path = os.path.join(tempfile.gettempdir(), "websauna-exports")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def get_export_path(registry: Registry, job_id: str) -> str:
+    """Get the spool file name of an export job."""
+    assert job_id.isalnum(), "Bad job id {}".format(job_id)
+    return os.path.join(get_spool_dir(registry), "{}.csv".format(job_id))
+
+
+def purge_spool_dir(registry: Registry, max_age: int = JOB_TTL) -> int:
+    """Remove export files whose job state has expired.
+
+    :return: Number of removed files
+    """
+    spool_dir = get_spool_dir(registry)
+    deadline = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(spool_dir):
+        if entry.is_file() and entry.stat().st_mtime < deadline:
+            os.remove(entry.path)
+            removed += 1
+    return removed
+
+
+def get_traverse_path(request: Request, context: object) -> t.List[str]:
+    """Get the traversal names from the request root to the context, so that a task can find the context again with :py:func:`find_context`."""
+    names = []
+    for resource in lineage(context):
+        if resource is request.root:
+            break
+        names.append(resource.__name__)
+    return list(reversed(names))
+
+
+def find_context(request: Request, route_name: t.Optional[str], path: t.List[str]) -> object:
+    """Traverse to a context outside of the original HTTP request.
+
+    :param request: Request in which traversal happens, e.g. a faux request of a Celery task
+    :param route_name: Name of the route whose factory creates the traversal root. ``None`` for the default root factory.
+    :param path: Traversal names from :py:func:`get_traverse_path`
+    """
+    registry = request.registry
+    if route_name:
+        route = registry.getUtility(IRoutesMapper).get_route(route_name)
+        root = route.factory(request)
+    else:
+        root = registry.getUtility(IRootFactory)(request)
+
+    context = root
+    for name in path:
+        context = context[name]
+    return context
+
+
+def find_user_context(request: Request, user_id: t.Optional[int], route_name: t.Optional[str], path: t.List[str], permissions: t.Iterable[str] = ("view",)) -> object:
+    """Traverse to a context on behalf of the user who started a background job.
+
+    The user is set as ``request.user`` of the faux request, so that listing queries scoped by the user see the same rows as in the original HTTP request. The permissions are checked again against the current principals of the user.
+
+    :param user_id: Id of the user who started the job or ``None`` for an anonymous user
+    :param permissions: Permissions the user must have on the context
+    :raise HTTPForbidden: If the user no longer has a permission
+    """
+    user = None
+    if user_id is not None:
+        user = request.dbsession.query(get_user_class(request.registry)).get(user_id)
+    request.user = user
+
+    context = find_context(request, route_name, path)
+
+    principals = [Everyone]
+    if user is not None:
+        principals += resolve_principals(get_user_registry(request).get_session_token(user), request) or []
+
+    policy = request.registry.queryUtility(IAuthorizationPolicy)
+    for permission in permissions:
+        if policy is not None and permission and not policy.permits(context, principals, permission):
+            raise HTTPForbidden("User {} does not have permission {} on {}".format(user_id, permission, context))
+
+    return context
+
+
+def create_export_job(request: Request, filename: str, total: t.Optional[int]) -> str:
+    """Store the state of a new pending export job.
+
+    :param request: HTTP request starting the export
+    :param filename: Download file name
+    :param total: Estimated number of exported rows
+    :return: Job id
+    """
+    job_id = generate_random_string(24)
+    user = request.user
+    update_export_job(request.registry, job_id, {
+        "status": "pending",
+        "filename": filename,
+        "rows": 0,
+        "total": int(total) if total is not None else "",
+        "user_id": user.id if user else "",
+    })
+    return job_id
+
+
+def update_export_job(registry: Registry, job_id: str, state: dict):
+    """Update the state of an export job."""
+    redis = get_redis(registry)
+    key = KEY_PREFIX + job_id
+    redis.hmset(key, state)
+    redis.expire(key, JOB_TTL)
+
+
+def get_export_job(registry: Registry, job_id: str) -> t.Optional[dict]:
+    """Read the state of an export job.
+
+    :return: Job state dictionary or ``None`` if the job does not exist or has expired. ``rows`` and ``total`` are integers, ``total`` may be ``None``.
+    """
+    redis = get_redis(registry)
+    data = redis.hgetall(KEY_PREFIX + job_id)
+    if not data:
+        return None
+
+    state = {k.decode("utf-8"): v.decode("utf-8") for k, v in data.items()}
+    state["id"] = job_id
+    state["rows"] = int(state.get("rows") or 0)
+    state["total"] = int(state["total"]) if state.get("total") else None
+    return state
@@ -19,6 +19,12 @@ class Column:
     navigate_url_getter = None
     getter = None
 
+    #: Model attribute names this column reads, used by listing projection. ``None`` means the column id if it is a mapped attribute, otherwise unknown.
+    attributes = None
+
+    #: Relationship paths this column traverses, e.g. ``["owner", "owner.groups"]``. The listing eager loads them for all rows in one go.
+    relationships = None
+
     #: Arrow formatting string
     format = "MM/DD/YYYY HH:mm"
 
@@ -32,7 +38,9 @@ class Column:
             getter: t.Optional[t.Callable] = None,
             format: t.Optional[str] = None,
             navigate_view_name=None,
-            navigate_url_getter=None
+            navigate_url_getter=None,
+            attributes: t.Optional[t.List[str]] = None,
+            relationships: t.Optional[t.List[str]] = None
     ):
         """Initialize Column.
 
@@ -45,6 +53,8 @@ class Column:
         :param format: Format to be applied to the value. i.e: "MM/DD/YYYY HH:mm" for a date value.
         :param navigate_url_getter: callback(request, resource) to generate the target URL if the contents of this cell is clicked
         :param navigate_view_name: If set, make this column clickable and navigates to the traversed name. Options are "show", "edit", "delete"
+        :param attributes: Model attribute names ``getter`` reads. Needed for listing projection to load these attributes, see :py:attr:`websauna.system.crud.views.Listing.projection`.
+        :param relationships: Dotted relationship paths ``getter`` or ``navigate_url_getter`` traverses. The listing query eager loads these to avoid one lazy load query per row.
         """
         self.id = id
         self.name = name
@@ -61,6 +71,10 @@ class Column:
             self.navigate_view_name = navigate_view_name
         if navigate_url_getter:
             self.navigate_url_getter = navigate_url_getter
+        if attributes is not None:
+            self.attributes = attributes
+        if relationships is not None:
+            self.relationships = relationships
 
     def get_value(self, view: t.Any, obj: t.Any):
         """Extract value from the object for this column.
@@ -144,6 +158,9 @@ class StringPresentationColumn(Column):
 class ControlsColumn(Column):
     """Render View / Edit / Delete buttons."""
 
+    #: Buttons only need the resource path
+    attributes = []
+
     def __init__(
             self,
             id: str = 'controls',
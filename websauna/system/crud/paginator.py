@@ -1,17 +1,35 @@
 """Paginator."""
 # Standard Library
+import base64
+import binascii
+import datetime
+import json
 import math
 import typing as t
+import uuid
+from decimal import Decimal
 from urllib.parse import parse_qsl
 from urllib.parse import urlencode
 from urllib.parse import urlsplit
 from urllib.parse import urlunsplit
 
+# SQLAlchemy
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import inspect
+from sqlalchemy import or_
+from sqlalchemy.orm import Query
+from sqlalchemy.orm.exc import UnmappedColumnError
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
+
+import arrow
+
 
 def merge_url_qs(url: str, **kw) -> str:
     """Merge the query string elements of a URL with the ones in ``kw``.
 
-    If any query string element exists in ``url`` that also exists in ``kw``, replace it.
+    If any query string element exists in ``url`` that also exists in ``kw``, replace it. Elements with ``None`` value are removed.
 
     :param url: An URL.
     :param kw: Dictionary with keyword arguments.
@@ -23,12 +41,45 @@ def merge_url_qs(url: str, **kw) -> str:
         for (k, v) in parse_qsl(segments.query, keep_blank_values=1)
         if k not in kw
     ]
-    qs = urlencode(sorted(kw.items()))
+    qs = urlencode(sorted((k, v) for k, v in kw.items() if v is not None))
     if extra_qs:
-        qs += '&' + urlencode(extra_qs)
+        qs = qs + '&' + urlencode(extra_qs) if qs else urlencode(extra_qs)
     return urlunsplit((segments.scheme, segments.netloc, segments.path, qs, segments.fragment))
 
 
+def get_batch_position(request, default_size: int) -> t.Tuple[int, int]:
+    """Read the batch number and batch size from the request parameters.
+
+    :return: Tuple (batch_num, batch_size)
+    """
+    try:
+        num = int(request.params.get('batch_num', 0))
+    except (TypeError, ValueError):
+        num = 0
+    if num < 0:
+        num = 0
+
+    try:
+        size = int(request.params.get('batch_size', default_size))
+    except (TypeError, ValueError):
+        size = default_size
+    if size < 1:
+        size = default_size
+
+    return num, size
+
+
+class _WindowSlice:
+    """A page of rows already loaded from the database, addressed with the indexes of the full sequence."""
+
+    def __init__(self, items: list, start: int):
+        self.items = items
+        self.start = start
+
+    def __getitem__(self, index: slice) -> list:
+        return self.items[index.start - self.start:index.stop - self.start]
+
+
 class Batch:
     """Present one paginator batch in the list rendering output.
 
@@ -110,7 +161,8 @@ class Batch:
       ``batch_size`` in its query string.  The base URL will be taken from
       the ``url`` value passed to this function.  If a ``url`` value is not
       passed to this function, the URL will be taken from ``request.url``.
-      This value will be ``None`` if there is no next batch.
+      This value will be ``None`` if there is no next batch or the total
+      count is not exact.
 
     ``required``
 
@@ -140,7 +192,10 @@ class Batch:
 
     ``seqlen``
 
-      This is total length of the sequence (across all batches).
+      This is total length of the sequence (across all batches).  If
+      ``seqlen`` is an estimated or capped count (has ``exact`` attribute
+      set to ``False``), the existence of the next batch is determined by
+      fetching one extra item.
 
     ``startitem``
 
@@ -156,19 +211,7 @@ class Batch:
         if url is None:
             url = request.url
 
-        try:
-            num = int(request.params.get('batch_num', 0))
-        except (TypeError, ValueError):
-            num = 0
-        if num < 0:
-            num = 0
-
-        try:
-            size = int(request.params.get('batch_size', default_size))
-        except (TypeError, ValueError):
-            size = default_size
-        if size < 1:
-            size = default_size
+        num, size = get_batch_position(request, default_size)
 
         multicolumn = request.params.get('multicolumn', '') == 'True'
 
@@ -184,13 +227,26 @@ class Batch:
         if seqlen is None:
             # won't work if seq is a generator
             seqlen = len(seq)
+
+        # Estimated and capped counts, see websauna.system.crud.count
+        exact = getattr(seqlen, "exact", True)
+
         start = num * size
         end = start + size
-        if end > seqlen:
-            end = seqlen
 
-        # normal list slicing is mucho faster than islice
-        items = seq[start:end]
+        if exact:
+            if end > seqlen:
+                end = seqlen
+
+            # normal list slicing is mucho faster than islice
+            items = seq[start:end]
+            has_next = seqlen > end
+        else:
+            # Fetch one extra item to see if there is a next page
+            items = list(seq[start:end + 1])
+            has_next = len(items) > size
+            items = items[:size]
+            end = start + len(items)
 
         length = len(items)
         last = int(math.ceil(seqlen / float(size)) - 1)
@@ -205,9 +261,9 @@ class Batch:
             first_url = merge_url_qs(url, batch_size=size, batch_num=0)
         if start >= size:
             prev_url = merge_url_qs(url, batch_size=size, batch_num=num - 1)
-        if seqlen > end:
+        if has_next:
             next_url = merge_url_qs(url, batch_size=size, batch_num=num + 1)
-        if size and (num < last):
+        if size and (num < last) and exact:
             last_url = merge_url_qs(url, batch_size=size, batch_num=last)
 
         if prev_url or next_url:
@@ -279,3 +335,312 @@ class DefaultPaginator:
     def paginate(self, seq, request, count, url=None) -> Batch:
         batch = Batch(seq, request, seqlen=count, url=url, default_size=self.default_size)
         return batch
+
+    def paginate_window_count(self, query: Query, request, url=None) -> Batch:
+        """Load the batch rows and the total count in one statement.
+
+        The total is read from a ``count(*) OVER ()`` column added to the page query, instead of running a separate count query. The count is then available as ``batch.seqlen``.
+
+        :param query: SQLAlchemy query for a single model
+        """
+        num, size = get_batch_position(request, self.default_size)
+        start = num * size
+
+        rows = query.add_columns(func.count().over()).limit(size).offset(start).all()
+        if rows:
+            count = rows[0][-1]
+        elif start:
+            # Past the last page, the window has no rows to tell the total
+            count = query.order_by(None).count()
+        else:
+            count = 0
+
+        seq = _WindowSlice([row[0] for row in rows], start)
+        return Batch(seq, request, seqlen=count, url=url, default_size=self.default_size)
+
+
+class CursorDecodeError(Exception):
+    """Keyset pagination cursor token from the URL was malformed."""
+
+
+#: Cursor value type tags. Order matters, as bool is a subclass of int and datetime a subclass of date.
+_CURSOR_TYPES = (
+    ("b", bool, lambda v: v, lambda v: v),
+    ("i", int, lambda v: v, lambda v: v),
+    ("f", float, lambda v: v, lambda v: v),
+    ("s", str, lambda v: v, lambda v: v),
+    ("n", Decimal, str, Decimal),
+    ("u", uuid.UUID, str, uuid.UUID),
+    ("dt", datetime.datetime, lambda v: v.isoformat(), lambda v: arrow.get(v).datetime),
+    ("d", datetime.date, lambda v: v.isoformat(), lambda v: arrow.get(v).date()),
+)
+
+
+def encode_cursor(values: t.Iterable) -> str:
+    """Pack ordering column values of a row to an URL safe cursor token.
+
+    :param values: Values of the keyset columns of the row where the page boundary is.
+    :return: Base64 encoded token
+    """
+    packed = []
+    for value in values:
+        if value is None:
+            packed.append(["z", None])
+            continue
+
+        for tag, type_, dump, load in _CURSOR_TYPES:
+            if isinstance(value, type_):
+                if type_ is datetime.datetime and value.tzinfo is None:
+                    tag = "ndt"
+                packed.append([tag, dump(value)])
+                break
+        else:
+            raise TypeError("Cannot use value {} of type {} in keyset pagination cursor".format(value, type(value)))
+
+    data = json.dumps(packed, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str) -> t.List:
+    """Unpack an URL cursor token created by :py:func:`encode_cursor`.
+
+    :param token: Token as it appears in the URL
+    :return: List of column values
+    :raise CursorDecodeError: If the token cannot be decoded
+    """
+    loaders = {tag: load for tag, type_, dump, load in _CURSOR_TYPES}
+    loaders["ndt"] = lambda v: arrow.get(v).naive
+    loaders["z"] = lambda v: None
+
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        packed = json.loads(data.decode("utf-8"))
+        return [loaders[tag](value) for tag, value in packed]
+    except (binascii.Error, ValueError, TypeError, KeyError, arrow.parser.ParserError) as e:
+        raise CursorDecodeError("Bad cursor token: {}".format(token)) from e
+
+
+def get_keyset_columns(query: Query) -> t.List[t.Tuple[str, t.Any, bool]]:
+    """Resolve the ordering of a query to keyset pagination columns.
+
+    The primary key is appended to the ordering if it is not there already, so that every row has an unique position in the ordering.
+
+    :param query: Query having ``order_by()`` set, as done by :py:meth:`websauna.system.crud.views.Listing.order_query`.
+    :return: List of tuples (attribute name, column, descending)
+    """
+    model = query.column_descriptions[0]["entity"]
+    mapper = inspect(model)
+
+    # SQLAlchemy 1.4+ renamed the internal attribute
+    clauses = getattr(query, "_order_by_clauses", None) or getattr(query, "_order_by", None) or ()
+
+    keys = []
+    for clause in clauses:
+        descending = False
+        column = clause
+        while isinstance(column, UnaryExpression):
+            if column.modifier is operators.desc_op:
+                descending = True
+            column = column.element
+
+        try:
+            attr = mapper.get_property_by_column(column).key
+        except (UnmappedColumnError, KeyError) as e:
+            raise RuntimeError("Keyset pagination can only order by mapped columns of {}, got {}".format(model, clause)) from e
+
+        keys.append((attr, column, descending))
+
+    # Use the direction of the last sort key for the tiebreaker, so that a composite index can serve the query
+    descending = keys[-1][2] if keys else False
+    for column in mapper.primary_key:
+        attr = mapper.get_property_by_column(column).key
+        if attr not in [k[0] for k in keys]:
+            keys.append((attr, column, descending))
+
+    return keys
+
+
+def _keyset_filter(keys: t.List[t.Tuple[str, t.Any, bool]], values: t.List, reverse: bool):
+    """Build WHERE condition selecting rows which come after the given values in the keyset ordering.
+
+    Mixed sort directions are supported by expanding the row comparison to ``(a > x) OR (a = x AND b > y) ...``.
+    """
+    clauses = []
+    for idx, (attr, column, descending) in enumerate(keys):
+        conditions = [keys[i][1] == values[i] for i in range(idx)]
+        if descending != reverse:
+            conditions.append(column < values[idx])
+        else:
+            conditions.append(column > values[idx])
+        clauses.append(and_(*conditions))
+    return or_(*clauses)
+
+
+class KeysetBatch:
+    """Present one keyset (seek method) paginated batch in the list rendering output.
+
+    Unlike :py:class:`Batch` which uses ``OFFSET``, keyset pagination continues from the ordering column values of the last row seen. Thus fetching a deep page costs the same as fetching the first page, given there is an index matching the ordering.
+
+    The page position is carried in the URL as an opaque ``after`` or ``before`` cursor token. ``before=last`` points to the last page.
+
+    The ordering columns must not contain NULL values.
+
+    ``items``
+
+      A list of items on this page.
+
+    ``size``
+
+      Page size, from ``request.params['batch_size']`` or ``default_size``.
+
+    ``length``
+
+      Number of items on this page.
+
+    ``seqlen``
+
+      Total number of items, if known.
+
+    ``first_url``, ``prev_url``, ``next_url``, ``last_url``
+
+      Navigation URLs or ``None`` if the navigation is not possible.
+
+    ``required``
+
+      ``True`` if either ``next_url`` or ``prev_url`` is set.
+    """
+
+    #: URL parameter value for ``before`` pointing to the last page
+    LAST = "last"
+
+    def __init__(self, query: Query, request, url=None, default_size=10, seqlen=None):
+        if url is None:
+            url = request.url
+
+        try:
+            size = int(request.params.get('batch_size', default_size))
+        except (TypeError, ValueError):
+            size = default_size
+        if size < 1:
+            size = default_size
+
+        keys = get_keyset_columns(query)
+
+        after = request.params.get("after")
+        before = request.params.get("before")
+
+        reverse = False
+        values = None
+
+        try:
+            if before:
+                reverse = True
+                if before != self.LAST:
+                    values = decode_cursor(before)
+            elif after:
+                values = decode_cursor(after)
+        except CursorDecodeError:
+            # Tampered or stale URL, start from the beginning
+            reverse = False
+            values = None
+
+        if values is not None and len(values) != len(keys):
+            reverse = False
+            values = None
+
+        def fetch(reverse, values):
+            ordering = []
+            for attr, column, descending in keys:
+                ordering.append(column.asc() if descending == reverse else column.desc())
+
+            page_query = query.order_by(None).order_by(*ordering)
+            if values is not None:
+                page_query = page_query.filter(_keyset_filter(keys, values, reverse))
+
+            # Fetch one extra row to see if there is more to come
+            return page_query.limit(size + 1).all()
+
+        items = fetch(reverse, values)
+        if not items and values is not None:
+            # Stale cursor, e.g. rows after it were deleted. Show the last page instead of an empty page after the end, or the first page instead of an empty page before the beginning.
+            reverse = not reverse
+            values = None
+            items = fetch(reverse, values)
+
+        has_more = len(items) > size
+        items = items[:size]
+
+        if reverse:
+            items.reverse()
+            has_prev = has_more
+            has_next = values is not None
+        else:
+            has_prev = values is not None
+            has_next = has_more
+
+        def cursor(obj):
+            return encode_cursor([getattr(obj, attr) for attr, column, descending in keys])
+
+        first_url = prev_url = next_url = last_url = None
+
+        if has_prev:
+            first_url = merge_url_qs(url, batch_size=size, after=None, before=None)
+            prev_url = merge_url_qs(url, batch_size=size, after=None, before=cursor(items[0]))
+
+        if has_next:
+            next_url = merge_url_qs(url, batch_size=size, before=None, after=cursor(items[-1]))
+            last_url = merge_url_qs(url, batch_size=size, after=None, before=self.LAST)
+
+        self.items = items
+        self.size = size
+        self.length = len(items)
+        self.seqlen = seqlen
+        self.required = bool(prev_url or next_url)
+        self.first_url = first_url
+        self.prev_url = prev_url
+        self.next_url = next_url
+        self.last_url = last_url
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return True
+
+
+class KeysetPaginator(DefaultPaginator):
+    """Keyset pagination for CRUD listings with large tables.
+
+    Pages on the ordering columns set by :py:meth:`websauna.system.crud.views.Listing.order_query`, with the primary key as a tiebreaker. There are no page numbers, but the user can navigate first, previous, next and last pages.
+
+    Example:
+
+    .. code-block:: python
+
+        class UserListing(admin_views.Listing):
+
+            paginator = KeysetPaginator()
+
+            def order_query(self, query):
+                return query.order_by(User.created_at.desc())
+
+    For optimal performance have a database index over the ordering columns and the primary key, e.g. ``(created_at, id)``.
+    """
+
+    template = 'crud/paginator_keyset.html'
+
+    def paginate(self, seq, request, count, url=None) -> KeysetBatch:
+        batch = KeysetBatch(seq, request, seqlen=count, url=url, default_size=self.default_size)
+        return batch
+
+    def paginate_window_count(self, query: Query, request, url=None):
+        """Window count is not available with keyset pagination.
+
+        ``count(*) OVER ()`` on a keyset page would only count the rows after the cursor. Use :py:attr:`websauna.system.crud.views.Listing.count_strategy` instead.
+
+        :raise RuntimeError: Always
+        """
+        raise RuntimeError("Listing.window_count cannot be used with KeysetPaginator, use Listing.count_strategy instead")
@@ -6,6 +6,8 @@ import typing as t
 from pyramid.interfaces import IRequest
 
 # SQLAlchemy
+from sqlalchemy import inspect
+from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm import Query
 from sqlalchemy.orm import Session
 
@@ -83,11 +85,20 @@ class CRUD(_CRUD):
         dbsession = self.get_dbsession()
         return dbsession.delete(obj)
 
+    def is_primary_key(self, attribute_name: str) -> bool:
+        """Check if the model attribute is the single column primary key of the model."""
+        mapper = inspect(self.get_model())
+        if len(mapper.primary_key) != 1:
+            return False
+        return mapper.get_property_by_column(mapper.primary_key[0]).key == attribute_name
+
     def fetch_object(self, id):
         """Pull a raw object from the database.
 
         Use the ``get_query()`` to get the query base and then return the object with matching id.
 
+        If the mapping attribute is the primary key and ``get_query()`` does not add any criteria, the object is loaded with ``Query.get()``. It returns an object already in the session identity map without a database round trip.
+
         First check for legal ids and raise KeyError to signal that the traversed ``id`` might be actually a view name.
         """
         model = self.get_model()
@@ -97,7 +108,15 @@ class CRUD(_CRUD):
         column_instance = getattr(model, column_name, None)
         assert column_instance, "Model {} does not define column/attribute {} used for CRUD resource traversing".format(self.model, column_name)
 
-        obj = self.get_query().filter(column_instance == id).first()
+        query = self.get_query()
+        if self.is_primary_key(column_name):
+            try:
+                obj = query.get(id)
+            except InvalidRequestError:
+                # Query.get() refuses queries with filters, ordering, etc.
+                obj = query.filter(column_instance == id).first()
+        else:
+            obj = query.filter(column_instance == id).first()
         if not obj:
             raise KeyError("Object id {} was not found for CRUD {} using model {}".format(id, self, model))
 
@@ -0,0 +1,74 @@
+"""Background tasks for CRUD."""
+# Standard Library
+import logging
+import typing as t
+
+# Pyramid
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid.path import DottedNameResolver
+
+# Websauna
+from websauna.system.task.tasks import RetryableTransactionTask
+from websauna.system.task.tasks import ScheduleOnCommitTask
+from websauna.system.task.tasks import task
+
+from . import export
+from .bulk import run_bulk_action
+from .bulk import run_bulk_action_query
+
+
+logger = logging.getLogger(__name__)
+
+
+@task(name="crud_bulk_action", base=RetryableTransactionTask, bind=True)
+def bulk_action(self: RetryableTransactionTask, action_name: str, payload: dict, model_name: str, ids: list):
+    """Run one chunk of a bulk action scheduled by :py:meth:`websauna.system.crud.bulk.BulkAction.schedule`."""
+    request = self.get_request()
+    count = run_bulk_action(request.dbsession, action_name, payload, model_name, ids)
+    logger.info("Bulk action %s affected %d rows of %s", action_name, count, model_name)
+
+
+@task(name="crud_bulk_action_query", base=RetryableTransactionTask, bind=True)
+def bulk_action_query(self: RetryableTransactionTask, action_name: str, payload: dict, user_id: t.Optional[int], view_name: str, route_name: str, path: list, params: list):
+    """Run a bulk action on all rows of a listing, scheduled by :py:meth:`websauna.system.crud.bulk.BulkAction.schedule_query`.
+
+    The listing is rebuilt as seen by the user who scheduled the action.
+    """
+    request = self.get_request()
+
+    # Listing filters are read from the query string
+    for key, value in params:
+        request.GET.add(key, value)
+
+    resolver = DottedNameResolver()
+    action = resolver.resolve(action_name).from_payload(payload)
+    context = export.find_user_context(request, user_id, route_name, path, permissions=("view", action.permission))
+    view_class = resolver.resolve(view_name)
+    view = view_class(context, request)
+    count = run_bulk_action_query(action_name, payload, view.get_query())
+    logger.info("Bulk action %s affected %d rows of %s", action_name, count, view_name)
+
+
+@task(name="crud_csv_export", base=ScheduleOnCommitTask, bind=True)
+def csv_export(self: ScheduleOnCommitTask, job_id: str, user_id: t.Optional[int], view_name: str, route_name: str, path: list, params: list, encoding: str):
+    """Write a background CSV export scheduled by :py:meth:`websauna.system.crud.views.CSVListing.start_export_job`.
+
+    The listing is rebuilt as seen by the user who started the export.
+    """
+    request = self.get_request()
+    export.purge_spool_dir(request.registry)
+
+    # Listing filters are read from the query string
+    for key, value in params:
+        request.GET.add(key, value)
+
+    try:
+        context = export.find_user_context(request, user_id, route_name, path)
+    except HTTPForbidden:
+        export.update_export_job(request.registry, job_id, {"status": "failed"})
+        raise
+
+    view_class = DottedNameResolver().resolve(view_name)
+    view = view_class(context, request)
+    view.write_export(job_id, encoding)
+    logger.info("Background export %s of %s finished", job_id, view_name)
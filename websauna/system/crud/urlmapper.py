@@ -41,7 +41,7 @@ class IdMapper(Mapper):
     transform_to_id = int
 
     #: is_id(path) function checks whether the given URL path should be mapped to object and is a valid object id. Alternatively, if the path doesn't look like an object id, it could be a view name. Because Pyramid traversing checks objects prior views, we need to let bad object ids to fall through through KeyError, so that view matching mechanism kicks in. By default we check for number integer id.
-    #: Some object paths cannot be reliable disquished from view names, like UUID strings. In this case ``is_id`` is None, the lookup always first goes to the database. The database item is not with view name a KeyError is triggerred and thus Pyramid continues to view name resolution. This behavior is suboptimal and may change in the future versions
+    #: Some object paths cannot be reliable disquished from view names, like UUID strings. In this case ``is_id`` is None, the lookup always first goes to the database. The database item is not with view name a KeyError is triggerred and thus Pyramid continues to view name resolution. View names registered for CRUD contexts never go to the database, see :py:func:`websauna.system.crud.get_reserved_view_names`.
     is_id = staticmethod(lambda value: value.isdigit())
 
     def __init__(self, mapping_attribute=None, transform_to_path=None, transform_to_id=None, is_id=None):
@@ -89,7 +89,7 @@ class Base64UUIDMapper(IdMapper):
     def is_id(val):
         """Try guess if the value is valid base64 UUID slug or not.
 
-        Note that some view names can be valid UUID slugs, thus we might hit database in any case for the view lookup.
+        Note that some view names can be valid UUID slugs. CRUD views are skipped by :py:func:`websauna.system.crud.get_reserved_view_names`, other names might still hit the database.
         """
         try:
             slug.slug_to_uuid(val)
@@ -1,20 +1,35 @@
 """Default CRUD views."""
 # Standard Library
 import csv
+import logging
+import os
 import typing as t
 from abc import abstractmethod
 from io import StringIO
 
 # Pyramid
 import deform
+from pyramid.csrf import check_csrf_token
+from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.httpexceptions import HTTPFound
+from pyramid.httpexceptions import HTTPNotFound
 from pyramid.renderers import render
 from pyramid.request import Request
+from pyramid.response import FileResponse
 from pyramid.response import Response
+from pyramid.settings import asbool
 from pyramid.view import view_config
 
 # SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy import orm
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import ColumnProperty
 from sqlalchemy.orm import Query
+from sqlalchemy.orm import RelationshipProperty
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import load_only
 
 from slugify import slugify
 
@@ -23,15 +38,25 @@ from websauna.system.core import messages
 from websauna.system.form import interstitial
 from websauna.system.form.fieldmapper import EditMode
 from websauna.system.form.resourceregistry import ResourceRegistry
+from websauna.utils.qualname import get_qual_name
 
 from . import CRUD
 from . import Resource
+from . import export
 from . import paginator
+from .bulk import BulkAction
+from .bulk import get_primary_key
+from .count import ExactCount
 
 if t.TYPE_CHECKING:
+    from .count import CountStrategy
+    from .listing import Column
     from .listing import Table
 
 
+logger = logging.getLogger(__name__)
+
+
 class ResourceButton:
     """Present a button on the top right corner of CRUD views.
 
@@ -162,6 +187,27 @@ class Listing(CRUDView):
     #: How the result of this list should be split to pages
     paginator = paginator.DefaultPaginator()
 
+    #: Automatic projection mode. If set, the listing query loads only model attributes needed by the table columns and defers the rest, e.g. large JSONB columns. Columns with a custom ``getter`` must declare the attributes they read with ``attributes`` argument, otherwise the full model is loaded.
+    projection = False
+
+    #: SQLAlchemy loader strategy used for relationships declared by columns with ``relationships`` argument. One of ``selectinload``, ``joinedload``, ``subqueryload``.
+    relationship_loading = "selectinload"
+
+    #: Detect relationships touched by column getters with a dry-run on the first row, for columns not declaring ``relationships``. The result is remembered for the lifetime of the process.
+    detect_relationships = False
+
+    #: Relationships found by dry-runs, keyed by (view class, column ids)
+    _detected_relationships = {}
+
+    #: Set-based actions on selected rows, like :py:class:`websauna.system.crud.bulk.BulkDelete`. When set, the listing renders row checkboxes.
+    bulk_actions = []
+
+    #: Load the page rows and the total count with one ``count(*) OVER ()`` statement instead of two queries. :py:attr:`count_strategy` is not used. Requires :py:class:`websauna.system.crud.paginator.DefaultPaginator`, not supported by :py:class:`websauna.system.crud.paginator.KeysetPaginator`.
+    window_count = False
+
+    #: How the total item count is calculated. See :py:mod:`websauna.system.crud.count` for estimated, capped and cached alternatives.
+    count_strategy = ExactCount()  # type: CountStrategy
+
     resource_buttons = [TraverseLinkButton(id="add", name="Add", view_name="add", permission="add")]
 
     def __init__(self, context: CRUD, request: Request):
@@ -187,24 +233,219 @@ class Listing(CRUDView):
         return self.context.get_query()
 
     def get_count(self, query: Query):
-        """Calculate total item count based on query."""
-        return query.count()
+        """Calculate total item count based on query.
+
+        The count is calculated by :py:attr:`count_strategy`.
+        """
+        return self.count_strategy.get_count(query, self.request)
 
     def order_query(self, query: Query):
         """Sort the query."""
         return query
 
+    def get_projection_attributes(self, query: Query, columns: t.List["Column"]) -> t.Optional[t.Set[str]]:
+        """Resolve model attributes the listing needs to load.
+
+        :param query: Ordered listing query
+        :param columns: Table columns
+        :return: Set of mapped column attribute names or ``None`` if some column reads unknown attributes.
+        """
+        mapper = inspect(self.get_model())
+
+        # Traversal path, row CSS class and ordering needs
+        names = {self.get_crud().mapper.mapping_attribute, "id"}
+        try:
+            names.update(attr for attr, column, descending in paginator.get_keyset_columns(query))
+        except RuntimeError:
+            # Ordered by an expression, do not care
+            pass
+
+        for c in columns:
+            if c.relationships:
+                names.update(path.split(".")[0] for path in c.relationships)
+
+            if c.attributes is not None:
+                names.update(c.attributes)
+                continue
+
+            prop = mapper.attrs.get(c.id)
+            if c.getter or prop is None:
+                # Python property or custom getter, we do not know what it reads
+                return None
+
+            names.add(c.id)
+
+        result = set()
+        for name in names:
+            prop = mapper.attrs.get(name)
+            if isinstance(prop, ColumnProperty):
+                result.add(name)
+            elif isinstance(prop, RelationshipProperty):
+                # Lazy loading a relationship needs the foreign key
+                for column in prop.local_columns:
+                    result.add(mapper.get_property_by_column(column).key)
+        return result
+
+    def apply_projection(self, query: Query, columns: t.List["Column"]) -> Query:
+        """Defer loading of model attributes which are not rendered in the listing.
+
+        Called if :py:attr:`projection` is set.
+        """
+        names = self.get_projection_attributes(query, columns)
+        if names is None:
+            return query
+        return query.options(load_only(*sorted(names)))
+
+    def detect_relationship_paths(self, query: Query, columns: t.List["Column"]) -> t.List[str]:
+        """Find relationships the column getters touch by rendering the first row.
+
+        We compare the unloaded relationships of the row object before and after extracting the column values.
+        """
+        key = (self.__class__, tuple(c.id for c in columns))
+        if key in self._detected_relationships:
+            return self._detected_relationships[key]
+
+        # Refresh the row even if it is already in the identity map, so that relationships loaded earlier in the request are unloaded again
+        obj = query.populate_existing().first()
+        if obj is None:
+            # Nothing to learn from yet
+            return []
+
+        state = inspect(obj)
+        relationship_names = set(state.mapper.relationships.keys())
+        unloaded_before = state.unloaded & relationship_names
+
+        resource = self.get_crud().wrap_to_resource(obj)
+        for c in columns:
+            if c.relationships is None:
+                c.get_value(self, obj)
+                if c.navigate_url_getter:
+                    c.get_navigate_url(resource, self.request)
+
+        paths = sorted(unloaded_before - state.unloaded)
+        if paths:
+            # An empty result might come from a row without related data, try again on the next listing
+            self._detected_relationships[key] = paths
+        return paths
+
+    def get_relationship_paths(self, query: Query, columns: t.List["Column"]) -> t.List[str]:
+        """Get the relationship paths to eager load for the listing."""
+        paths = []
+        for c in columns:
+            for path in c.relationships or []:
+                if path not in paths:
+                    paths.append(path)
+
+        if self.detect_relationships:
+            for path in self.detect_relationship_paths(query, columns):
+                if path not in paths:
+                    paths.append(path)
+
+        return paths
+
+    def apply_relationship_loading(self, query: Query, columns: t.List["Column"]) -> Query:
+        """Eager load relationships traversed by the columns.
+
+        :param query: Listing query
+        :param columns: Table columns
+        :return: Query with loader options
+        """
+        paths = self.get_relationship_paths(query, columns)
+        if not paths:
+            return query
+
+        mapper = inspect(self.get_model())
+        options = []
+        for path in paths:
+            current = mapper
+            option = None
+            for name in path.split("."):
+                if name not in current.relationships:
+                    raise RuntimeError("{} is not a relationship of {} in column relationship path {}".format(name, current.class_, path))
+                attr = getattr(current.class_, name)
+                if option is None:
+                    option = getattr(orm, self.relationship_loading)(attr)
+                else:
+                    option = getattr(option, self.relationship_loading)(attr)
+                current = current.relationships[name].mapper
+            options.append(option)
+
+        return query.options(*options)
+
+    def watch_query_count(self, template_context: dict) -> dict:
+        """Warn if rendering the listing page issues as many database queries as there are rows.
+
+        Enabled with ``websauna.debug_listing_queries`` setting. The queries of the listing itself, counting and fetching the page, are not included: the caller stores the number of queries issued so far as ``listing`` in the returned counter after the page has been fetched.
+
+        :return: Counter dict with ``queries`` and ``listing`` keys
+        """
+        connection = self.get_crud().get_dbsession().connection()
+        counter = {"queries": 0, "listing": 0}
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            counter["queries"] += 1
+
+        event.listen(connection, "before_cursor_execute", before_cursor_execute)
+
+        def check(request, response):
+            event.remove(connection, "before_cursor_execute", before_cursor_execute)
+            rows = len(template_context["batch"])
+            queries = counter["queries"] - counter["listing"]
+            if rows and queries >= rows:
+                logger.warning("Listing %s issued %d queries for %d rows, declare relationships on columns to eager load them", self.__class__.__name__, queries, rows)
+
+        self.request.add_response_callback(check)
+        return counter
+
+    def get_bulk_actions(self) -> t.List[BulkAction]:
+        """Get bulk actions the current user is allowed to perform."""
+        return [a for a in self.bulk_actions if a.is_visible(self.context, self.request)]
+
+    def get_bulk_id(self, obj: object) -> t.Any:
+        """Get the value of the row checkbox for bulk actions."""
+        return inspect(obj).identity[0]
+
+    def get_bulk_ids(self) -> t.List:
+        """Read the selected row ids from the POST.
+
+        :raise HTTPBadRequest: If the ids do not match the primary key type
+        """
+        pk = get_primary_key(self.get_model())
+        try:
+            python_type = pk.type.python_type
+        except NotImplementedError:
+            python_type = str
+
+        try:
+            return [python_type(id) for id in self.request.POST.getall("ids")]
+        except ValueError as e:
+            raise HTTPBadRequest("Bad bulk action ids") from e
+
+    def get_listing_ref(self) -> tuple:
+        """Get a serializable reference to rebuild this listing and its query in a Celery task.
+
+        :return: Tuple (view class name, route name, traversal path, query string parameters)
+        """
+        request = self.request
+        route_name = request.matched_route.name if request.matched_route else None
+        path = export.get_traverse_path(request, self.context)
+        return get_qual_name(self.__class__), route_name, path, list(request.GET.items())
+
     def get_title(self) -> str:
         """Get the user-readable name of the listing view (breadcrumbs, etc.)"""
         return "All {}".format(self.get_crud().plural_name)
 
     def paginate(self, template_context):
         """Create template variables for paginatoin results."""
-        batch = self.paginator.paginate(
-            template_context["query"],
-            self.request,
-            template_context["count"]
-        )
+        if self.window_count:
+            batch = self.paginator.paginate_window_count(template_context["query"], self.request)
+            template_context["count"] = batch.seqlen
+        else:
+            batch = self.paginator.paginate(
+                template_context["query"],
+                self.request,
+                template_context["count"]
+            )
         template_context["batch"] = batch
 
     @view_config(context=CRUD, name="listing", renderer="crud/listing.html", permission="view")
@@ -227,13 +468,18 @@ class Listing(CRUDView):
 
         query = self.get_query()
         query = self.order_query(query)
+        if self.projection:
+            query = self.apply_projection(query, columns)
+        query = self.apply_relationship_loading(query, columns)
         base_template = self.base_template
 
         # This is to support breadcrums with titled views
         current_view_name = self.get_title()
 
         title = self.get_title()
-        count = self.get_count(query)
+
+        # With window_count the count is filled in by paginate()
+        count = None if self.window_count else self.get_count(query)
 
         # Base listing template variables
         template_context = {
@@ -244,26 +490,67 @@ class Listing(CRUDView):
             "crud": crud,
             "columns": columns,
             "resource_buttons": self.get_resource_buttons(),
+            "bulk_actions": self.get_bulk_actions(),
             "base_template": base_template,
             "view": self,
         }
 
+        query_counter = None
+        if asbool(self.request.registry.settings.get("websauna.debug_listing_queries", False)):
+            query_counter = self.watch_query_count(template_context)
+
         # Include pagination template context
         self.paginate(template_context)
 
+        if query_counter:
+            query_counter["listing"] = query_counter["queries"]
+
         return template_context
 
+    @view_config(context=CRUD, name="bulk", request_method="POST", permission="view")
+    def bulk(self):
+        """Perform a bulk action on the selected rows or on all rows matching the listing query.
+
+        The action must be one of :py:meth:`get_bulk_actions`. The query string of the listing is carried over, so that the listing filters apply.
+        """
+        request = self.request
+        check_csrf_token(request)
+
+        actions = {a.id: a for a in self.get_bulk_actions()}
+        action = actions.get(request.POST.get("action"))
+        if not action:
+            raise HTTPBadRequest("Unknown bulk action")
+
+        if request.POST.get("select_all"):
+            ids = None
+        else:
+            ids = self.get_bulk_ids()
+            if not ids:
+                messages.add(request, kind="warning", msg="No items selected.", msg_id="msg-bulk-no-items")
+                return HTTPFound(request.resource_url(self.context, "listing", query=request.GET))
+
+        query = self.get_query()
+        count, scheduled = action.perform(request, query, ids, listing_ref=self.get_listing_ref())
+
+        if scheduled:
+            msg = "{} for {} items scheduled.".format(action.name, count)
+        else:
+            msg = "{} done for {} items.".format(action.name, count)
+        messages.add(request, kind="success", msg=msg, msg_id="msg-bulk-action-done")
+
+        return HTTPFound(request.resource_url(self.context, "listing", query=request.GET))
+
 
 class CSVListing(Listing):
     """A listing view that exports the listing table as CSV.
 
     CSVListing users the same :py:class:`Table` structure to define the listing as the listing HTML page. For columns, we use only id and :py:meth:`websauna.system.crud.listing.Column.get_value` to stringify entries from SQLAlchemy model attributes to CSV writer stream.
 
-    For example usage see :py:class:`websauna.system.user.adminviews.UserCSVListing`.
+    The export is streamed to the client in chunks of :py:attr:`buffered_rows` rows. Rows are read through a server-side cursor on a dedicated read-only database connection, which is independent of the request transaction managed by pyramid_tm. Thus, the memory usage stays constant regardless of the export size and the download starts immediately.
 
-    .. note ::
+    Because the rows are loaded in batches with ``yield_per()``, the listing query must not use joined eager loading of collections.
 
-        This is TODO, having pyramid_tm issue open https://github.com/Pylons/pyramid_tm/issues/56
+    For example usage see :py:class:`websauna.system.user.adminviews.UserCSVListing`.
 
     Original implementation in https://github.com/nandoflorestan/bag/blob/master/bag/spreadsheet/csv.py by Nando Florestan.
     """
@@ -271,56 +558,202 @@ class CSVListing(Listing):
     #: How many rows we buffer in a chunk before writing into a response
     buffered_rows = 100
 
-    @view_config(context=CRUD, name="csv-export", permission='view')
-    def listing(self):
-        """Listing core."""
+    #: Transaction isolation level of the export connection. A repeatable read gives the export a consistent snapshot of the database.
+    isolation_level = "REPEATABLE READ"
 
-        table = self.table
-        columns = table.get_columns()
-        query = self.get_query()
-        query = self.order_query(query)
+    #: Exports with more rows than this, as counted by :py:attr:`count_strategy`, are written by a background Celery task instead of a web worker. ``None`` disables automatic background exports. ``?background=1`` query parameter always starts a background export. See :py:mod:`websauna.system.crud.export`.
+    background_threshold = None
 
-        file_title = slugify(self.context.title)
-        encoding = "utf-8"
+    #: How often, in rows, a background export reports its progress to Redis
+    progress_rows = 5000
 
-        response = Response()
-        response.headers["Content-Type"] = "text/csv; charset={}".format(encoding)
-        response.headers["Content-Disposition"] = "attachment;filename={filename}.{encoding}.csv".format(
-            filename=file_title,
-            encoding=encoding
-        )
+    def open_export_session(self) -> t.Tuple[Connection, Session]:
+        """Open a dedicated database connection and session for reading the export rows.
+
+        :return: Tuple (connection, session). The connection is in a read-only transaction that the caller must close.
+        """
+        engine = self.context.get_dbsession().get_bind()
+        connection = engine.connect()
+
+        if engine.dialect.name == "postgresql":
+            connection = connection.execution_options(isolation_level=self.isolation_level)
+            connection.begin()
+            connection.execute("SET TRANSACTION READ ONLY")
+        else:
+            connection.begin()
+
+        session = Session(bind=connection)
+        return connection, session
+
+    def generate_csv_data(self, query: Query, columns: t.List, encoding: str, progress: t.Optional[t.Callable[[int], None]] = None) -> t.Iterable[bytes]:
+        """Iterate the CSV export in encoded chunks.
 
+        :param query: Listing query
+        :param columns: Table columns to export
+        :param encoding: Character encoding of the output
+        :param progress: Called with the number of rows written so far after each chunk
+        """
         buf = StringIO()
         writer = csv.writer(buf)
-        view = self
+        buffered_rows = self.buffered_rows
 
-        def generate_csv_data():
+        def flush():
+            data = buf.getvalue().encode(encoding)
+            buf.seek(0)
+            buf.truncate()
+            return data
 
+        connection, session = self.open_export_session()
+        idx = 0
+        try:
             # Write headers
             writer.writerow([c.id for c in columns])
 
-            # Write each listing item
-            for idx, model_instance in enumerate(query):
+            # yield_per() turns on stream_results, which makes psycopg2 to use a server-side cursor
+            for idx, model_instance in enumerate(query.with_session(session).yield_per(buffered_rows), start=1):
 
                 # Extract column values for this row
-                values = [c.get_value(view, model_instance) for c in columns]
-
+                values = [c.get_value(self, model_instance) for c in columns]
                 writer.writerow(values)
-                # if idx % buffered_rows == 0:
-                #    yield buf.getvalue().encode(encoding)
-                #    buf.truncate(0)  # But in Python 3, truncate() does not move
-                #    buf.seek(0)  # the file pointer, so we seek(0) explicitly.
 
-            # yield buf.getvalue().encode(encoding)
+                if idx % buffered_rows == 0:
+                    yield flush()
+                    if progress:
+                        progress(idx)
+
+            yield flush()
+            if progress:
+                progress(idx)
+        finally:
+            session.close()
+            connection.close()
+
+    def get_export_query(self, columns: t.List) -> Query:
+        """Build the query for the exported rows."""
+        query = self.get_query()
+        query = self.order_query(query)
+        if self.projection:
+            query = self.apply_projection(query, columns)
+        return self.apply_relationship_loading(query, columns)
+
+    def get_export_filename(self, encoding: str) -> str:
+        """Get the download file name."""
+        return "{filename}.{encoding}.csv".format(filename=slugify(self.context.title), encoding=encoding)
+
+    def start_export_job(self, query: Query, encoding: str) -> Response:
+        """Schedule a background export and redirect to its status page."""
+        # Celery is an optional dependency
+        from .tasks import csv_export
+
+        request = self.request
+        job_id = export.create_export_job(request, self.get_export_filename(encoding), self.get_count(query))
+
+        route_name = request.matched_route.name if request.matched_route else None
+        path = export.get_traverse_path(request, self.context)
+        params = [(k, v) for k, v in request.GET.items() if k != "background"]
+        user_id = request.user.id if request.user else None
+        csv_export.apply_async(args=(job_id, user_id, get_qual_name(self.__class__), route_name, path, params, encoding), tm=request.tm)
+
+        return HTTPFound(request.resource_url(self.context, "csv-export-status", query={"job": job_id}))
+
+    def write_export(self, job_id: str, encoding: str = "utf-8"):
+        """Write a background export to the spool directory. Called by the Celery task.
+
+        :param job_id: Job id from :py:func:`websauna.system.crud.export.create_export_job`
+        :param encoding: Character encoding of the output
+        """
+        registry = self.request.registry
+        columns = self.table.get_columns()
+        query = self.get_export_query(columns)
+
+        path = export.get_export_path(registry, job_id)
+        temp_path = path + ".part"
+        written = {"rows": 0, "reported": 0}
+
+        def progress(rows):
+            written["rows"] = rows
+            if rows - written["reported"] >= self.progress_rows:
+                export.update_export_job(registry, job_id, {"rows": rows})
+                written["reported"] = rows
+
+        export.update_export_job(registry, job_id, {"status": "running"})
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in self.generate_csv_data(query, columns, encoding, progress=progress):
+                    f.write(chunk)
+            os.rename(temp_path, path)
+        except Exception:
+            logger.exception("Background export %s failed", job_id)
+            export.update_export_job(registry, job_id, {"status": "failed"})
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        export.update_export_job(registry, job_id, {"status": "done", "rows": written["rows"]})
+
+    def get_export_job(self) -> dict:
+        """Get the background export job of the current user from ``job`` query parameter.
+
+        :raise HTTPNotFound: If the job does not exist, has expired or belongs to someone else
+        """
+        job_id = self.request.GET.get("job", "")
+        job = export.get_export_job(self.request.registry, job_id) if job_id.isalnum() else None
+        user = self.request.user
+        if not job or job["user_id"] != str(user.id if user else ""):
+            raise HTTPNotFound()
+        return job
+
+    @view_config(context=CRUD, name="csv-export", permission='view')
+    def listing(self):
+        """Listing core."""
+
+        table = self.table
+        columns = table.get_columns()
+        query = self.get_export_query(columns)
+
+        encoding = "utf-8"
+
+        background = asbool(self.request.GET.get("background", False))
+        if not background and self.background_threshold is not None:
+            background = self.get_count(query) > self.background_threshold
+
+        if background:
+            return self.start_export_job(query, encoding)
+
+        response = Response()
+        response.headers["Content-Type"] = "text/csv; charset={}".format(encoding)
+        response.headers["Content-Disposition"] = "attachment;filename={}".format(self.get_export_filename(encoding))
+
+        response.app_iter = self.generate_csv_data(query, columns, encoding)
+        return response
+
+    @view_config(context=CRUD, name="csv-export-status", renderer="crud/export_status.html", permission='view')
+    def export_status(self):
+        """Show the progress of a background export and the download link once it is done."""
+        job = self.get_export_job()
+        title = "Exporting {}".format(self.context.title)
+        return {
+            "title": title,
+            "current_view_name": title,
+            "job": job,
+            "crud": self.context,
+            "base_template": self.base_template,
+            "view": self,
+        }
+
+    @view_config(context=CRUD, name="csv-export-download", permission='view')
+    def export_download(self):
+        """Serve the file of a finished background export."""
+        job = self.get_export_job()
+        if job["status"] != "done":
+            raise HTTPNotFound()
 
-            # Abort the transaction, otherwise it might not be closed by underlying machinery
-            # (at least tests hang)
-            # TODO: Confirm this behavior with pyramid_tm 2.0 when it's out
-            # request.tm.abort()
+        path = export.get_export_path(self.request.registry, job["id"])
+        if not os.path.exists(path):
+            raise HTTPNotFound()
 
-        # TODO: This use to be response.app_iter, but apparently it doesn't place nicely with pyramid_tm
-        generate_csv_data()
-        response.body = buf.getvalue().encode(encoding)
+        response = FileResponse(path, request=self.request, content_type="text/csv")
+        response.headers["Content-Disposition"] = "attachment;filename={}".format(job["filename"])
         return response
 
 
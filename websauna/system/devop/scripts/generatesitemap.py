@@ -0,0 +1,34 @@
+"""ws-generate-sitemap script.
+
+Build the sitemap and write it to ``websauna.sitemap_dir`` folder.
+"""
+# Standard Library
+import sys
+import typing as t
+
+# Websauna
+from websauna.system.core.sitemapstore import generate_sitemap
+from websauna.system.devop.cmdline import init_websauna
+from websauna.system.devop.scripts import feedback_and_exit
+from websauna.system.devop.scripts import get_config_uri
+from websauna.system.devop.scripts import usage_message
+
+
+def main(argv: t.List[str] = sys.argv):
+    """Build the sitemap and write it to disk.
+
+    :param argv: Command line arguments, second one needs to be the uri to a configuration file.
+    :raises sys.SystemExit:
+    """
+    if len(argv) < 2:
+        usage_message(argv)
+
+    config_uri = get_config_uri(argv)
+    request = init_websauna(config_uri)
+    with request.tm:
+        count = generate_sitemap(request)
+    feedback_and_exit('ws-generate-sitemap: Wrote sitemap with {} URLs'.format(count), 0, True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""ws-purge-sessions script.
+
+Delete old sessions and sessions of disabled users from Redis.
+"""
+# Standard Library
+import sys
+import typing as t
+
+# Websauna
+from websauna.system.core.sessionpurge import purge_sessions
+from websauna.system.devop.cmdline import init_websauna
+from websauna.system.devop.scripts import feedback_and_exit
+from websauna.system.devop.scripts import get_config_uri
+from websauna.system.devop.scripts import usage_message
+
+
+def main(argv: t.List[str] = sys.argv):
+    """Purge sessions.
+
+    :param argv: Command line arguments, second one needs to be the uri to a configuration file.
+    :raises sys.SystemExit:
+    """
+    if len(argv) < 2:
+        usage_message(argv)
+
+    config_uri = get_config_uri(argv)
+    request = init_websauna(config_uri)
+    with request.tm:
+        stats = purge_sessions(request)
+
+    feedback_and_exit('ws-purge-sessions: {}'.format(stats), 0, True)
@@ -0,0 +1,441 @@
+"""Rate limiter algorithms using Redis.
+
+:py:mod:`websauna.system.form.throttle` can count hits with different algorithms:
+
+``rolling``
+    Exact rolling time window using a Redis sorted set, see :py:mod:`websauna.system.form.rollingwindow`. Stores one entry per hit, so memory use and check cost grow with the limit. This is the default.
+
+``gcra``
+    Generic cell rate algorithm, equal to a token bucket of ``limit`` tokens refilled over ``window`` seconds. Stores one float per key. Allows bursts of up to ``limit`` hits.
+
+``sliding``
+    Sliding window counter. Counts hits in the current and the previous fixed window and weights the previous count by how much of it still overlaps the rolling window. Stores three integers per key. The count is an approximation which assumes hits of the previous window were evenly distributed.
+
+Each check is one atomic Lua script call. Hits over the limit are not counted by ``gcra`` and ``sliding`` limiters, so a client hammering the endpoint gets through again as soon as the rate drops.
+
+Pick an algorithm by name with ``limiter`` argument of :py:func:`websauna.system.form.throttle.throttled_view` and :py:func:`websauna.system.form.throttle.create_throttle_validator`, or as the third part of a throttle setting string, e.g. ``50/3600/gcra``.
+
+Redis calls go through a :py:class:`CircuitBreaker`. When Redis fails or is slower than ``websauna.throttle_latency_budget`` several times in a row, hits are counted by :py:class:`LocalTokenBucketLimiter` inside each worker process until Redis has recovered. Rate limiter calls use their own Redis connection pool, see :py:func:`get_limiter_redis`, with the latency budget as the socket timeout. A stalled Redis raises :py:class:`redis.exceptions.TimeoutError` instead of blocking the request, and the timeout counts as a failure.
+"""
+# Standard Library
+import logging
+import math
+import threading
+import time
+import typing as t
+from collections import OrderedDict
+
+# Pyramid
+from pyramid.registry import Registry
+
+from redis import StrictRedis
+from redis.exceptions import RedisError
+
+# Websauna
+from websauna.system.core.redis import create_redis
+from websauna.system.core.redis import get_redis
+
+from . import rollingwindow
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitStatus:
+    """Outcome of a rate limiter check."""
+
+    __slots__ = ("limited", "limit", "remaining", "reset_after", "retry_after")
+
+    def __init__(self, limited: bool, limit: int, remaining: int, reset_after: float, retry_after: float = 0.0):
+        #: Was the hit over the limit
+        self.limited = limited
+
+        #: Allowed hits per window
+        self.limit = limit
+
+        #: How many more hits are allowed now
+        self.remaining = remaining
+
+        #: Seconds until the full limit is available again
+        self.reset_after = reset_after
+
+        #: Seconds until the next hit is allowed, zero if not limited
+        self.retry_after = retry_after
+
+    def __repr__(self):
+        return "<RateLimitStatus limited:{} limit:{} remaining:{} reset_after:{:.3f} retry_after:{:.3f}>".format(self.limited, self.limit, self.remaining, self.reset_after, self.retry_after)
+
+
+class Limiter:
+    """Base class for rate limiter algorithms."""
+
+    #: Name used to pick this limiter in settings
+    name = None
+
+    #: Lua script doing the check, if any
+    script = None
+
+    def __init__(self):
+        self._script = None
+
+    def call_script(self, redis: StrictRedis, keys: list, args: list):
+        """Run :py:attr:`script` with one round trip once it has been loaded to the server."""
+        if self._script is None:
+            self._script = redis.register_script(self.script)
+        return self._script(keys=keys, args=args, client=redis)
+
+    def hit(self, redis: StrictRedis, key: str, limit: int, window: float) -> RateLimitStatus:
+        """Record a hit unless over the limit.
+
+        :param redis: Redis client
+        :param key: Redis key of the counter
+        :param limit: Allowed hits per window
+        :param window: Time window in seconds
+        """
+        raise NotImplementedError()
+
+
+class RollingWindowLimiter(Limiter):
+    """Exact rolling window using :py:mod:`websauna.system.form.rollingwindow`."""
+
+    name = "rolling"
+
+    def hit(self, redis: StrictRedis, key: str, limit: int, window: float) -> RateLimitStatus:
+        count = rollingwindow._hit(redis, key, window)
+        limited = count > limit
+        # Without reading the oldest hit we only know the whole window has passed by then
+        return RateLimitStatus(limited, limit, max(0, limit - count), window, window if limited else 0.0)
+
+
+class GCRALimiter(Limiter):
+    """Generic cell rate algorithm, a token bucket storing only the theoretical arrival time."""
+
+    name = "gcra"
+
+    #: ARGV is current time, emission interval and burst tolerance. Returns allowed flag and seconds until the key is empty or the next hit is allowed.
+    script = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local tolerance = tonumber(ARGV[3])
+local tat = tonumber(redis.call("GET", key)) or now
+if tat < now then
+    tat = now
+end
+local new_tat = tat + interval
+local allow_at = new_tat - tolerance
+if now < allow_at then
+    return {0, tostring(tat - now), tostring(allow_at - now)}
+end
+redis.call("SET", key, tostring(new_tat), "PX", math.ceil((new_tat - now) * 1000))
+return {1, tostring(new_tat - now), "0"}
+"""
+
+    def hit(self, redis: StrictRedis, key: str, limit: int, window: float) -> RateLimitStatus:
+        interval = window / limit
+        allowed, reset_after, retry_after = self.call_script(redis, [key], [time.time(), interval, window])
+        reset_after = float(reset_after)
+        # Tokens left in the bucket, with tolerance for float rounding
+        remaining = max(0, int(math.floor((window - reset_after) / interval + 1e-6)))
+        return RateLimitStatus(not allowed, limit, remaining, reset_after, float(retry_after))
+
+
+class SlidingWindowCounterLimiter(Limiter):
+    """Approximated rolling window from the counts of the current and the previous fixed windows."""
+
+    name = "sliding"
+
+    #: ARGV is current window index, limit, weight of the previous window and key TTL. Returns allowed flag, weighted count and previous window count.
+    script = """
+local key = KEYS[1]
+local index = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local weight = tonumber(ARGV[3])
+local state = redis.call("HMGET", key, "i", "c", "p")
+local stored = tonumber(state[1])
+local current = tonumber(state[2]) or 0
+local previous = tonumber(state[3]) or 0
+if stored == nil or stored < index - 1 then
+    current = 0
+    previous = 0
+elseif stored == index - 1 then
+    previous = current
+    current = 0
+else
+    index = stored
+end
+local count = previous * weight + current
+if count + 1 > limit then
+    return {0, tostring(count), tostring(previous)}
+end
+redis.call("HMSET", key, "i", index, "c", current + 1, "p", previous)
+redis.call("EXPIRE", key, ARGV[4])
+return {1, tostring(count + 1), tostring(previous)}
+"""
+
+    def hit(self, redis: StrictRedis, key: str, limit: int, window: float) -> RateLimitStatus:
+        now = time.time()
+        index = int(now // window)
+        elapsed = now - index * window
+        weight = 1 - elapsed / window
+        left_in_window = window - elapsed
+
+        # Counters live for the current and the next window
+        ttl = max(1, math.ceil(2 * window))
+        allowed, count, previous = self.call_script(redis, [key], [index, limit, weight, ttl])
+        count = float(count)
+        previous = float(previous)
+
+        retry_after = 0.0
+        if not allowed:
+            retry_after = left_in_window
+            if previous:
+                # When enough of the previous window has slid out
+                retry_after = min(retry_after, (count + 1 - limit) * window / previous)
+
+        # Hits of the current window are weighted down to zero by the end of the next window
+        reset_after = left_in_window + window if count else 0.0
+        remaining = max(0, int(limit - count))
+        return RateLimitStatus(not allowed, limit, remaining, reset_after, retry_after)
+
+
+class LocalTokenBucketLimiter(Limiter):
+    """Token bucket kept in the memory of the current process.
+
+    Used as the fallback when Redis is not available. Each worker process counts its own hits, so the effective limit of the site is the limit times the number of worker processes.
+    """
+
+    name = "local"
+
+    def __init__(self, max_keys: int = 10000):
+        """
+        :param max_keys: Number of buckets to keep. Least recently used buckets are dropped first.
+        """
+        super().__init__()
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def hit(self, redis: t.Optional[StrictRedis], key: str, limit: int, window: float) -> RateLimitStatus:
+        rate = limit / window
+        now = time.monotonic()
+
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                tokens = float(limit)
+            else:
+                tokens = min(float(limit), bucket[0] + (now - bucket[1]) * rate)
+                self.buckets.move_to_end(key)
+
+            limited = tokens < 1
+            if not limited:
+                tokens -= 1
+
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+
+        retry_after = (1 - tokens) / rate if limited else 0.0
+        return RateLimitStatus(limited, limit, int(tokens), (limit - tokens) / rate, retry_after)
+
+
+class CircuitBreaker:
+    """Stop calling a failing service for a while.
+
+    The circuit is closed when the service works. After ``failure_threshold`` consecutive failures or calls slower than ``latency_budget`` the circuit opens and calls go to the fallback. After ``reset_timeout`` seconds one call is let through to test the service. If it succeeds the circuit closes again, otherwise it stays open for another ``reset_timeout``.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0, latency_budget: t.Optional[float] = None, errors: t.Tuple[type, ...] = (RedisError,)):
+        """
+        :param failure_threshold: Consecutive failures to open the circuit
+        :param reset_timeout: Seconds to wait before testing the service again
+        :param latency_budget: Calls taking longer than this many seconds count as failures. The result of a slow call is still used.
+        :param errors: Exceptions counted as failures
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency_budget = latency_budget
+        self.errors = errors
+
+        #: Current state
+        self.state = self.CLOSED
+
+        #: Consecutive failures
+        self.failures = 0
+
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Can the service be called now."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN and time.monotonic() >= self.opened_at + self.reset_timeout:
+                # Let one trial call through
+                self.state = self.HALF_OPEN
+                return True
+
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                logger.info("Circuit closed, service recovered")
+                self.state = self.CLOSED
+
+    def record_failure(self, reason: str):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                logger.warning("Circuit opened for %s seconds: %s", self.reset_timeout, reason)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def call(self, func: t.Callable[[], object], fallback: t.Callable[[], object]):
+        """Call the service, or the fallback if the circuit is open or the call fails."""
+        if not self.allow():
+            return fallback()
+
+        started = time.monotonic()
+        try:
+            result = func()
+        except self.errors as e:
+            self.record_failure(repr(e))
+            return fallback()
+        except Exception as e:
+            # Do not leave a half-open circuit waiting for a trial call which never completes
+            self.record_failure(repr(e))
+            raise
+
+        duration = time.monotonic() - started
+        if self.latency_budget and duration > self.latency_budget:
+            self.record_failure("call took {:.3f} s".format(duration))
+        else:
+            self.record_success()
+
+        return result
+
+
+#: Limiter name -> limiter
+LIMITERS = {
+    "rolling": RollingWindowLimiter(),
+    "gcra": GCRALimiter(),
+    "sliding": SlidingWindowCounterLimiter(),
+    "local": LocalTokenBucketLimiter(),
+}
+
+LIMITERS["token_bucket"] = LIMITERS["gcra"]
+
+
+def get_limiter(limiter: t.Union[str, Limiter]) -> Limiter:
+    """Resolve a limiter by its name.
+
+    :param limiter: Name in :py:data:`LIMITERS` or a limiter instance
+    """
+    if isinstance(limiter, Limiter):
+        return limiter
+
+    try:
+        return LIMITERS[limiter]
+    except KeyError:
+        raise RuntimeError("Unknown rate limiter: {}. Available: {}".format(limiter, ", ".join(sorted(LIMITERS))))
+
+
+def parse_rate(value: str) -> t.Tuple[int, int, t.Optional[str]]:
+    """Parse a rate setting string.
+
+    :param value: ``limit/window_seconds``, optionally followed by ``/limiter``, e.g. ``50/3600`` or ``50/3600/gcra``
+    :return: Tuple (limit, window, limiter name or None)
+    """
+    parts = value.split("/")
+    if len(parts) not in (2, 3):
+        raise RuntimeError("Bad throttle setting format: {}".format(value))
+
+    try:
+        limit = int(parts[0])
+        window = int(parts[1])
+    except ValueError:
+        raise RuntimeError("Could not parse: {}".format(value))
+
+    limiter = parts[2].strip() if len(parts) == 3 else None
+    if limiter:
+        get_limiter(limiter)
+
+    return limit, window, limiter or None
+
+
+def hit(registry, key: str, limit: int, window: float, limiter: t.Union[str, Limiter] = "rolling") -> RateLimitStatus:
+    """Record a hit against a rate limit.
+
+    :param registry: Pyramid registry e.g. request.registry
+    :param key: Redis key name we use to keep counter
+    :param limit: Allowed hits per window
+    :param window: Time window in seconds
+    :param limiter: Algorithm name or instance, see :py:data:`LIMITERS`
+    """
+    limiter = get_limiter(limiter)
+    breaker = get_circuit_breaker(registry)
+    if breaker is None:
+        return limiter.hit(get_redis(registry), key, limit, window)
+
+    return breaker.call(
+        lambda: limiter.hit(get_limiter_redis(registry), key, limit, window),
+        lambda: LIMITERS["local"].hit(None, key, limit, window),
+    )
+
+
+def get_limiter_redis(registry: Registry) -> StrictRedis:
+    """Get the Redis client for rate limiter calls guarded by the circuit breaker.
+
+    The client has its own connection pool to ``redis.sessions.url`` with ``websauna.throttle_latency_budget`` as the socket and connect timeout, so that a stalled Redis fails the call instead of blocking it. Without a latency budget or a connection URL the shared client of :py:func:`websauna.system.core.redis.get_redis` is used.
+    """
+    try:
+        return registry.rate_limit_redis
+    except AttributeError:
+        pass
+
+    settings = registry.settings or {}
+    latency_budget = float(settings.get("websauna.throttle_latency_budget", 0.1))
+    if latency_budget and settings.get("redis.sessions.url"):
+        redis = create_redis(registry, socket_timeout=latency_budget, socket_connect_timeout=latency_budget)
+    else:
+        redis = get_redis(registry)
+
+    registry.rate_limit_redis = redis
+    return redis
+
+
+def get_circuit_breaker(registry: Registry) -> t.Optional[CircuitBreaker]:
+    """Get the circuit breaker guarding rate limiter Redis calls.
+
+    Configured with ``websauna.throttle_breaker_failures``, ``websauna.throttle_breaker_reset_timeout`` and ``websauna.throttle_latency_budget`` settings.
+
+    :return: Circuit breaker or ``None`` if disabled
+    """
+    try:
+        return registry.rate_limit_circuit_breaker
+    except AttributeError:
+        pass
+
+    settings = registry.settings or {}
+    failures = int(settings.get("websauna.throttle_breaker_failures", 3))
+    if failures:
+        latency_budget = float(settings.get("websauna.throttle_latency_budget", 0.1))
+        breaker = CircuitBreaker(
+            failure_threshold=failures,
+            reset_timeout=float(settings.get("websauna.throttle_breaker_reset_timeout", 30)),
+            latency_budget=latency_budget or None,
+        )
+    else:
+        breaker = None
+
+    registry.rate_limit_circuit_breaker = breaker
+    return breaker
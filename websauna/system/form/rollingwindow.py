@@ -72,49 +72,81 @@ More info
 
 * http://redis.io/commands/zadd
 
+* https://redis.io/commands/eval
+
 """
 
 # Standard Library
+import math
+import os
 import time
+import typing as t
+
+from redis import StrictRedis
 
 # Websauna
 from websauna.system.core.redis import get_redis
 
 
-def _check(redis, key, window=60, limit=50):
+#: Record a hit and count hits within the window in one atomic server side operation.
+#: KEYS[1] is the counter key, ARGV is current time, window in seconds and unique member for this hit.
+#: The key expires when no hits have been recorded within the window.
+HIT_SCRIPT = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call("ZREMRANGEBYSCORE", key, "-inf", now - window)
+redis.call("ZADD", key, ARGV[1], ARGV[3])
+redis.call("EXPIRE", key, ARGV[4])
+return redis.call("ZCARD", key)
+"""
+
+#: Lazily registered :py:data:`HIT_SCRIPT`
+_hit_script = None
+
 
-    # Expire old keys (hits)
-    expires = time.time() - window
-    redis.zremrangebyscore(key, '-inf', expires)
+def _hit(redis: StrictRedis, key: str, window: int) -> int:
+    """Record a hit and return the number of hits within the window, including this one."""
+    global _hit_script
+    if _hit_script is None:
+        _hit_script = redis.register_script(HIT_SCRIPT)
 
-    # Add a hit on the very moment
     now = time.time()
-    redis.zadd(key, {str(now): now})
 
-    # If we currently have more keys than limit,
-    # then limit the action
-    if redis.zcard(key) > limit:
-        return True
+    # Random suffix so that simultaneous hits from different processes are not merged
+    member = "{:.6f}-{}".format(now, os.urandom(4).hex())
 
-    return False
+    # The script is sent once and later called by its SHA1 digest, so this is one round trip
+    return _hit_script(keys=[key], args=[now, window, member, max(1, math.ceil(window))], client=redis)
 
 
-def _get(redis, key):
+def _check(redis: StrictRedis, key: str, window=60, limit=50) -> bool:
+
+    # If we currently have more hits than limit,
+    # then limit the action
+    return _hit(redis, key, window) > limit
+
+
+def _get(redis: StrictRedis, key: str, window: t.Optional[int] = None) -> int:
     """ Get the current hits per rolling time window.
 
     :param redis: Redis client
 
     :param key: Redis key name we use to keep counter
 
+    :param window: Count hits within this many last seconds. If not given, count all hits not yet expired.
+
     :return: int, how many hits we have within the current rolling time window
     """
-    return redis.zcard(key)
+    if window is None:
+        return redis.zcard(key)
+    return redis.zcount(key, time.time() - window, "+inf")
 
 
 def check(registry, key, window=60, limit=10):
     """Do a rolling time window counter hit.
 
-    Use ``key`` to store the current hit rate in Redis.
+    Use ``key`` to store the current hit rate in Redis. The hit is recorded and counted with one atomic Redis call, so concurrent requests cannot exceed the limit. The key expires after ``window`` seconds without hits.
 
     :param registry: Pyramid registry e.g. request.registry
     :param key: Redis key name we use to keep counter
@@ -127,14 +159,15 @@ def check(registry, key, window=60, limit=10):
     return _check(redis, key, window, limit)
 
 
-def get(registry, key):
+def get(registry, key, window: t.Optional[int] = None):
     """Get the current hits per rolling time window.
 
-     Use ``key`` to store the current hit rate in Redis.
+    Use ``key`` to store the current hit rate in Redis. Unlike :py:func:`check`, this does not record a hit.
 
     :param registry: Pyramid registry e.g. request.registry
     :param key: Redis key name we use to keep counter
+    :param window: Count hits within this many last seconds. If not given, count all hits not yet expired.
     :return: int, how many hits we have within the current rolling time window
     """
     redis = get_redis(registry)
-    return _check(redis, key)
+    return _get(redis, key, window)
@@ -1,29 +1,160 @@
 """Deform throttling support."""
 # Standard Library
+import hashlib
+import ipaddress
 import logging
+import math
 import typing as t
 
 # Pyramid
 import colander as c
 from pyramid import httpexceptions
+from pyramid.registry import Registry
+from pyramid.settings import aslist
 
 # Websauna
 from websauna.system.core.redis import get_redis
+from websauna.system.core.session import WebsaunaSession
 from websauna.system.http import Request
 
-from . import rollingwindow
+from . import ratelimit
 
 
 logger = logging.getLogger(__name__)
 
 
-def create_throttle_validator(name: str, max_actions_in_time_window: int, time_window_in_seconds: int = 3600):
+#: Maximum number of counters per throttle when clients are throttled separately
+DEFAULT_KEY_BUCKETS = 65536
+
+#: Function returning the client identifier of a request
+KeyFunc = t.Callable[[Request], str]
+
+
+def get_trusted_proxies(registry: Registry) -> t.List[t.Union[ipaddress.IPv4Network, ipaddress.IPv6Network]]:
+    """Get the reverse proxy networks allowed to set ``X-Forwarded-For``.
+
+    Configured with ``websauna.throttle_trusted_proxies`` setting.
+    """
+    try:
+        return registry.throttle_trusted_proxies
+    except AttributeError:
+        pass
+
+    settings = registry.settings or {}
+    proxies = registry.throttle_trusted_proxies = [ipaddress.ip_network(p, strict=False) for p in aslist(settings.get("websauna.throttle_trusted_proxies", ""))]
+    return proxies
+
+
+def _is_trusted(addr: str, proxies: list) -> bool:
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError:
+        return False
+    return any(ip in network for network in proxies)
+
+
+def get_client_addr(request: Request) -> str:
+    """Get the IP address of the client for throttling.
+
+    Unlike :py:attr:`webob.request.BaseRequest.client_addr`, ``X-Forwarded-For`` header is not trusted unless the request comes from a proxy listed in ``websauna.throttle_trusted_proxies``. The header is then read from right to left, skipping trusted proxies, and the first untrusted address is the client. Anything left of it may have been set by the client itself.
+    """
+    addr = request.remote_addr
+    proxies = get_trusted_proxies(request.registry)
+    if not proxies or not _is_trusted(addr, proxies):
+        return addr
+
+    forwarded = request.headers.get("X-Forwarded-For", "")
+    for hop in reversed([hop.strip() for hop in forwarded.split(",") if hop.strip()]):
+        if not _is_trusted(hop, proxies):
+            return hop
+        addr = hop
+
+    return addr
+
+
+def client_ip_key(request: Request) -> str:
+    """Throttle per client IP address, see :py:func:`get_client_addr`."""
+    return "ip:{}".format(get_client_addr(request))
+
+
+def user_key(request: Request) -> str:
+    """Throttle per logged in user, or per client IP address for anonymous users."""
+    user = request.user
+    if user is None:
+        return client_ip_key(request)
+    return "user:{}".format(user.id)
+
+
+def session_key(request: Request) -> str:
+    """Throttle per session, or per client IP address for requests without an existing session.
+
+    A client can drop its session cookie to get a new session on every request, so new sessions are throttled by the client IP address. No session is created for a request without a session cookie.
+    """
+    session = request.session
+    if isinstance(session, WebsaunaSession) and session.cookie_session_id is None:
+        return client_ip_key(request)
+
+    if getattr(session, "session_id", None) is None or session.new:
+        return client_ip_key(request)
+
+    return "session:{}".format(session.session_id)
+
+
+def composite_key(*key_funcs: KeyFunc) -> KeyFunc:
+    """Throttle per combination of client identifiers.
+
+    Example:
+
+    .. code-block:: python
+
+        throttled_view(limit=10, key_func=composite_key(client_ip_key, user_key))
+    """
+    def key_func(request: Request) -> str:
+        return "|".join(f(request) for f in key_funcs)
+    return key_func
+
+
+def get_throttle_key(key_name: str, request: Request, key_func: t.Optional[KeyFunc] = None, key_buckets: t.Optional[int] = DEFAULT_KEY_BUCKETS) -> str:
+    """Get the Redis key of the throttle counter of a client.
+
+    The client identifier is hashed, so that keys have fixed length, and spread over at most ``key_buckets`` counters, so that a flood of spoofed identifiers cannot grow Redis memory usage without bounds. Clients sharing a bucket share the limit.
+
+    :param key_name: Redis key of the throttle
+    :param key_func: Client identifier of a request. If not given, all clients share one counter.
+    :param key_buckets: Maximum number of counters. ``None`` for no limit.
+    """
+    if key_func is None:
+        return key_name
+
+    digest = hashlib.sha1(str(key_func(request)).encode("utf-8")).hexdigest()
+    if key_buckets:
+        digest = str(int(digest[:15], 16) % key_buckets)
+
+    return "{}:{}".format(key_name, digest)
+
+
+def set_rate_limit_headers(headers, status: ratelimit.RateLimitStatus):
+    """Set ``RateLimit-*`` headers, and ``Retry-After`` if limited.
+
+    See https://tools.ietf.org/html/draft-ietf-httpapi-ratelimit-headers
+
+    :param headers: Response headers
+    :param status: Rate limiter check result
+    """
+    headers["RateLimit-Limit"] = str(status.limit)
+    headers["RateLimit-Remaining"] = str(status.remaining)
+    headers["RateLimit-Reset"] = str(int(math.ceil(status.reset_after)))
+    if status.limited:
+        headers["Retry-After"] = str(max(1, int(math.ceil(status.retry_after))))
+
+
+def create_throttle_validator(name: str, max_actions_in_time_window: int, time_window_in_seconds: int = 3600, limiter: t.Union[str, ratelimit.Limiter] = "rolling", key_func: t.Optional[KeyFunc] = None):
     """Creates a Colander form validator which prevents form submissions exceed certain rate.
 
     The benefit of using validator instead of :func:`throttle_view` decorator is that we can give a nice
     Colander form error message instead of an error page.
 
-    Form submissions are throttled system wide. This prevents abuse of the system by flooding it with requests.
+    Form submissions are throttled system wide, unless ``key_func`` is given. This prevents abuse of the system by flooding it with requests.
 
     A logging warning is issued if the rate is exceeded. The user is greeted with an error message telling the submission is not possible at the moment.
 
@@ -50,6 +181,10 @@ def create_throttle_validator(name: str, max_actions_in_time_window: int, time_w
 
     :param time_window_in_seconds: Time in window in seconds. Default one hour, 3600 seconds.
 
+    :param limiter: Rate limiting algorithm, see :py:mod:`websauna.system.form.ratelimit`. Default ``rolling``.
+
+    :param key_func: Throttle each client separately. E.g. :py:func:`client_ip_key`, :py:func:`user_key`, :py:func:`session_key`.
+
     :return: Function to be passed to ``validator`` Colander schema construction parameter.
     """
 
@@ -62,7 +197,8 @@ def create_throttle_validator(name: str, max_actions_in_time_window: int, time_w
 
         def inner(node, value):
             # Check we don't have many invites going out
-            if rollingwindow.check(request.registry, "throttle_" + name, window=time_window_in_seconds, limit=limit):
+            key = get_throttle_key("throttle_" + name, request, key_func)
+            if ratelimit.hit(request.registry, key, limit, time_window_in_seconds, limiter).limited:
 
                 # Alert devops through Sentry
                 logger.warning("Excessive form submissions on %s", name)
@@ -75,35 +211,30 @@ def create_throttle_validator(name: str, max_actions_in_time_window: int, time_w
     return throttle_validator
 
 
-def _read_throttle_settings(settings, setting):
+def _read_throttle_settings(settings, setting) -> t.Tuple[int, int, t.Optional[str]]:
 
     setting_value = settings.get(setting)
     if not setting_value:
         raise RuntimeError("Cannot read setting: {}".format(setting))
 
-    parts = setting_value.split("/")
-    if len(parts) != 2:
-        raise RuntimeError("Bad throttle setting format: {}".format(setting_value))
-
-    try:
-        window = int(parts[0])
-        limit = int(parts[1])
-    except ValueError:
-        raise RuntimeError("Could not parse: {}".format(setting_value))
-
-    return limit, window
+    return ratelimit.parse_rate(setting_value)
 
 
 def throttled_view(
         rolling_window_id: t.Optional[str] = None,
         time_window_in_seconds: int = 3600,
         limit: int = 50,
-        setting: t.Optional[str] = None):
+        setting: t.Optional[str] = None,
+        limiter: t.Union[str, ratelimit.Limiter] = "rolling",
+        key_func: t.Optional[KeyFunc] = None,
+        key_buckets: t.Optional[int] = DEFAULT_KEY_BUCKETS):
     """Decorate a view to protect denial-of-service attacks using throttling.
 
-    If the global throttling limit is exceeded the client gets HTTP 429 error.
+    If the global throttling limit is exceeded the client gets HTTP 429 error. With ``key_func`` each client has its own limit.
+
+    Responses carry ``RateLimit-Limit``, ``RateLimit-Remaining`` and ``RateLimit-Reset`` headers. HTTP 429 responses also tell when to try again in ``Retry-After`` header.
 
-    Internally we use :py:mod:`websauna.system.form.rollingwindow` hit counting implementation.
+    By default :py:mod:`websauna.system.form.rollingwindow` hit counting implementation is used. For high limits pick a limiter using constant memory, see :py:mod:`websauna.system.form.ratelimit`.
 
     Example that allows 30 page loads per hour:
 
@@ -124,6 +255,9 @@ def throttled_view(
 
         magiclogin.email_throttle = 50/3600
 
+        # Or with a token bucket
+        magiclogin.email_throttle = 50/3600/gcra
+
     .. code-block:: python
 
         @view_config(
@@ -133,13 +267,29 @@ def throttled_view(
         def new_phone_number(request):
             # ... code goes here ...
 
+    Example that allows 5 login attempts per minute from an IP address:
+
+    .. code-block:: python
+
+        @view_config(
+            name="login",
+            decorator=throttled_view(limit=5, time_window_in_seconds=60, key_func=client_ip_key))
+        def login(request):
+            # ... code goes here ...
+
     :param rolling_window_id: The Redis key name used to store throttle state. If not given a key derived from view name is used.
 
     :param time_window_in_seconds: Sliding time window for counting hits
 
     :param limit: Allowed number of hits in the given time window
 
-    :param setting: Read throttle information from a INI settings. In this case string must be in format limit/time_window_seconds. Example: 50/3600. This overrides any given time and limit argument.
+    :param setting: Read throttle information from a INI settings. In this case string must be in format limit/time_window_seconds, optionally followed by /limiter. Example: 50/3600. This overrides any given time, limit and limiter argument.
+
+    :param limiter: Rate limiting algorithm name, one of ``rolling``, ``gcra`` or ``sliding``. See :py:mod:`websauna.system.form.ratelimit`. Default ``rolling``.
+
+    :param key_func: Throttle each client separately. Takes request and returns a client identifier, e.g. :py:func:`client_ip_key`, :py:func:`user_key`, :py:func:`session_key` or :py:func:`composite_key`.
+
+    :param key_buckets: Maximum number of per-client counters, see :py:func:`get_throttle_key`
 
     :raise: :py:class:`pyramid.httpexceptions.HTTPTooManyRequests` if the endpoint gets hammered too much
     """
@@ -156,14 +306,22 @@ def throttled_view(
         def inner(context, request):
 
             if setting:
-                hits, window = _read_throttle_settings(request.registry.settings, setting)
+                hits, window, algorithm = _read_throttle_settings(request.registry.settings, setting)
+                algorithm = algorithm or limiter
             else:
                 window = time_window_in_seconds
                 hits = limit
+                algorithm = limiter
+
+            key = get_throttle_key(key_name, request, key_func, key_buckets)
+            status = ratelimit.hit(request.registry, key, hits, window, algorithm)
 
-            if rollingwindow.check(request.registry, key_name, window=window, limit=hits):
-                raise httpexceptions.HTTPTooManyRequests("Too many requests against {}".format(name))
+            if status.limited:
+                e = httpexceptions.HTTPTooManyRequests("Too many requests against {}".format(name))
+                set_rate_limit_headers(e.headers, status)
+                raise e
 
+            request.add_response_callback(lambda request, response: set_rate_limit_headers(response.headers, status))
             return view_callable(context, request)
 
         return inner
@@ -171,7 +329,7 @@ def throttled_view(
     return outer
 
 
-def clear_throttle(request: Request, key_name: str):
+def clear_throttle(request: Request, key_name: str, key_func: t.Optional[KeyFunc] = None, key_buckets: t.Optional[int] = DEFAULT_KEY_BUCKETS):
     """Clear the throttling status.
 
     Example:
@@ -180,6 +338,8 @@ def clear_throttle(request: Request, key_name: str):
 
         clear_throttle(request, "new-phone-number")
 
+    :param key_func: Clear the counter of the client of ``request`` of a per-client throttle
+    :param key_buckets: Same as given to :py:func:`throttled_view`
     """
     redis = get_redis(request)
-    redis.delete("throttle_{}".format(key_name))
+    redis.delete(get_throttle_key("throttle_{}".format(key_name), request, key_func, key_buckets))
@@ -42,6 +42,8 @@ from websauna.utils.time import now
 def kill_user_sessions(request: Request, user: IUser, operation: str):
     """Notify session to drop this user.
 
+    The default :py:func:`websauna.system.auth.subscribers.user_auth_details_changes` handler deletes all sessions of the user.
+
     :param request: Pyramid request.
     :param user: User.
     :param operation: Operation triggering the killing of user sessions.
@@ -354,6 +356,9 @@ class UserDelete(admin_views.Delete):
 class GroupListing(admin_views.Listing):
     """Listing view for Groups."""
 
+    # Do not load group_data JSON
+    projection = True
+
     table = listing.Table(
         columns=[
             listing.Column("id", "Id",),
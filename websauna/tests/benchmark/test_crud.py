@@ -0,0 +1,205 @@
+"""Benchmark CRUD admin views against realistic amounts of data.
+
+The benchmarks are excluded from the default test run. They need a PostgreSQL test database and `pytest-benchmark <https://pytest-benchmark.readthedocs.io/>`_. Run with:
+
+.. code-block:: console
+
+    py.test --ini=websauna/conf/test.ini -m benchmark websauna/tests/benchmark
+
+Choose a data size with ``-k``, e.g. ``-k rows10k``. Besides the latency, each benchmark reports the number of SQL statements and the peak Python memory allocation of one view call in ``extra_info`` of ``--benchmark-json`` output.
+"""
+# Standard Library
+import json
+import tracemalloc
+import typing as t
+
+# Pyramid
+import transaction
+from pyramid.renderers import render
+
+# SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy import text
+
+import pytest
+
+# Websauna
+from websauna.system.admin.utils import get_admin_resource_for_sqlalchemy_object
+from websauna.system.http.utils import make_routable_request
+from websauna.system.user.adminviews import UserCSVListing
+from websauna.system.user.adminviews import UserEdit
+from websauna.system.user.adminviews import UserListing
+from websauna.system.user.adminviews import UserShow
+from websauna.system.user.models import User
+from websauna.system.user.usermixin import DEFAULT_USER_DATA
+from websauna.tests.fixtures import create_test_dbsession
+
+
+pytest.importorskip("pytest_benchmark")
+
+pytestmark = pytest.mark.benchmark(group="crud")
+
+
+#: Seeded user counts and their test ids
+SIZES = [
+    pytest.param(10000, id="rows10k"),
+    pytest.param(100000, id="rows100k"),
+    pytest.param(1000000, id="rows1m"),
+]
+
+#: One group for this many users
+USERS_PER_GROUP = 1000
+
+SEED_USERS = """
+INSERT INTO users (uuid, username, email, created_at, enabled, user_data, last_auth_sensitive_operation_at)
+SELECT
+    gen_random_uuid(),
+    'user' || i,
+    'user' || i || '@example.com',
+    now() - i * interval '1 minute',
+    true,
+    CAST(:user_data AS jsonb),
+    now()
+FROM generate_series(1, :size) AS i
+"""
+
+SEED_GROUPS = """
+INSERT INTO "group" (uuid, name, created_at, group_data)
+SELECT gen_random_uuid(), 'group' || i, now(), '{}'
+FROM generate_series(1, :count) AS i
+"""
+
+SEED_MEMBERSHIPS = """
+INSERT INTO usergroup (user_id, group_id)
+SELECT users.id, "group".id
+FROM users JOIN "group" ON "group".name = 'group' || (users.id % :count + 1)
+"""
+
+
+@pytest.fixture(scope="module", params=SIZES)
+def seeded_dbsession(request, app):
+    """A database with users and groups. Seeded once per data size, as inserting a million rows takes a while."""
+    dbsession = create_test_dbsession(request, app.initializer.config.registry)
+    engine = dbsession.get_bind()
+    if engine.dialect.name != "postgresql":
+        pytest.skip("Benchmarks need PostgreSQL")
+
+    size = request.param
+    group_count = max(1, size // USERS_PER_GROUP)
+
+    with engine.begin() as connection:
+        connection.execute(text(SEED_USERS), user_data=json.dumps(DEFAULT_USER_DATA), size=size)
+        connection.execute(text(SEED_GROUPS), count=group_count)
+        connection.execute(text(SEED_MEMBERSHIPS), count=group_count)
+
+    # Give the query planner statistics, as a production database would have
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute("ANALYZE")
+
+    return dbsession
+
+
+def measure(benchmark, dbsession, registry, func, rounds: int = 5):
+    """Benchmark a view call and record its statement count and peak memory.
+
+    :param func: Called inside a transaction with a fresh request
+    """
+    engine = dbsession.get_bind()
+
+    def run():
+        with transaction.manager:
+            request = make_routable_request(dbsession, registry)
+            request.tm = transaction.manager
+            return func(request)
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    # One instrumented run outside of timing
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    tracemalloc.start()
+    try:
+        run()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+    benchmark.extra_info["queries"] = len(statements)
+    benchmark.extra_info["peak_memory_kb"] = peak // 1024
+
+    benchmark.pedantic(run, rounds=rounds, iterations=1, warmup_rounds=1)
+
+
+def get_user_admin(request):
+    return request.admin["models"]["user"]
+
+
+def get_user_resource(request):
+    """Admin resource for a user in the middle of the table."""
+    user = request.dbsession.query(User).filter_by(username="user5000").one()
+    return get_admin_resource_for_sqlalchemy_object(request.admin, user)
+
+
+def call_view(view_class: type, attr: str, context: object, request, renderer: t.Optional[str] = None):
+    """Call a view the way the router does, rendering the template if it has one."""
+    request.context = context
+    result = getattr(view_class(context, request), attr)()
+    if renderer:
+        return render(renderer, result, request=request)
+    # Consume streamed responses
+    return sum(len(chunk) for chunk in result.app_iter)
+
+
+def test_listing(benchmark, seeded_dbsession, registry):
+    """First page of the user listing."""
+
+    def view(request):
+        return call_view(UserListing, "listing", get_user_admin(request), request, "crud/listing.html")
+
+    measure(benchmark, seeded_dbsession, registry, view)
+
+
+def test_listing_last_page(benchmark, seeded_dbsession, registry):
+    """Last page of the user listing, the worst case for ``OFFSET`` pagination."""
+
+    with transaction.manager:
+        count = seeded_dbsession.query(User).count()
+
+    # Zero based index of the last non-empty page
+    last_page = max(count - 1, 0) // UserListing.paginator.default_size
+
+    def view(request):
+        request.GET["batch_num"] = str(last_page)
+        return call_view(UserListing, "listing", get_user_admin(request), request, "crud/listing.html")
+
+    measure(benchmark, seeded_dbsession, registry, view)
+
+
+def test_show(benchmark, seeded_dbsession, registry):
+    """User show page."""
+
+    def view(request):
+        return call_view(UserShow, "show", get_user_resource(request), request, "crud/show.html")
+
+    measure(benchmark, seeded_dbsession, registry, view)
+
+
+def test_edit(benchmark, seeded_dbsession, registry):
+    """User edit form, including the group vocabulary."""
+
+    def view(request):
+        return call_view(UserEdit, "edit", get_user_resource(request), request, "crud/edit.html")
+
+    measure(benchmark, seeded_dbsession, registry, view)
+
+
+def test_csv_export(benchmark, seeded_dbsession, registry):
+    """Full CSV export of the users."""
+
+    def view(request):
+        return call_view(UserCSVListing, "listing", get_user_admin(request), request)
+
+    measure(benchmark, seeded_dbsession, registry, view, rounds=1)
@@ -0,0 +1,149 @@
+"""Redis cache."""
+# Standard Library
+import datetime
+import threading
+import time
+
+import pytest
+
+# Websauna
+from websauna.system.core.cache import cached
+from websauna.system.core.cache import get_cache
+from websauna.system.core.redis import get_redis
+
+
+#: Calls to cached functions
+calls = []
+
+
+@cached(ttl=60, namespace="test_cache", tags=["sample"])
+def sample(registry, value):
+    calls.append(value)
+    return {"value": value}
+
+
+@pytest.fixture()
+def cache(registry):
+    """Empty cache in a test namespace."""
+    redis = get_redis(registry)
+    for key in redis.keys("test_cache:*"):
+        redis.delete(key)
+    calls.clear()
+    return get_cache(registry, "test_cache")
+
+
+@pytest.mark.parametrize("serializer", ["pickle", "json", "compact"])
+def test_get_set(registry, serializer):
+    """Values are stored and read back."""
+    cache = get_cache(registry, "test_cache", serializer)
+    value = {"a": [1, 2]}
+    if serializer == "compact":
+        value["now"] = datetime.datetime(2020, 1, 1)
+
+    cache.set("foo", value, ttl=60)
+    assert cache.get("foo") == value
+    assert 0 < get_redis(registry).pttl("test_cache:foo") <= 60000
+
+    assert cache.delete("foo")
+    assert cache.get("foo", "missing") == "missing"
+
+
+def test_cached(registry, cache):
+    """Decorated function is called once per arguments."""
+    assert sample(registry, 1) == {"value": 1}
+    assert sample(registry, 1) == {"value": 1}
+    assert sample(registry, 2) == {"value": 2}
+    assert calls == [1, 2]
+
+    sample.invalidate(registry, 1)
+    sample(registry, 1)
+    assert calls == [1, 2, 1]
+
+
+def test_invalidate_tags(registry, cache):
+    """Tagged values are deleted together."""
+    sample(registry, 1)
+    sample(registry, 2)
+    cache.set("untagged", "x", ttl=60)
+
+    assert cache.invalidate_tags("sample") == 2
+    assert cache.get("untagged") == "x"
+
+    sample(registry, 1)
+    assert calls == [1, 2, 1]
+
+
+def test_tag_set_pruned(registry, cache):
+    """Expired keys are removed from a tag set when a value is added to it."""
+    redis = get_redis(registry)
+    for index in range(3):
+        cache.set("short-{}".format(index), index, ttl=0.05, tags=["pruned"])
+    assert redis.zcard("test_cache:tag:pruned") == 3
+
+    time.sleep(0.1)
+    cache.set("long", "x", ttl=60, tags=["pruned"])
+    assert redis.zrange("test_cache:tag:pruned", 0, -1) == [b"test_cache:long"]
+
+
+def test_single_tag_string(registry, cache):
+    """A tag given as a string is not iterated by character."""
+    redis = get_redis(registry)
+
+    @cached(ttl=60, namespace="test_cache", tags="products")
+    def products(registry):
+        return "list"
+
+    products(registry)
+    assert cache.get_or_set("bestsellers", lambda: "top", ttl=60, tags="products") == "top"
+    assert redis.exists("test_cache:tag:products")
+    assert not redis.exists("test_cache:tag:p")
+    assert cache.invalidate_tags("products") == 2
+
+
+def test_invalidate_during_computation(cache):
+    """A value whose tag is invalidated while it is computed is not stored."""
+    cache.delete("racing")
+
+    def compute():
+        cache.invalidate_tags("racing")
+        return "stale"
+
+    assert cache.get_or_set("racing", compute, ttl=60, tags=["racing"]) == "stale"
+    assert cache.get("racing") is None
+
+    assert cache.get_or_set("racing", lambda: "fresh", ttl=60, tags=["racing"]) == "fresh"
+    assert cache.get("racing") == "fresh"
+
+
+def test_single_flight(registry, cache):
+    """Only one of concurrent callers computes a missing value."""
+    results = []
+
+    def slow():
+        calls.append("slow")
+        time.sleep(0.2)
+        return "value"
+
+    def worker():
+        results.append(get_cache(registry, "test_cache").get_or_set("slow", slow, ttl=60))
+
+    threads = [threading.Thread(target=worker) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["value"] * 5
+    assert calls == ["slow"]
+
+
+def test_early_recompute(cache, monkeypatch):
+    """A value about to expire is recomputed before it expires."""
+    # Median draw: recompute if the value expires within 0.69 computation times
+    monkeypatch.setattr("websauna.system.core.cache.random.random", lambda: 0.5)
+
+    cache.set("early", "old", ttl=60, delta=1000)
+    assert cache.get_or_set("early", lambda: "new", ttl=60) == "new"
+
+    cache.set("late", "old", ttl=60, delta=0.001)
+    assert cache.get_or_set("late", lambda: "new", ttl=60) == "old"
@@ -0,0 +1,210 @@
+"""Redis session loading."""
+# Standard Library
+import pickle
+
+# Pyramid
+from pyramid import testing
+from pyramid.response import Response
+from pyramid.session import signed_deserialize
+
+import pytest
+from redis import StrictRedis
+from webtest import TestApp as App
+
+# Websauna
+import websauna.system
+from websauna.system.core.session import \
+    set_creation_time_aware_session_factory
+
+
+#: Redis commands issued by the session backend
+commands = []
+
+
+class CountingRedis(StrictRedis):
+    """Record executed Redis commands."""
+
+    def execute_command(self, *args, **options):
+        commands.append(args[0])
+        return super(CountingRedis, self).execute_command(*args, **options)
+
+    def pipeline(self, *args, **kwargs):
+        commands.append("PIPELINE")
+        return super(CountingRedis, self).pipeline(*args, **kwargs)
+
+
+def get_redis_client(request, **redis_options):
+    return CountingRedis.from_url("redis://localhost:6379/14")
+
+
+def untouched_view(request):
+    return Response("ok")
+
+
+def read_view(request):
+    return Response(request.session.get("foo", "missing"))
+
+
+def write_view(request):
+    request.session["foo"] = "bar"
+    return Response("ok")
+
+
+def login_view(request):
+    """Write several keys like a login flow."""
+    request.session["auth.userid"] = 1
+    request.session["authenticated_at"] = "now"
+    request.session.flash("Welcome")
+    del request.session["foo"]
+    return Response("ok")
+
+
+def session_type_view(request):
+    """Touch the session and tell what it is."""
+    request.session["foo"] = "bar"
+    return Response(type(request.session).__name__)
+
+
+def create_app(request, settings):
+    settings = dict(settings)
+    settings["redis.sessions.secret"] = "secret"
+    settings["redis.sessions.client_callable"] = get_redis_client
+    config = testing.setUp(settings=settings)
+    set_creation_time_aware_session_factory(config)
+    for name, view in (("untouched", untouched_view), ("read", read_view), ("write", write_view), ("login", login_view)):
+        config.add_route(name, "/" + name)
+        config.add_view(view, route_name=name)
+
+    config.add_route("api", "/api/foo")
+    config.add_view(session_type_view, route_name="api")
+    config.add_route("health", "/health")
+    config.add_view(session_type_view, route_name="health")
+    config.add_route("sessionless", "/sessionless")
+    config.add_view(session_type_view, route_name="sessionless", session=False)
+    config.add_route("session", "/session")
+    config.add_view(session_type_view, route_name="session")
+
+    def teardown():
+        testing.tearDown()
+
+    request.addfinalizer(teardown)
+    return App(config.make_wsgi_app())
+
+
+@pytest.fixture(scope="module")
+def initializer_app(request, paster_config):
+    """Full Websauna app with a view not touching the session."""
+
+    class Initializer(websauna.system.Initializer):
+
+        def configure_views(self):
+            self.config.add_route("untouched", "/untouched")
+            self.config.add_view(untouched_view, route_name="untouched")
+
+    global_config, app_settings = paster_config
+    init = Initializer(global_config, app_settings)
+    init.run()
+    return App(init.make_wsgi_app())
+
+
+@pytest.fixture()
+def app(request):
+    """App using Websauna session factory."""
+    return create_app(request, {})
+
+
+@pytest.fixture()
+def sessionless_app(request):
+    """App with sessionless paths and routes."""
+    return create_app(request, {"websauna.sessionless_paths": "/api/ /static/", "websauna.sessionless_routes": "health"})
+
+
+@pytest.fixture()
+def coalescing_app(request):
+    """App buffering session writes until the end of the request."""
+    return create_app(request, {"redis.sessions.coalesce_writes": "true"})
+
+
+def test_lazy_session(app: App):
+    """Session is not loaded unless it is accessed."""
+    resp = app.get("/write")
+    assert "Set-Cookie" in resp.headers
+
+    commands.clear()
+    resp = app.get("/untouched")
+    assert commands == []
+    assert "Set-Cookie" not in resp.headers
+
+    commands.clear()
+    resp = app.get("/read")
+    assert resp.text == "bar"
+    assert "EXISTS" not in commands
+    assert commands.count("GET") == 1
+    assert "Set-Cookie" not in resp.headers
+
+
+def test_expired_session(app: App):
+    """Session is recreated if the cookie points to an expired session."""
+    app.get("/write")
+    cookie = app.cookies["session"]
+
+    redis = get_redis_client(None)
+    redis.delete(signed_deserialize(cookie, "secret"))
+
+    resp = app.get("/read")
+    assert resp.text == "missing"
+    assert "Set-Cookie" in resp.headers
+    assert app.cookies["session"] != cookie
+
+
+def test_coalesce_writes(app: App, coalescing_app: App):
+    """Several session changes are written with one pipeline."""
+    app.get("/write")
+    commands.clear()
+    app.get("/login")
+    assert commands.count("PIPELINE") == 5
+
+    coalescing_app.get("/write")
+    commands.clear()
+    coalescing_app.get("/login")
+    assert commands == ["GET", "PIPELINE"]
+
+    commands.clear()
+    resp = coalescing_app.get("/read")
+    assert resp.text == "missing"
+    # Expiration time of the session and the per-user session index
+    assert commands == ["GET", "PIPELINE"]
+
+    redis = get_redis_client(None)
+    session_id = signed_deserialize(coalescing_app.cookies["session"], "secret")
+    data = pickle.loads(redis.get(session_id))
+    assert data["managed_dict"]["auth.userid"] == 1
+    assert data["managed_dict"]["_f_"] == ["Welcome"]
+
+
+@pytest.mark.parametrize("path,session_type", [
+    ("/api/foo", "dict"),
+    ("/health", "dict"),
+    ("/sessionless", "dict"),
+    ("/session", "WebsaunaSession"),
+])
+def test_sessionless(sessionless_app: App, path: str, session_type: str):
+    """Configured paths, routes and session=False views do not access Redis."""
+    commands.clear()
+    resp = sessionless_app.get(path)
+    assert resp.text == session_type
+    if session_type == "dict":
+        assert commands == []
+        assert "Set-Cookie" not in resp.headers
+    else:
+        assert commands
+
+
+def test_cookieless_request_in_full_app(initializer_app: App):
+    """Tweens and authentication policy of a full app do not create sessions for requests without a session cookie."""
+    redis = get_redis_client(None)
+    session_count = len(redis.keys("websauna_session*"))
+    resp = initializer_app.get("/untouched")
+    assert resp.text == "ok"
+    assert "Set-Cookie" not in resp.headers
+    assert len(redis.keys("websauna_session*")) == session_count
@@ -0,0 +1,76 @@
+"""Purging old sessions."""
+# Standard Library
+import datetime
+import pickle
+import time
+
+# Pyramid
+import transaction
+
+# Websauna
+from websauna.system.auth import sessionindex
+from websauna.system.core.redis import get_redis
+from websauna.system.core.sessionpurge import get_session_key_pattern
+from websauna.system.core.sessionpurge import purge_sessions
+from websauna.system.user.models import User
+from websauna.tests.test_utils import create_user
+from websauna.utils.time import now
+
+
+def store_session(redis, settings, name, managed_dict, created=None):
+    key = get_session_key_pattern(settings)[:-1] + "purgetest_" + name
+    data = {
+        "managed_dict": managed_dict,
+        "created": created or time.time(),
+        "timeout": 3600,
+    }
+    redis.set(key, pickle.dumps(data))
+    return key
+
+
+def test_purge_sessions(dbsession, registry, test_request):
+    """Old sessions and sessions of disabled users are deleted."""
+    with transaction.manager:
+        create_user(dbsession, registry, email="enabled@example.com")
+        disabled = create_user(dbsession, registry, email="disabled@example.com")
+        disabled.enabled = False
+
+    with transaction.manager:
+        enabled_id = dbsession.query(User).filter_by(email="enabled@example.com").one().id
+        disabled_id = dbsession.query(User).filter_by(email="disabled@example.com").one().id
+
+    redis = get_redis(test_request)
+    settings = registry.settings
+    day = datetime.timedelta(days=1)
+
+    fresh = store_session(redis, settings, "fresh", {"created_at": now()})
+    old = store_session(redis, settings, "old", {"created_at": now() - 3 * day})
+    never_written = store_session(redis, settings, "never_written", {}, created=time.time() - 3 * 86400)
+    logged_in = store_session(redis, settings, "logged_in", {"created_at": now(), "auth.userid": enabled_id})
+    logged_in_disabled = store_session(redis, settings, "logged_in_disabled", {"created_at": now(), "auth.userid": disabled_id})
+    not_session = get_session_key_pattern(settings)[:-1] + "purgetest_set"
+    redis.sadd(not_session, "foo")
+    redis.sadd(sessionindex.get_index_key(enabled_id), logged_in)
+    redis.sadd(sessionindex.get_index_key(disabled_id), logged_in_disabled)
+
+    with transaction.manager:
+        stats = purge_sessions(test_request, max_age=2 * 86400, batch_size=2)
+
+    assert stats.expired >= 2
+    assert stats.disabled >= 1
+    assert stats.batches > 1
+    assert stats.scanned >= 6
+    assert str(stats).startswith("Scanned")
+
+    assert redis.exists(fresh)
+    assert redis.exists(logged_in)
+    assert redis.exists(not_session)
+    assert not redis.exists(old)
+    assert not redis.exists(never_written)
+    assert not redis.exists(logged_in_disabled)
+
+    # Deleted sessions are removed from the per-user session index
+    assert redis.sismember(sessionindex.get_index_key(enabled_id), logged_in)
+    assert not redis.exists(sessionindex.get_index_key(disabled_id))
+
+    redis.delete(fresh, logged_in, not_session, sessionindex.get_index_key(enabled_id))
@@ -0,0 +1,75 @@
+"""Compact session serialization."""
+# Standard Library
+import datetime
+import decimal
+import pickle
+import time
+import uuid
+
+import pytest
+from redis import StrictRedis
+
+# Websauna
+from websauna.system.core import sessionserializer
+from websauna.system.core.messages import FlashMessage
+from websauna.system.core.session import WebsaunaSession
+from websauna.utils.time import now
+
+
+@pytest.fixture
+def session_data():
+    """Session as stored by pyramid_redis_sessions after login and a flash message."""
+    return {
+        "managed_dict": {
+            "_csrft_": "3f0e6a7d2c4b41e5b0b0a1f6b2d9c8e7a6b5c4d3",
+            "client_addr": "127.0.0.1",
+            "created_at": now(),
+            "authenticated_at": datetime.datetime(2019, 1, 1, 12, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=2))),
+            "auth.userid": 1,
+            "_f_success": [FlashMessage("Welcome back!", kind="success", msg_id="msg-login")],
+            "delivery_data": {"ids": (1, 2), "tags": {"a"}, "price": decimal.Decimal("1.50"), "uuid": uuid.uuid4(), 5: b"\x00\x01"},
+        },
+        "created": time.time(),
+        "timeout": 1200,
+    }
+
+
+def test_roundtrip(session_data):
+    """Session data survives serialization with types intact."""
+    data = sessionserializer.serialize(session_data)
+    assert data.startswith(sessionserializer.MAGIC)
+    assert sessionserializer.deserialize(data) == session_data
+
+    msg = sessionserializer.deserialize(data)["managed_dict"]["_f_success"][0]
+    assert isinstance(msg, FlashMessage)
+    assert msg.kind == "success"
+    assert msg.plain == "Welcome back!"
+
+
+def test_smaller_than_pickle(session_data):
+    """Compact format takes less space than pickle."""
+    assert len(sessionserializer.serialize(session_data)) < len(pickle.dumps(session_data))
+
+
+def test_unknown_type():
+    """Types without an extension are refused."""
+    with pytest.raises(TypeError):
+        sessionserializer.serialize({"foo": object()})
+
+
+def test_legacy_session_migrated(session_data):
+    """Pickled sessions are read and rewritten in compact format on save."""
+    redis = StrictRedis.from_url("redis://localhost:6379/14")
+    session_id = "test_legacy_session"
+    redis.set(session_id, pickle.dumps(session_data), ex=60)
+
+    session = WebsaunaSession({}, redis, session_id, False, None, serialize=sessionserializer.serialize, deserialize=sessionserializer.deserialize)
+    assert session["auth.userid"] == 1
+    assert sessionserializer.is_legacy(redis.get(session_id))
+
+    session["foo"] = "bar"
+    stored = redis.get(session_id)
+    assert not sessionserializer.is_legacy(stored)
+    assert sessionserializer.deserialize(stored)["managed_dict"]["auth.userid"] == 1
+
+    redis.delete(session_id)
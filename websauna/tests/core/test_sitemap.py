@@ -1,18 +1,30 @@
+# Standard Library
+import datetime
+import gzip
+import os
+from xml.etree import ElementTree
+
 # Pyramid
 import pyramid.testing
+from pyramid.interfaces import IAuthorizationPolicy
 from pyramid.testing import DummyRequest
 
 import pytest
+from webtest import TestApp as App
 
 # Websauna
 import websauna.system
 from websauna.system.core import sitemap
+from websauna.system.core import sitemapstore
 from websauna.system.core.sitemap import ReflectiveSitemapBuilder
 from websauna.system.core.sitemap import RouteItem
 from websauna.system.core.sitemap import TraverseItem
 from websauna.system.http.utils import make_routable_request
 
 
+SITEMAP_NS = {"sm": "http://www.sitemaps.org/schemas/sitemap/0.9"}
+
+
 @pytest.fixture(scope="module")
 def sitemap_app(request, paster_config):
     '''Custom WSGI app with travesal points for sitemap enabled.'''
@@ -25,6 +37,9 @@ def sitemap_app(request, paster_config):
             self.config.add_route('sitemap_test', '/container/*traverse', factory=sitemapsamples.container_factory)
             self.config.scan(sitemapsamples)
 
+        def configure_sitemap(self):
+            sitemapstore.add_stored_sitemap(self.config, ReflectiveSitemapBuilder.create_lazy_sitemap)
+
     global_config, app_settings = paster_config
     init = Initializer(global_config, app_settings)
     init.run()
@@ -39,6 +54,15 @@ def sitemap_request(sitemap_app):
     return make_routable_request(dbsession=None, registry=sitemap_app.init.config.registry)
 
 
+@pytest.fixture
+def sitemap_dir(sitemap_app, tmpdir):
+    """Write stored sitemaps to a temporary folder."""
+    settings = sitemap_app.init.config.registry.settings
+    settings["websauna.sitemap_dir"] = str(tmpdir)
+    yield str(tmpdir)
+    del settings["websauna.sitemap_dir"]
+
+
 @pytest.fixture
 def builder(sitemap_request):
     return ReflectiveSitemapBuilder(sitemap_request)
@@ -98,6 +122,37 @@ def test_generator_items():
         assert items[2].location(request) == "/3"
 
 
+def test_stream_xml():
+    """Sitemap is streamed as escaped XML in batches."""
+
+    with pyramid.testing.testConfig() as config:
+        request = DummyRequest()
+        config.add_route('bar', '/bar/{id}')
+
+        s = sitemap.Sitemap()
+        s.add_item(sitemap.RouteItem("bar", id=1, lastmod=datetime.date(2015, 1, 1), priority="1.0"))
+        s.add_item(sitemap.RouteItem("bar", id=2, changefreq="never", _query={"a": "1", "b": "2"}))
+        s.add_item(sitemap.RouteItem("bar", id=3))
+        s.add_item(sitemap.RouteItem("bar", id=4, priority=0))
+
+        chunks = list(sitemap.iterate_sitemap_xml(s.urls(), request, batch_size=2))
+        # Header, two batches, footer
+        assert len(chunks) == 4
+
+        response = s.stream(None, request)
+        assert response.content_type == "application/xml"
+        tree = ElementTree.fromstring(response.body)
+        urls = tree.findall("sm:url", SITEMAP_NS)
+        assert len(urls) == 4
+        assert urls[0].find("sm:loc", SITEMAP_NS).text == "http://example.com/bar/1"
+        assert urls[0].find("sm:lastmod", SITEMAP_NS).text == "2015-01-01"
+        assert urls[0].find("sm:priority", SITEMAP_NS).text == "1.0"
+        assert urls[1].find("sm:loc", SITEMAP_NS).text == "http://example.com/bar/2?a=1&b=2"
+        assert urls[1].find("sm:changefreq", SITEMAP_NS).text == "never"
+        assert urls[2].find("sm:lastmod", SITEMAP_NS) is None
+        assert urls[3].find("sm:priority", SITEMAP_NS).text == "0"
+
+
 def test_reflect_routes(builder):
     """See we can reflect simple routes back to the sitemap."""
 
@@ -131,11 +186,66 @@ def test_reflect_traverse(builder):
     assert not (any("permissioned" in u for u in urls))
 
 
+def test_reflect_batch_container(builder, monkeypatch):
+    """Batch containers are enumerated in pages and ACL decisions are shared between siblings."""
+    from websauna.tests.sitemapsamples import SampleBatchContainer
+
+    policy = builder.request.registry.queryUtility(IAuthorizationPolicy)
+    calls = []
+    original = policy.principals_allowed_by_permission
+
+    def counting(context, permission):
+        calls.append(context)
+        return original(context, permission)
+
+    monkeypatch.setattr(policy, "principals_allowed_by_permission", counting)
+    monkeypatch.setattr(SampleBatchContainer, "pages_loaded", 0)
+    builder.batch_size = 10
+
+    builder.build_traverse_trees()
+    request = builder.request
+    items = {i.location(request): i for i in builder.sitemap.items if isinstance(i, TraverseItem)}
+
+    assert "http://localhost:6543/container/batch/item-0/" in items
+    assert "http://localhost:6543/container/batch/item-24/additional" in items
+    assert items["http://localhost:6543/container/batch/item-24/"].lastmod(request) == datetime.date(2015, 1, 25)
+
+    assert SampleBatchContainer.pages_loaded == 3
+
+    # One decision per resource class and parent, not per batch item
+    assert len([c for c in calls if c.__parent__ and c.__parent__.__name__ == "batch"]) == 1
+
+
 def test_reflect_build(builder):
     """Build both routes and traversables."""
     builder.build()
 
 
+def test_reflect_stream(sitemap_request, monkeypatch):
+    """The site is walked lazily while the sitemap is streamed."""
+    from websauna.tests.sitemapsamples import SampleBatchContainer
+
+    monkeypatch.setattr(SampleBatchContainer, "pages_loaded", 0)
+    builder = ReflectiveSitemapBuilder(sitemap_request)
+    builder.batch_size = 10
+
+    items = builder.iterate_items()
+    next(items)
+    assert SampleBatchContainer.pages_loaded == 0
+    assert not builder.sitemap.items
+
+    rest = list(items)
+    assert SampleBatchContainer.pages_loaded == 3
+    assert not builder.sitemap.items
+
+    expected = [i.location(sitemap_request) for i in ReflectiveSitemapBuilder.create_sitemap(sitemap_request).urls()]
+    assert len(rest) + 1 == len(expected)
+
+    response = ReflectiveSitemapBuilder.stream(None, sitemap_request)
+    tree = ElementTree.fromstring(response.body)
+    assert [e.text for e in tree.findall("sm:url/sm:loc", SITEMAP_NS)] == expected
+
+
 def test_conditions(builder):
     """We can enable/disable items in the sitemap using decorators."""
 
@@ -150,3 +260,87 @@ def test_conditions(builder):
 
     assert any("/container/bar/conditional" in u for u in urls)
     assert not any("/container/bar/skipped_conditional" in u for u in urls)
+
+
+def test_sitemap_index_cached(sitemap_request, monkeypatch):
+    """Route and view introspection is done only once per registry."""
+    registry = sitemap_request.registry
+    index = sitemap.get_sitemap_index(registry)
+    assert sitemap.get_sitemap_index(registry) is index
+
+    entries = {e.route_name: e for e in index.route_views}
+    assert entries["conditional_route"].public_get
+    assert entries["skipped_route"].sitemap_data["include"] is False
+    assert not entries["permissioned_route"].public_get
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Introspector scanned again")
+
+    monkeypatch.setattr(registry.introspector, "get_category", fail)
+    monkeypatch.setattr(registry.introspector, "related", fail)
+
+    builder = ReflectiveSitemapBuilder(sitemap_request)
+    builder.build()
+    routes = [i.route_name for i in builder.sitemap.items if isinstance(i, RouteItem)]
+    assert "conditional_route" in routes
+    assert "permissioned_route" not in routes
+    assert any(isinstance(i, TraverseItem) for i in builder.sitemap.items)
+
+    # Routes use the precomputed public GET flag and sitemap data
+    monkeypatch.setattr(sitemap, "is_get_requestable", fail)
+    monkeypatch.setattr(sitemap, "is_anonymous", fail)
+    monkeypatch.setattr(sitemap, "get_sitemap_data", fail)
+    builder = ReflectiveSitemapBuilder(sitemap_request)
+    builder.build_routes()
+    assert routes == [i.route_name for i in builder.sitemap.items]
+
+
+def test_stored_sitemap(sitemap_request, sitemap_dir):
+    """Sitemap is written as an index and gzipped chunks."""
+    s = ReflectiveSitemapBuilder.create_lazy_sitemap(sitemap_request)
+    total = len(list(s.urls()))
+    assert total == len(list(ReflectiveSitemapBuilder.create_sitemap(sitemap_request).urls()))
+    assert not s.items
+
+    generator = sitemapstore.SitemapGenerator(sitemap_request, s, chunk_size=3)
+    assert generator.generate() == total
+
+    index = ElementTree.parse(os.path.join(sitemap_dir, "sitemap.xml"))
+    locations = [e.text for e in index.findall("sm:sitemap/sm:loc", SITEMAP_NS)]
+    assert len(locations) == (total + 2) // 3
+    assert locations[0].endswith("/sitemap-1.xml.gz")
+
+    urls = []
+    for number in range(1, len(locations) + 1):
+        with gzip.open(os.path.join(sitemap_dir, "sitemap-{}.xml.gz".format(number))) as f:
+            urls += [e.text for e in ElementTree.parse(f).findall("sm:url/sm:loc", SITEMAP_NS)]
+    assert len(urls) == total
+    assert any(u.endswith("/container/additional") for u in urls)
+
+    # Regenerating a smaller sitemap removes extra chunks
+    generator = sitemapstore.SitemapGenerator(sitemap_request, s, chunk_size=sitemapstore.MAX_URLS)
+    generator.generate()
+    assert os.path.exists(os.path.join(sitemap_dir, "sitemap-1.xml.gz"))
+    assert not os.path.exists(os.path.join(sitemap_dir, "sitemap-2.xml.gz"))
+
+
+def test_serve_stored_sitemap(sitemap_app, sitemap_request, sitemap_dir):
+    """Stored sitemap files are served with caching headers."""
+    app = App(sitemap_app)
+    app.get("/sitemap.xml", status=404)
+
+    sitemapstore.generate_sitemap(sitemap_request)
+
+    resp = app.get("/sitemap.xml")
+    assert resp.content_type == "application/xml"
+    assert resp.headers["ETag"]
+    assert resp.headers["Last-Modified"]
+
+    app.get("/sitemap.xml", headers={"If-None-Match": resp.headers["ETag"]}, status=304)
+    app.get("/sitemap.xml", headers={"If-Modified-Since": resp.headers["Last-Modified"]}, status=304)
+
+    resp = app.get("/sitemap-1.xml.gz")
+    assert resp.content_type == "application/gzip"
+    assert b"<urlset" in gzip.decompress(resp.body)
+
+    app.get("/sitemap-2.xml.gz", status=404)
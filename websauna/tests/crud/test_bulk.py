@@ -0,0 +1,112 @@
+"""Test set-based bulk actions."""
+# Pyramid
+import transaction
+
+# Websauna
+from websauna.system.crud import bulk
+from websauna.system.user.models import User
+from websauna.tests.test_utils import create_user
+
+
+def _create_users(dbsession, registry, count=5):
+    with transaction.manager:
+        for index in range(count):
+            create_user(dbsession, registry, email="bulk{}@example.com".format(index))
+        create_user(dbsession, registry, email="other@example.com")
+
+
+def _bulk_query(dbsession):
+    return dbsession.query(User).filter(User.email.like("bulk%"))
+
+
+def test_iterate_id_chunks(dbsession, registry):
+    """All matching ids are walked in primary key order."""
+    _create_users(dbsession, registry)
+
+    with transaction.manager:
+        chunks = list(bulk.iterate_id_chunks(_bulk_query(dbsession), 2))
+        assert [len(c) for c in chunks] == [2, 2, 1]
+        ids = [id for c in chunks for id in c]
+        assert ids == sorted(ids)
+
+
+def test_delete_selected(dbsession, registry, test_request):
+    """Only selected rows are deleted."""
+    _create_users(dbsession, registry)
+
+    with transaction.manager:
+        ids = [u.id for u in _bulk_query(dbsession).order_by(User.id).limit(2)]
+        count, scheduled = bulk.BulkDelete().perform(test_request, _bulk_query(dbsession), ids)
+        assert count == 2
+        assert not scheduled
+
+    with transaction.manager:
+        assert _bulk_query(dbsession).count() == 3
+        assert dbsession.query(User).filter(User.id.in_(ids)).count() == 0
+
+
+def test_selected_ids_outside_query(dbsession, registry, test_request):
+    """Selected ids not matching the listing query are not touched."""
+    _create_users(dbsession, registry)
+
+    with transaction.manager:
+        other = dbsession.query(User).filter_by(email="other@example.com").one()
+        count, scheduled = bulk.BulkDelete().perform(test_request, _bulk_query(dbsession), [other.id])
+        assert count == 0
+
+    with transaction.manager:
+        assert dbsession.query(User).filter_by(email="other@example.com").count() == 1
+
+
+def test_update_all_matching(dbsession, registry, test_request):
+    """Select all updates every row matching the query, in chunks."""
+    _create_users(dbsession, registry)
+
+    with transaction.manager:
+        action = bulk.BulkUpdate(id="disable", name="Disable", values={"enabled": False}, chunk_size=2)
+        count, scheduled = action.perform(test_request, _bulk_query(dbsession))
+        assert count == 5
+
+    with transaction.manager:
+        assert _bulk_query(dbsession).filter_by(enabled=False).count() == 5
+        assert dbsession.query(User).filter_by(email="other@example.com").one().enabled
+
+
+def test_run_bulk_action(dbsession, registry):
+    """Actions can be reconstructed from the task payload."""
+    _create_users(dbsession, registry)
+
+    with transaction.manager:
+        ids = [u.id for u in _bulk_query(dbsession)]
+        action = bulk.BulkUpdate(id="disable", name="Disable", values={"enabled": False})
+        count = bulk.run_bulk_action(dbsession, "websauna.system.crud.bulk.BulkUpdate", action.get_payload(), "websauna.system.user.models.User", ids)
+        assert count == 5
+
+
+def test_schedule_all_matching(dbsession, registry, test_request, monkeypatch):
+    """Select all above the background threshold passes the listing to the task instead of ids."""
+    _create_users(dbsession, registry)
+
+    scheduled_refs = []
+    monkeypatch.setattr(bulk, "iterate_id_chunks", None)
+
+    with transaction.manager:
+        action = bulk.BulkDelete(background_threshold=2)
+        monkeypatch.setattr(action, "schedule_query", lambda request, listing_ref: scheduled_refs.append(listing_ref))
+        count, scheduled = action.perform(test_request, _bulk_query(dbsession), listing_ref=("view", None, [], []))
+        assert count == 5
+        assert scheduled
+        assert scheduled_refs == [("view", None, [], [])]
+
+
+def test_run_bulk_action_query(dbsession, registry):
+    """Background task resolves the ids of the listing query in chunks."""
+    _create_users(dbsession, registry)
+
+    with transaction.manager:
+        action = bulk.BulkUpdate(id="disable", name="Disable", values={"enabled": False}, chunk_size=2)
+        count = bulk.run_bulk_action_query("websauna.system.crud.bulk.BulkUpdate", action.get_payload(), _bulk_query(dbsession))
+        assert count == 5
+
+    with transaction.manager:
+        assert _bulk_query(dbsession).filter_by(enabled=False).count() == 5
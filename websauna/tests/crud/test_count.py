@@ -0,0 +1,78 @@
+"""Test CRUD listing count strategies."""
+# Pyramid
+import transaction
+from pyramid import testing
+
+# Websauna
+from websauna.system.core.redis import get_redis
+from websauna.system.crud import count
+from websauna.system.crud.paginator import Batch
+from websauna.system.user.models import User
+from websauna.tests.test_utils import create_user
+
+
+def _create_users(dbsession, registry, count: int):
+    with transaction.manager:
+        for index in range(count):
+            create_user(dbsession, registry, email="example{}@example.com".format(index))
+
+
+def test_capped_count(dbsession, registry, test_request):
+    """Capped count stops counting at the cap."""
+    _create_users(dbsession, registry, 5)
+
+    with transaction.manager:
+        query = dbsession.query(User)
+        assert count.CappedCount(cap=10).get_count(query, test_request) == 5
+
+        capped = count.CappedCount(cap=3).get_count(query, test_request)
+        assert not capped.exact
+        assert capped == 3
+        assert str(capped) == "3+"
+
+
+def test_estimated_count(dbsession, registry, test_request):
+    """Estimated count falls back to exact count for small tables."""
+    _create_users(dbsession, registry, 5)
+
+    with transaction.manager:
+        query = dbsession.query(User).filter(User.enabled == True)  # noqa
+        assert count.EstimatedCount().get_count(query, test_request) == 5
+
+        estimate = count.EstimatedCount(threshold=0).get_count(query, test_request)
+        assert str(estimate).startswith("~")
+
+
+def test_cached_count(dbsession, registry, test_request):
+    """Cached count is served from Redis on the second call."""
+    _create_users(dbsession, registry, 2)
+    count.clear_count_cache(registry)
+
+    strategy = count.CachedCount(ttl=60)
+
+    with transaction.manager:
+        query = dbsession.query(User)
+        assert strategy.get_count(query, test_request) == 2
+        create_user(dbsession, registry, email="another@example.com")
+        assert strategy.get_count(query, test_request) == 2
+        assert strategy.get_count(query.filter(User.email == "another@example.com"), test_request) == 1
+
+    redis = get_redis(registry)
+    assert redis.ttl(strategy.get_cache_key(query)) > 0
+    count.clear_count_cache(registry)
+
+
+def test_batch_inexact_count():
+    """Paginator does not offer last page link when the count is not exact."""
+    seq = list(range(100))
+    request = testing.DummyRequest(params={"batch_num": "1"})
+
+    batch = Batch(seq, request, default_size=10, seqlen=count.InexactCount(20, capped=True))
+    assert list(batch) == list(range(10, 20))
+    assert batch.next_url
+    assert batch.last_url is None
+
+    request = testing.DummyRequest(params={"batch_num": "9"})
+    batch = Batch(seq, request, default_size=10, seqlen=count.InexactCount(20, capped=True))
+    assert list(batch) == list(range(90, 100))
+    assert batch.next_url is None
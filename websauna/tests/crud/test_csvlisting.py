@@ -0,0 +1,129 @@
+"""Test streaming CSV export."""
+# Pyramid
+import transaction
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid.httpexceptions import HTTPNotFound
+
+import pytest
+
+# Websauna
+from websauna.system.crud import export
+from websauna.system.crud import listing
+from websauna.system.crud.views import CSVListing
+from websauna.system.http.utils import make_routable_request
+from websauna.system.user.models import User
+from websauna.tests.test_utils import create_user
+
+
+class DummyCRUD:
+    """Minimal CRUD for driving the view outside traversal."""
+
+    title = "Users"
+
+    def __init__(self, dbsession):
+        self.dbsession = dbsession
+
+    def get_dbsession(self):
+        return self.dbsession
+
+    def get_query(self):
+        return self.dbsession.query(User)
+
+
+class UserExport(CSVListing):
+
+    buffered_rows = 2
+
+    table = listing.Table(
+        columns=[
+            listing.Column("id"),
+            listing.Column("email"),
+        ]
+    )
+
+    def order_query(self, query):
+        return query.order_by(User.id)
+
+
+def test_csv_export_streams(dbsession, registry, test_request):
+    """CSV export is produced in chunks of buffered rows."""
+
+    with transaction.manager:
+        for index in range(5):
+            create_user(dbsession, registry, email="example{}@example.com".format(index))
+
+    with transaction.manager:
+        view = UserExport(DummyCRUD(dbsession), test_request)
+        response = view.listing()
+
+    # Consumed after the request transaction has been closed
+    chunks = list(response.app_iter)
+    assert len(chunks) == 3
+
+    lines = b"".join(chunks).decode("utf-8").splitlines()
+    assert lines[0] == "id,email"
+    assert lines[1:] == ["{},example{}@example.com".format(index + 1, index) for index in range(5)]
+    assert response.headers["Content-Type"] == "text/csv; charset=utf-8"
+
+
+@pytest.fixture
+def spool_dir(registry, tmpdir):
+    """Write background exports to a temporary folder."""
+    registry.settings["websauna.export_spool_dir"] = str(tmpdir)
+    yield str(tmpdir)
+    del registry.settings["websauna.export_spool_dir"]
+
+
+def test_background_export(dbsession, registry, test_request, spool_dir):
+    """Background export writes the file to the spool directory and tracks progress in Redis."""
+
+    with transaction.manager:
+        for index in range(5):
+            create_user(dbsession, registry, email="example{}@example.com".format(index))
+
+    job_id = export.create_export_job(test_request, "users.utf-8.csv", 5)
+    assert export.get_export_job(registry, job_id)["status"] == "pending"
+
+    with transaction.manager:
+        view = UserExport(DummyCRUD(dbsession), test_request)
+        view.progress_rows = 2
+        view.write_export(job_id)
+
+    job = export.get_export_job(registry, job_id)
+    assert job["status"] == "done"
+    assert job["rows"] == 5
+    assert job["total"] == 5
+
+    with open(export.get_export_path(registry, job_id), "rb") as f:
+        lines = f.read().decode("utf-8").splitlines()
+    assert len(lines) == 6
+
+    # The job can be looked up by the user who started it
+    test_request.GET["job"] = job_id
+    assert view.get_export_job()["id"] == job_id
+
+    test_request.GET["job"] = "nonexisting"
+    with pytest.raises(HTTPNotFound):
+        view.get_export_job()
+
+
+def test_find_user_context(dbsession, registry):
+    """Background jobs see the listing as the user who started them and check the permissions again."""
+
+    with transaction.manager:
+        admin_id = create_user(dbsession, registry, email="admin@example.com", admin=True).id
+        user_id = create_user(dbsession, registry, email="user@example.com").id
+
+    request = make_routable_request(dbsession=dbsession, registry=registry)
+
+    with transaction.manager:
+        context = export.find_user_context(request, admin_id, "admin", ["models", "user"], permissions=("view", "delete"))
+        assert context.__name__ == "user"
+        assert request.user.id == admin_id
+
+        with pytest.raises(HTTPForbidden):
+            export.find_user_context(request, user_id, "admin", ["models", "user"])
+        assert request.user.id == user_id
+
+        with pytest.raises(HTTPForbidden):
+            export.find_user_context(request, None, "admin", ["models", "user"])
@@ -0,0 +1,160 @@
+"""Test CRUD listing pagination."""
+# Standard Library
+import datetime
+from urllib.parse import parse_qsl
+from urllib.parse import urlsplit
+
+# Pyramid
+import transaction
+from pyramid import testing
+
+# SQLAlchemy
+from sqlalchemy import event
+
+import pytest
+
+# Websauna
+from websauna.system.crud.paginator import DefaultPaginator
+from websauna.system.crud.paginator import KeysetPaginator
+from websauna.system.crud.paginator import decode_cursor
+from websauna.system.crud.paginator import encode_cursor
+from websauna.system.user.models import User
+from websauna.tests.test_utils import create_user
+
+
+def _create_users(dbsession, registry, count: int):
+    with transaction.manager:
+        for index in range(count):
+            create_user(dbsession, registry, email="example{}@example.com".format(index))
+
+
+def _paginate(query, url: str):
+    request = testing.DummyRequest(params=dict(parse_qsl(urlsplit(url).query)), url=url)
+    return KeysetPaginator(default_size=20).paginate(query, request, count=None)
+
+
+def test_cursor_roundtrip():
+    """Cursor tokens should preserve the column value types."""
+    values = [datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc), datetime.datetime(2020, 1, 1), 5, "foo", None]
+    assert decode_cursor(encode_cursor(values)) == values
+
+
+def test_keyset_pagination(dbsession, registry):
+    """Walk through all pages forward and backward using cursors."""
+    _create_users(dbsession, registry, 45)
+
+    with transaction.manager:
+        query = dbsession.query(User).order_by(User.created_at.desc())
+        expected = [u.email for u in query.order_by(User.id.desc())]
+
+        seen = []
+        batch = _paginate(query, "http://example.com/listing")
+        assert batch.first_url is None
+        assert batch.prev_url is None
+        while True:
+            seen.extend(u.email for u in batch)
+            if not batch.next_url:
+                break
+            batch = _paginate(query, batch.next_url)
+
+        assert seen == expected
+        assert len(batch) == 5
+
+        # Go back from the last page
+        batch = _paginate(query, batch.prev_url)
+        assert [u.email for u in batch] == expected[20:40]
+        assert batch.next_url
+
+        # Last page link gives a full page from the end
+        batch = _paginate(query, "http://example.com/listing?before=last")
+        assert [u.email for u in batch] == expected[-20:]
+        assert batch.next_url is None
+
+
+def test_keyset_stale_cursor(dbsession, registry):
+    """Cursor matching no rows, e.g. after the rows were deleted, falls back to the nearest page."""
+    _create_users(dbsession, registry, 25)
+
+    with transaction.manager:
+        query = dbsession.query(User).order_by(User.created_at.desc())
+        expected = [u.email for u in query.order_by(User.id.desc())]
+        next_url = _paginate(query, "http://example.com/listing").next_url
+        prev_url = _paginate(query, next_url).prev_url
+
+    with transaction.manager:
+        dbsession.query(User).filter(User.email.in_(expected[:20])).delete(synchronize_session=False)
+
+    with transaction.manager:
+        # Nothing left before the cursor, show the first page
+        batch = _paginate(query, prev_url)
+        assert [u.email for u in batch] == expected[20:]
+        assert batch.prev_url is None
+
+    with transaction.manager:
+        dbsession.query(User).filter(User.email.in_(expected[20:])).delete(synchronize_session=False)
+
+    _create_users(dbsession, registry, 3)
+
+    with transaction.manager:
+        # Nothing left after the cursor, show the last page
+        batch = _paginate(query, next_url)
+        assert len(batch) == 3
+        assert batch.next_url is None
+
+
+def test_keyset_bad_cursor(dbsession, registry):
+    """Tampered cursor falls back to the first page."""
+    _create_users(dbsession, registry, 3)
+
+    with transaction.manager:
+        query = dbsession.query(User).order_by(User.created_at.desc())
+        batch = _paginate(query, "http://example.com/listing?after=xxx")
+        assert len(batch) == 3
+        assert not batch.required
+
+
+def test_window_count(dbsession, registry):
+    """Page rows and the total count are loaded with one statement."""
+    _create_users(dbsession, registry, 45)
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = dbsession.get_bind()
+    paginator = DefaultPaginator(default_size=20)
+
+    with transaction.manager:
+        query = dbsession.query(User).order_by(User.id)
+        expected = [u.email for u in query]
+
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            request = testing.DummyRequest(params={"batch_num": "2"}, url="http://example.com/listing")
+            batch = paginator.paginate_window_count(query, request)
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+        assert len(statements) == 1
+        assert batch.seqlen == 45
+        assert [u.email for u in batch] == expected[40:]
+        assert batch.prev_url
+        assert not batch.next_url
+
+        # Past the last page
+        request = testing.DummyRequest(params={"batch_num": "5"}, url="http://example.com/listing")
+        batch = paginator.paginate_window_count(query, request)
+        assert batch.seqlen == 45
+        assert len(batch) == 0
+
+
+def test_keyset_window_count(dbsession, registry):
+    """Keyset pagination refuses window count instead of silently paging by offset."""
+    paginator = KeysetPaginator(default_size=20)
+
+    with transaction.manager:
+        query = dbsession.query(User).order_by(User.id)
+        request = testing.DummyRequest(url="http://example.com/listing")
+        with pytest.raises(RuntimeError):
+            paginator.paginate_window_count(query, request)
@@ -0,0 +1,71 @@
+"""Test listing column projection."""
+# Pyramid
+import transaction
+
+# SQLAlchemy
+from sqlalchemy import inspect
+
+# Websauna
+from websauna.system.crud import listing
+from websauna.system.crud.urlmapper import Base64UUIDMapper
+from websauna.system.crud.views import Listing
+from websauna.system.user.models import User
+from websauna.tests.test_utils import create_user
+
+
+class DummyCRUD:
+    """Minimal CRUD for driving the view outside traversal."""
+
+    title = "Users"
+    plural_name = "users"
+    mapper = Base64UUIDMapper()
+
+    def __init__(self, dbsession):
+        self.dbsession = dbsession
+
+    def get_model(self):
+        return User
+
+    def get_query(self):
+        return self.dbsession.query(User)
+
+
+class UserEmailListing(Listing):
+
+    projection = True
+
+    table = listing.Table(
+        columns=[
+            listing.Column("id", "Id"),
+            listing.Column("email", "Email"),
+            listing.Column("name", "Name", getter=lambda view, column, obj: obj.username, attributes=["username"]),
+            listing.ControlsColumn(),
+        ]
+    )
+
+    def order_query(self, query):
+        return query.order_by(User.created_at.desc())
+
+
+def test_projection(dbsession, registry, test_request):
+    """Only attributes rendered in the listing are loaded."""
+
+    with transaction.manager:
+        create_user(dbsession, registry)
+
+    with transaction.manager:
+        view = UserEmailListing(DummyCRUD(dbsession), test_request)
+        assert view.get_projection_attributes(view.order_query(view.get_query()), view.table.get_columns()) == {"id", "uuid", "email", "username", "created_at"}
+
+        template_context = view.listing()
+        user = list(template_context["batch"])[0]
+        unloaded = inspect(user).unloaded
+        assert "user_data" in unloaded
+        assert "email" not in unloaded
+
+
+def test_projection_unknown_getter(dbsession, test_request):
+    """Columns with getters not declaring their attributes disable projection."""
+    view = UserEmailListing(DummyCRUD(dbsession), test_request)
+    columns = [listing.Column("email", "Email"), listing.Column("link", getter=lambda view, column, obj: obj.email)]
+    assert view.get_projection_attributes(view.get_query(), columns) is None
@@ -0,0 +1,157 @@
+"""Test eager loading of relationships in listings."""
+# Standard Library
+import logging
+
+# Pyramid
+import transaction
+from pyramid.response import Response
+
+# SQLAlchemy
+from sqlalchemy import inspect
+
+# Websauna
+from websauna.system.crud import listing
+from websauna.system.crud.sqlalchemy import CRUD
+from websauna.system.crud.sqlalchemy import Resource
+from websauna.system.crud.views import Listing
+from websauna.system.user.models import User
+from websauna.tests.test_utils import create_user
+
+
+def _get_group_names(view, column, obj):
+    return ", ".join(g.name for g in obj.groups)
+
+
+class UserCRUD(CRUD):
+
+    Resource = Resource
+
+
+class UserGroupListing(Listing):
+
+    table = listing.Table(
+        columns=[
+            listing.Column("email", "Email"),
+            listing.Column("groups", "Groups", getter=_get_group_names, relationships=["groups"]),
+        ]
+    )
+
+    def order_query(self, query):
+        return query.order_by(User.id)
+
+
+class DetectingUserGroupListing(UserGroupListing):
+
+    detect_relationships = True
+
+    table = listing.Table(
+        columns=[
+            listing.Column("email", "Email"),
+            listing.Column("groups", "Groups", getter=_get_group_names),
+        ]
+    )
+
+
+class UnoptimizedUserGroupListing(DetectingUserGroupListing):
+
+    detect_relationships = False
+
+
+def _create_users(dbsession, registry):
+    with transaction.manager:
+        create_user(dbsession, registry, admin=True)
+        for index in range(3):
+            create_user(dbsession, registry, email="example{}@example.com".format(index))
+
+
+def test_declared_relationships(dbsession, registry, test_request):
+    """Relationships declared on columns are loaded with the listing query."""
+    _create_users(dbsession, registry)
+
+    with transaction.manager:
+        view = UserGroupListing(UserCRUD(test_request, User), test_request)
+        users = list(view.listing()["batch"])
+        assert len(users) == 4
+        for u in users:
+            assert "groups" not in inspect(u).unloaded
+
+
+def test_detect_relationships(dbsession, registry, test_request):
+    """Dry-run finds the relationships touched by getters."""
+    _create_users(dbsession, registry)
+
+    with transaction.manager:
+        view = DetectingUserGroupListing(UserCRUD(test_request, User), test_request)
+        query = view.order_query(view.get_query())
+        assert view.get_relationship_paths(query, view.table.get_columns()) == ["groups"]
+
+
+def test_detect_loaded_relationships(dbsession, registry, test_request):
+    """Relationships already loaded in the identity map are detected, an empty result is not cached."""
+
+    class FreshListing(DetectingUserGroupListing):
+        """Not in the detection cache yet."""
+
+    with transaction.manager:
+        view = FreshListing(UserCRUD(test_request, User), test_request)
+        columns = view.table.get_columns()
+        query = view.order_query(view.get_query())
+        assert view.detect_relationship_paths(query, columns) == []
+
+    _create_users(dbsession, registry)
+
+    with transaction.manager:
+        # The sampled row has its groups loaded already, e.g. it is the logged in user
+        users = test_request.dbsession.query(User).all()
+        for u in users:
+            list(u.groups)
+
+        view = FreshListing(UserCRUD(test_request, User), test_request)
+        query = view.order_query(view.get_query())
+        assert view.detect_relationship_paths(query, columns) == ["groups"]
+
+
+def test_query_count_warning(dbsession, registry, test_request, caplog):
+    """Debug mode warns about lazy loads per row."""
+    _create_users(dbsession, registry)
+
+    registry.settings["websauna.debug_listing_queries"] = "true"
+    try:
+        with transaction.manager:
+            view = UnoptimizedUserGroupListing(UserCRUD(test_request, User), test_request)
+            template_context = view.listing()
+            for u in template_context["batch"]:
+                _get_group_names(view, None, u)
+
+            with caplog.at_level(logging.WARNING):
+                test_request._process_response_callbacks(Response())
+    finally:
+        del registry.settings["websauna.debug_listing_queries"]
+
+    assert "issued 4 queries for 4 rows" in caplog.text
+
+
+def test_query_count_no_warning(dbsession, registry, test_request, caplog):
+    """Counting and fetching the page are not counted as per row queries."""
+
+    class SingleUserListing(UserGroupListing):
+
+        def get_query(self):
+            return super().get_query().filter(User.email == "example0@example.com")
+
+    _create_users(dbsession, registry)
+
+    registry.settings["websauna.debug_listing_queries"] = "true"
+    try:
+        with transaction.manager:
+            view = SingleUserListing(UserCRUD(test_request, User), test_request)
+            template_context = view.listing()
+            for u in template_context["batch"]:
+                _get_group_names(view, None, u)
+
+            with caplog.at_level(logging.WARNING):
+                test_request._process_response_callbacks(Response())
+    finally:
+        del registry.settings["websauna.debug_listing_queries"]
+
+    assert "issued" not in caplog.text
@@ -0,0 +1,119 @@
+"""Test CRUD traversal lookups."""
+# Pyramid
+import transaction
+from pyramid.config import Configurator
+from zope.interface import Interface
+from zope.interface import implementer
+
+# SQLAlchemy
+from sqlalchemy import event
+
+import pytest
+
+# Websauna
+from websauna.system.crud import get_reserved_view_names
+from websauna.system.crud.sqlalchemy import CRUD
+from websauna.system.crud.sqlalchemy import Resource
+from websauna.system.crud.urlmapper import IdMapper
+from websauna.system.user.models import User
+from websauna.tests.test_utils import create_user
+
+
+class UserCRUD(CRUD):
+
+    Resource = Resource
+
+
+class UserIdCRUD(UserCRUD):
+
+    mapper = IdMapper()
+
+
+class IGroupCRUD(Interface):
+    """Views registered for an interface."""
+
+
+@implementer(IGroupCRUD)
+class GroupCRUD(CRUD):
+
+    Resource = Resource
+
+
+class UserAnyPathCRUD(UserCRUD):
+
+    #: Like UUID slugs, every path might be an object id
+    mapper = IdMapper(mapping_attribute="username", transform_to_id=str, is_id=lambda value: True)
+
+
+@pytest.fixture
+def statements(dbsession):
+    """Collect SQL statements executed on the test database."""
+    executed = []
+    engine = dbsession.get_bind()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    yield executed
+    event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def test_reserved_view_names(registry):
+    """CRUD view names are collected from view configuration."""
+    names = get_reserved_view_names(registry, UserCRUD)
+    assert "listing" in names
+    assert "add" in names
+    assert "csv-export" in names
+
+    # Object level views are not reserved
+    assert "edit" not in names
+
+
+def test_reserved_view_names_per_crud():
+    """View names of one CRUD do not shadow objects of unrelated CRUDs."""
+    config = Configurator()
+    config.add_view(lambda context, request: None, context=UserCRUD, name="user-report")
+    config.add_view(lambda context, request: None, context=IGroupCRUD, name="group-report")
+    config.add_view(lambda context, request: None, context=CRUD, name="summary")
+    config.commit()
+    registry = config.registry
+
+    assert get_reserved_view_names(registry, UserIdCRUD) == {"user-report", "summary"}
+    assert get_reserved_view_names(registry, GroupCRUD) == {"group-report", "summary"}
+    assert get_reserved_view_names(registry, UserIdCRUD) is get_reserved_view_names(registry, UserIdCRUD)
+
+
+def test_reserved_view_name_no_query(dbsession, test_request, statements):
+    """View names which might be object ids do not hit the database."""
+    crud = UserAnyPathCRUD(test_request, User)
+
+    with transaction.manager:
+        with pytest.raises(KeyError):
+            crud["listing"]
+
+    assert not statements
+
+    with transaction.manager:
+        with pytest.raises(KeyError):
+            crud["nonexisting"]
+
+    assert statements
+
+
+def test_primary_key_identity_map(dbsession, registry, test_request, statements):
+    """Objects already in the session are fetched by primary key without a query."""
+    with transaction.manager:
+        create_user(dbsession, registry)
+
+    with transaction.manager:
+        user = dbsession.query(User).one()
+        del statements[:]
+
+        crud = UserIdCRUD(test_request, User)
+        resource = crud[str(user.id)]
+        assert resource.get_object() is user
+        assert not statements
+
+        with pytest.raises(KeyError):
+            crud["999"]
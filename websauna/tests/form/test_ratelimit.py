@@ -0,0 +1,165 @@
+"""Rate limiter algorithms."""
+# Standard Library
+import time
+
+# Pyramid
+from pyramid.registry import Registry
+
+import pytest
+from redis import StrictRedis
+from redis.exceptions import ConnectionError
+from redis.exceptions import TimeoutError
+
+# Websauna
+from websauna.system.core.redis import get_redis
+from websauna.system.form import ratelimit
+
+
+@pytest.mark.parametrize("limiter", ["rolling", "gcra", "sliding"])
+def test_limit(registry, limiter):
+    """Hits over the limit are refused."""
+    redis = get_redis(registry)
+    redis.delete("test_rate_limit")
+
+    statuses = [ratelimit.hit(registry, "test_rate_limit", 3, 60, limiter) for i in range(4)]
+    assert [s.limited for s in statuses] == [False, False, False, True]
+    assert [s.remaining for s in statuses] == [2, 1, 0, 0]
+    assert 0 < statuses[-1].retry_after <= 60
+    assert 0 < redis.ttl("test_rate_limit") <= 120
+
+
+@pytest.mark.parametrize("limiter", ["gcra", "sliding"])
+def test_constant_memory(registry, limiter):
+    """Limiters other than the rolling window do not store hits."""
+    redis = get_redis(registry)
+    redis.delete("test_rate_limit")
+
+    for i in range(20):
+        ratelimit.hit(registry, "test_rate_limit", 1000, 3600, limiter)
+
+    assert redis.type("test_rate_limit") in (b"string", b"hash")
+    if limiter == "sliding":
+        assert int(redis.hget("test_rate_limit", "c")) == 20
+
+
+def test_parse_rate():
+    """Rate setting strings are limit/window with an optional limiter."""
+    assert ratelimit.parse_rate("50/3600") == (50, 3600, None)
+    assert ratelimit.parse_rate("50/3600/gcra") == (50, 3600, "gcra")
+
+    with pytest.raises(RuntimeError):
+        ratelimit.parse_rate("50")
+
+    with pytest.raises(RuntimeError):
+        ratelimit.parse_rate("50/3600/foobar")
+
+
+def test_local_limiter():
+    """In-process token bucket refuses hits over the limit and drops old buckets."""
+    limiter = ratelimit.LocalTokenBucketLimiter(max_keys=2)
+    statuses = [limiter.hit(None, "a", 2, 60) for i in range(3)]
+    assert [s.limited for s in statuses] == [False, False, True]
+    assert 0 < statuses[-1].retry_after <= 30
+
+    limiter.hit(None, "b", 2, 60)
+    limiter.hit(None, "c", 2, 60)
+    assert list(limiter.buckets) == ["b", "c"]
+
+
+def test_circuit_breaker():
+    """Circuit opens after failures and closes when the service recovers."""
+    breaker = ratelimit.CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    calls = []
+
+    def broken():
+        calls.append("broken")
+        raise ConnectionError()
+
+    def working():
+        calls.append("working")
+        return "service"
+
+    def fallback():
+        return "fallback"
+
+    assert breaker.call(broken, fallback) == "fallback"
+    assert breaker.state == breaker.CLOSED
+    assert breaker.call(broken, fallback) == "fallback"
+    assert breaker.state == breaker.OPEN
+
+    # Service is not called while open
+    assert breaker.call(working, fallback) == "fallback"
+    assert calls == ["broken", "broken"]
+
+    # Failed trial keeps the circuit open
+    time.sleep(0.06)
+    assert breaker.call(broken, fallback) == "fallback"
+    assert breaker.state == breaker.OPEN
+
+    time.sleep(0.06)
+    assert breaker.call(working, fallback) == "service"
+    assert breaker.state == breaker.CLOSED
+
+
+def test_circuit_breaker_latency():
+    """Slow calls count as failures."""
+    breaker = ratelimit.CircuitBreaker(failure_threshold=1, latency_budget=0.01)
+    assert breaker.call(lambda: time.sleep(0.02) or "slow", lambda: "fallback") == "slow"
+    assert breaker.state == breaker.OPEN
+
+
+def test_circuit_breaker_unexpected_error():
+    """A trial call raising an unexpected exception does not leave the circuit half-open."""
+    breaker = ratelimit.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+
+    def broken():
+        raise ConnectionError()
+
+    def buggy():
+        raise ValueError()
+
+    breaker.call(broken, lambda: "fallback")
+    assert breaker.state == breaker.OPEN
+
+    time.sleep(0.06)
+    with pytest.raises(ValueError):
+        breaker.call(buggy, lambda: "fallback")
+    assert breaker.state == breaker.OPEN
+
+    time.sleep(0.06)
+    assert breaker.call(lambda: "service", lambda: "fallback") == "service"
+    assert breaker.state == breaker.CLOSED
+
+
+def test_redis_stall():
+    """A stalled Redis call times out after the latency budget and counts as a failure."""
+    registry = Registry()
+    registry.settings = {
+        "redis.sessions.url": "redis://localhost:6379/14",
+        "websauna.throttle_latency_budget": "0.05",
+        "websauna.throttle_breaker_failures": "1",
+    }
+
+    redis = ratelimit.get_limiter_redis(registry)
+    assert redis is ratelimit.get_limiter_redis(registry)
+
+    # Blocking pop stalls the connection for a second
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        redis.blpop("test_rate_limit_stall", timeout=1)
+    assert time.monotonic() - started < 0.5
+
+    breaker = ratelimit.get_circuit_breaker(registry)
+    assert breaker.call(lambda: redis.blpop("test_rate_limit_stall", timeout=1), lambda: "fallback") == "fallback"
+    assert breaker.state == breaker.OPEN
+
+
+def test_redis_down():
+    """Throttling falls back to in-process counting when Redis is down."""
+    registry = Registry()
+    registry.settings = {}
+    registry.redis = StrictRedis.from_url("redis://localhost:1/0")
+
+    statuses = [ratelimit.hit(registry, "test_rate_limit_redis_down", 2, 60, "gcra") for i in range(3)]
+    assert [s.limited for s in statuses] == [False, False, True]
+    assert registry.rate_limit_circuit_breaker.state == ratelimit.CircuitBreaker.OPEN
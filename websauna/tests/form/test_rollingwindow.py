@@ -0,0 +1,40 @@
+"""Rolling time window counter."""
+# Websauna
+from websauna.system.core.redis import get_redis
+from websauna.system.form import rollingwindow
+
+
+def test_check(registry):
+    """Hits are counted and the limit is enforced."""
+    redis = get_redis(registry)
+    redis.delete("test_rolling_window")
+
+    assert not rollingwindow.check(registry, "test_rolling_window", window=60, limit=2)
+    assert not rollingwindow.check(registry, "test_rolling_window", window=60, limit=2)
+    assert rollingwindow.check(registry, "test_rolling_window", window=60, limit=2)
+
+    # Key goes away when there is no traffic
+    assert 0 < redis.ttl("test_rolling_window") <= 60
+
+
+def test_get(registry):
+    """Reading the counter does not record a hit."""
+    redis = get_redis(registry)
+    redis.delete("test_rolling_window")
+
+    assert rollingwindow.get(registry, "test_rolling_window") == 0
+    rollingwindow.check(registry, "test_rolling_window", window=60, limit=2)
+    assert rollingwindow.get(registry, "test_rolling_window") == 1
+    assert rollingwindow.get(registry, "test_rolling_window", window=60) == 1
+    assert rollingwindow.get(registry, "test_rolling_window") == 1
+
+
+def test_expire_old_hits(registry):
+    """Hits older than the window are not counted."""
+    redis = get_redis(registry)
+    redis.delete("test_rolling_window")
+    redis.zadd("test_rolling_window", {"old": 1})
+
+    assert rollingwindow.get(registry, "test_rolling_window", window=60) == 0
+    assert not rollingwindow.check(registry, "test_rolling_window", window=60, limit=1)
+    assert rollingwindow.get(registry, "test_rolling_window") == 1
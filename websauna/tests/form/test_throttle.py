@@ -1,6 +1,8 @@
 """Test view throttlign facilities."""
 # Pyramid
 from pyramid.httpexceptions import HTTPOk
+from pyramid.registry import Registry
+from pyramid.request import Request
 
 import pytest
 from webtest import TestApp as App
@@ -9,6 +11,9 @@ from webtest import TestApp as App
 import websauna
 from websauna.system.core.redis import get_redis  # noQA
 from websauna.system.form.throttle import clear_throttle
+from websauna.system.form.throttle import client_ip_key
+from websauna.system.form.throttle import get_client_addr
+from websauna.system.form.throttle import session_key
 from websauna.system.form.throttle import throttled_view
 
 
@@ -16,6 +21,19 @@ def throttle_sample(request):
     return HTTPOk()
 
 
+def per_client_sample(request):
+    return HTTPOk()
+
+
+def per_session_sample(request):
+    return HTTPOk()
+
+
+def start_session_sample(request):
+    request.session["started"] = True
+    return HTTPOk()
+
+
 @pytest.fixture(scope="module")
 def throttle_app(request, paster_config):
     '''Custom WSGI app with permission test views enabled.'''
@@ -25,6 +43,12 @@ def throttle_app(request, paster_config):
         def configure_views(self):
             self.config.add_route("throttle_sample", "/")
             self.config.add_view(throttle_sample, route_name="throttle_sample", decorator=throttled_view(limit=1))
+            self.config.add_route("per_client_sample", "/per-client")
+            self.config.add_view(per_client_sample, route_name="per_client_sample", decorator=throttled_view(limit=1, time_window_in_seconds=60, key_func=client_ip_key))
+            self.config.add_route("per_session_sample", "/per-session")
+            self.config.add_view(per_session_sample, route_name="per_session_sample", decorator=throttled_view(limit=1, time_window_in_seconds=60, key_func=session_key))
+            self.config.add_route("start_session_sample", "/start-session")
+            self.config.add_view(start_session_sample, route_name="start_session_sample")
 
         def configure_csrf(self):
             """Disable CSRF for this test run for making testing simpler."""
@@ -55,3 +79,66 @@ def test_throttle(throttle_app: App, test_request):
     clear_throttle(test_request, "throttle_sample")
 
     app.get("/", status=200)
+
+
+def test_throttle_per_client(throttle_app: App, test_request):
+    """Clients are throttled separately and told when to retry."""
+    app = throttle_app
+    redis = get_redis(test_request)
+    for key in redis.keys("throttle_per_client_sample:*"):
+        redis.delete(key)
+
+    resp = app.get("/per-client", extra_environ={"REMOTE_ADDR": "10.0.0.1"}, status=200)
+    assert resp.headers["RateLimit-Limit"] == "1"
+    assert resp.headers["RateLimit-Remaining"] == "0"
+
+    resp = app.get("/per-client", extra_environ={"REMOTE_ADDR": "10.0.0.1"}, status=429)
+    assert 0 < int(resp.headers["Retry-After"]) <= 60
+    assert resp.headers["RateLimit-Remaining"] == "0"
+
+    # Spoofed X-Forwarded-For from an untrusted address does not escape the limit
+    app.get("/per-client", extra_environ={"REMOTE_ADDR": "10.0.0.1"}, headers={"X-Forwarded-For": "10.0.0.3"}, status=429)
+
+    # Another client is not affected
+    app.get("/per-client", extra_environ={"REMOTE_ADDR": "10.0.0.2"}, status=200)
+
+
+def test_throttle_per_session(throttle_app: App, test_request):
+    """Sessions are throttled separately, requests without a session cookie by client IP address."""
+    wsgi_app = throttle_app.app
+    redis = get_redis(test_request)
+    for key in redis.keys("throttle_per_session_sample:*"):
+        redis.delete(key)
+
+    session_count = len(redis.keys("websauna_session*"))
+    environ = {"REMOTE_ADDR": "10.0.1.1"}
+
+    # Cookie-less client cannot get a new bucket on every request and no sessions are created for it
+    App(wsgi_app).get("/per-session", extra_environ=environ, status=200)
+    App(wsgi_app).get("/per-session", extra_environ=environ, status=429)
+    assert len(redis.keys("websauna_session*")) == session_count
+
+    # Clients with a session behind the same address have their own buckets
+    for index in range(2):
+        browser = App(wsgi_app)
+        browser.get("/start-session", extra_environ=environ)
+        browser.get("/per-session", extra_environ=environ, status=200)
+        browser.get("/per-session", extra_environ=environ, status=429)
+
+
+def test_client_addr_trusted_proxies():
+    """X-Forwarded-For is read from the right, only through trusted proxies."""
+    registry = Registry()
+    registry.settings = {"websauna.throttle_trusted_proxies": "127.0.0.1 10.1.0.0/16"}
+
+    def client_addr(remote_addr, forwarded=None):
+        request = Request.blank("/", remote_addr=remote_addr, headers={"X-Forwarded-For": forwarded} if forwarded else {})
+        request.registry = registry
+        return get_client_addr(request)
+
+    assert client_addr("192.168.1.1", "1.2.3.4") == "192.168.1.1"
+    assert client_addr("127.0.0.1") == "127.0.0.1"
+    assert client_addr("127.0.0.1", "1.2.3.4") == "1.2.3.4"
+    assert client_addr("127.0.0.1", "6.6.6.6, 1.2.3.4, 10.1.2.3") == "1.2.3.4"
+    assert client_addr("127.0.0.1", "10.1.0.1, 10.1.2.3") == "10.1.0.1"
+    assert client_addr("127.0.0.1", "garbage") == "garbage"
@@ -1,5 +1,6 @@
 """Permission test views."""
 # Standard Library
+import datetime
 import typing as t
 
 # Pyramid
@@ -9,6 +10,7 @@ from pyramid.view import view_config
 from zope.interface import implementer
 
 # Websauna
+from websauna.system.core.interfaces import IBatchContainer
 from websauna.system.core.interfaces import IContainer
 from websauna.system.core.root import Root
 from websauna.system.core.route import simple_route
@@ -49,6 +51,33 @@ class SampleContainer(SampleResource):
         # First level container has second level nested container
         if self.name == "Container folder":
             yield construct_child("nested", SampleContainer(request, "Nested"))
+            yield construct_child("batch", SampleBatchContainer(request, "Batch"))
+
+
+@implementer(IBatchContainer)
+class SampleBatchContainer(SampleResource):
+    """Container enumerating its children in pages."""
+
+    #: Number of children
+    item_count = 25
+
+    #: Number of pages loaded, like database queries in a real container
+    pages_loaded = 0
+
+    def iterate_batches(self, batch_size: int) -> t.Iterable[t.List[t.Tuple[str, ILocation, t.Optional[datetime.date]]]]:
+        for start in range(0, self.item_count, batch_size):
+            SampleBatchContainer.pages_loaded += 1
+            batch = []
+            for i in range(start, min(start + batch_size, self.item_count)):
+                child_id = "item-{}".format(i)
+                child = Resource.make_lineage(self, SampleResource(self.request, child_id), child_id)
+                batch.append((child_id, child, datetime.date(2015, 1, 1) + datetime.timedelta(days=i)))
+            yield batch
+
+    def items(self) -> t.Iterable[t.Tuple[str, ILocation]]:
+        for batch in self.iterate_batches(10):
+            for name, child, lastmod in batch:
+                yield name, child
 
 
 @view_config(context=SampleResource, name="", route_name="sitemap_test")
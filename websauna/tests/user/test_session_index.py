@@ -0,0 +1,112 @@
+"""Per-user session index."""
+# Pyramid
+from pyramid import testing
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.response import Response
+from pyramid.security import forget
+from pyramid.security import remember
+
+import pytest
+from redis import StrictRedis
+from webtest import TestApp as App
+
+# Websauna
+from websauna.system.auth import sessionindex
+from websauna.system.auth.policy import SessionAuthenticationPolicy
+from websauna.system.core.session import set_creation_time_aware_session_factory
+
+
+def get_redis_client(request, **redis_options):
+    return StrictRedis.from_url("redis://localhost:6379/14")
+
+
+def login_view(request):
+    remember(request, 1)
+    return Response("ok")
+
+
+def logout_view(request):
+    forget(request)
+    return Response("ok")
+
+
+def whoami_view(request):
+    return Response(str(request.authenticated_userid))
+
+
+def kill_view(request):
+    return Response(str(sessionindex.delete_user_sessions(request, 1)))
+
+
+@pytest.fixture()
+def config(request):
+    """Configure sessions and session authentication."""
+    settings = {
+        "redis.sessions.secret": "secret",
+        "redis.sessions.client_callable": get_redis_client,
+    }
+    config = testing.setUp(settings=settings)
+    set_creation_time_aware_session_factory(config)
+    config.set_authorization_policy(ACLAuthorizationPolicy())
+    config.set_authentication_policy(SessionAuthenticationPolicy())
+    for name, view in (("login", login_view), ("logout", logout_view), ("whoami", whoami_view), ("kill", kill_view)):
+        config.add_route(name, "/" + name)
+        config.add_view(view, route_name=name)
+
+    get_redis_client(None).delete(sessionindex.get_index_key(1))
+
+    def teardown():
+        testing.tearDown()
+
+    request.addfinalizer(teardown)
+    return config
+
+
+def test_kill_user_sessions(config):
+    """Sessions of a user are deleted through the index."""
+    wsgi_app = config.make_wsgi_app()
+    browser1 = App(wsgi_app)
+    browser2 = App(wsgi_app)
+    admin = App(wsgi_app)
+
+    browser1.get("/login")
+    browser2.get("/login")
+    assert browser1.get("/whoami").text == "1"
+    assert browser2.get("/whoami").text == "1"
+
+    redis = get_redis_client(None)
+    assert redis.scard(sessionindex.get_index_key(1)) == 2
+
+    assert admin.get("/kill").text == "2"
+    assert browser1.get("/whoami").text == "None"
+    assert browser2.get("/whoami").text == "None"
+    assert not redis.exists(sessionindex.get_index_key(1))
+
+
+def test_logout_removes_session(config):
+    """Logging out removes the session from the index."""
+    browser = App(config.make_wsgi_app())
+    browser.get("/login")
+    browser.get("/logout")
+    assert get_redis_client(None).scard(sessionindex.get_index_key(1)) == 0
+
+
+def test_kill_own_session(config):
+    """Killing the sessions of the current user does not write the session back."""
+    browser = App(config.make_wsgi_app())
+    browser.get("/login")
+    assert browser.get("/kill").text == "1"
+    assert browser.get("/whoami").text == "None"
+
+
+def test_index_expiration_refreshed(config):
+    """The index lives as long as the sessions which are kept alive by requests."""
+    browser = App(config.make_wsgi_app())
+    browser.get("/login")
+
+    redis = get_redis_client(None)
+    key = sessionindex.get_index_key(1)
+    redis.expire(key, 5)
+
+    assert browser.get("/whoami").text == "1"
+    assert redis.ttl(key) > 5